@@ -0,0 +1,65 @@
+# Per-token overhead of the decode loop (flash_attn.utils.generation.decode) outside of the model
+# forward: sampling, stopping checks, syncs with the device and output bookkeeping. Uses a tiny
+# model on CPU so that the forward is cheap and the overhead of the loop is visible.
+import time
+
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.generation import decode
+
+# On GPU, checking for EOS also waits for the device, so the gap between the configurations is
+# larger than on CPU
+device = "cpu"
+config = GPT2Config(n_embd=32, n_head=2, n_layer=1, vocab_size=64, n_positions=1024)
+batch_size, seqlen, max_length = 8, 16, 1024
+repeats = 5
+
+torch.manual_seed(0)
+model = GPTLMHeadModel(config, device=device, dtype=torch.float32)
+model.eval()
+input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), device=device)
+# Never sampled, so that every configuration runs to max_length but still checks for EOS
+eos_token_id = config.vocab_size
+
+forward_time = 0.0
+
+
+def forward_pre_hook(module, args):
+    global forward_start
+    forward_start = time.perf_counter()
+
+
+def forward_hook(module, args, output):
+    global forward_time
+    forward_time += time.perf_counter() - forward_start
+
+
+model.register_forward_pre_hook(forward_pre_hook)
+model.register_forward_hook(forward_hook)
+
+
+def benchmark(**kwargs):
+    global forward_time
+    decode(input_ids, model, max_length, eos_token_id=eos_token_id, **kwargs)  # Warmup
+    forward_time = 0.0
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = decode(input_ids, model, max_length, eos_token_id=eos_token_id, **kwargs)
+    total_time = time.perf_counter() - start
+    num_tokens = (out.sequences.shape[1] - seqlen) * repeats
+    return total_time / num_tokens * 1e6, (total_time - forward_time) / num_tokens * 1e6
+
+
+print(f"Model: {config.n_layer} layer, hidden {config.n_embd}, {device}")
+print(f"Batch size {batch_size}, prompt length {seqlen}, max length {max_length}")
+print(f"{'configuration':<40}{'us/token':>10}{'loop overhead us/token':>24}")
+for name, kwargs in [
+    ("check EOS every step, keep scores", dict(stop_check_interval=1)),
+    ("check EOS every 8 steps, keep scores", dict(stop_check_interval=8)),
+    ("check EOS every 8 steps, no scores", dict(stop_check_interval=8, output_scores=False)),
+    ("check EOS every 32 steps, no scores", dict(stop_check_interval=32, output_scores=False)),
+]:
+    time_per_token, overhead_per_token = benchmark(**kwargs)
+    print(f"{name:<40}{time_per_token:>10.1f}{overhead_per_token:>24.1f}")
@@ -0,0 +1,83 @@
+# Accuracy vs memory of the quantized KV cache (flash_attn.utils.quantized_kv_cache), compared to
+# the KV cache in the dtype of the model. Runs on CPU if there's no GPU (with a smaller model).
+import time
+
+import torch
+import torch.nn.functional as F
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.quantized_kv_cache import QUANT_DTYPES
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+dtype = torch.float16 if device == "cuda" else torch.float32
+if device == "cuda":
+    config = GPT2Config(n_embd=1024, n_head=16, n_layer=24, vocab_size=50257, n_positions=2048)
+    batch_size, seqlen, max_length = 8, 512, 640
+else:
+    config = GPT2Config(n_embd=256, n_head=4, n_layer=4, vocab_size=1024, n_positions=512)
+    batch_size, seqlen, max_length = 4, 128, 192
+memory_budget = 2**30  # Memory for the KV cache, to compute the max batch size
+repeats = 3
+
+torch.manual_seed(0)
+model = GPTLMHeadModel(config, device=device, dtype=dtype)
+model.eval()
+input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), device=device)
+
+
+def generate(**kwargs):
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeats):
+        out = model.generate(
+            input_ids, max_length, return_dict_in_generate=True, output_scores=True, **kwargs
+        )
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return out, (time.time() - start) / repeats
+
+
+def kv_cache_bytes_per_token(**kwargs):
+    kv_cache = model.allocate_inference_cache(1, 1, dtype=dtype, **kwargs)
+    return sum(c.nbytes for c in kv_cache.values())
+
+
+out_ref, time_ref = generate()
+scores_ref = torch.stack(out_ref.scores, dim=1).float()
+bytes_ref = kv_cache_bytes_per_token()
+print(f"Model: {config.n_layer} layers, hidden {config.n_embd}, {dtype}, {device}")
+print(f"Batch size {batch_size}, prompt length {seqlen}, max length {max_length}")
+print(
+    f"{'KV cache':<24}{'bytes/token':>12}{'max batch':>10}{'max |dlogit|':>14}"
+    f"{'KL':>10}{'top-1 match':>13}{'time (ms)':>11}"
+)
+max_batch_size = memory_budget // (bytes_ref * max_length)
+print(
+    f"{str(dtype).split('.')[-1]:<24}{bytes_ref:>12}{max_batch_size:>10}{0.0:>14.4f}{0.0:>10.2e}"
+    f"{1.0:>13.4f}{time_ref * 1000:>11.0f}"
+)
+for quant_dtype in QUANT_DTYPES:
+    for group_size in [None, 32]:
+        kwargs = dict(kv_cache_quant_dtype=quant_dtype, kv_cache_quant_group_size=group_size)
+        # Feed the same tokens as the reference, so that the logits can be compared at every step
+        out, elapsed = generate(teacher_outputs=out_ref.sequences, **kwargs)
+        scores = torch.stack(out.scores, dim=1).float()
+        kl = F.kl_div(
+            F.log_softmax(scores, dim=-1),
+            F.log_softmax(scores_ref, dim=-1),
+            log_target=True,
+            reduction="batchmean",
+        ) / scores.shape[1]
+        top1 = (scores.argmax(dim=-1) == scores_ref.argmax(dim=-1)).float().mean()
+        nbytes = kv_cache_bytes_per_token(**kwargs)
+        name = f"{str(quant_dtype).split('.')[-1]}, " + (
+            "per head" if group_size is None else f"group {group_size}"
+        )
+        max_batch_size = memory_budget // (nbytes * max_length)
+        print(
+            f"{name:<24}{nbytes:>12}{max_batch_size:>10}"
+            f"{(scores - scores_ref).abs().max().item():>14.4f}{kl.item():>10.2e}"
+            f"{top1.item():>13.4f}{elapsed * 1000:>11.0f}"
+        )
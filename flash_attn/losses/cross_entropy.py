@@ -3,7 +3,12 @@
 import torch
 import torch.nn as nn
 
-from flash_attn.ops.triton.cross_entropy import cross_entropy_loss
+from flash_attn.ops.cross_entropy import cross_entropy_loss as cross_entropy_loss_torch
+
+try:
+    from flash_attn.ops.triton.cross_entropy import cross_entropy_loss
+except ImportError:
+    cross_entropy_loss = None
 
 
 class CrossEntropyLoss(nn.Module):
@@ -27,7 +32,8 @@ class CrossEntropyLoss(nn.Module):
             inplace_backward: bool. If True, we do the backward pass in-place by modifying the logits.
                 This saves memory.
             process_group: if not None, we're doing Tensor Parallel: each process is responsible for
-                one part of the vocab. The loss will be aggregated across processes.
+                one part of the vocab. The loss will be aggregated across processes. For CPU
+                tensors, the process group must support CPU tensors (e.g. gloo).
             return_z_loss: bool. If True, we return the component of the loss contributed by
                 the lse_square_scale value. This value is only for logging and does not support
                 backprop.
@@ -52,9 +58,13 @@ class CrossEntropyLoss(nn.Module):
         Returns:
             losses: (batch,) if reduction is 'none', else (1,), dtype float
             z_loss: (batch,) if reduction is 'none', else (1,), dtype float (if self.return_z_loss)
+        CUDA tensors use the Triton kernels, CPU tensors use a chunked PyTorch implementation.
         """
-        assert input.is_cuda and target.is_cuda, "Only support CUDA tensors"
-        loss, z_loss = cross_entropy_loss(
+        if input.is_cuda:
+            assert target.is_cuda, "input and target must be on the same device"
+            assert cross_entropy_loss is not None, "Triton is needed for CUDA tensors"
+        loss_fn = cross_entropy_loss if input.is_cuda else cross_entropy_loss_torch
+        loss, z_loss = loss_fn(
             input,
             target,
             precomputed_lse=precomputed_lse,
@@ -0,0 +1,275 @@
+# Copyright (c) 2024, Tri Dao.
+
+# Fused LM head + cross-entropy. The logits are computed one (token chunk, vocab chunk) tile at a
+# time and reduced with an online log-sum-exp, so the full (num_tokens, vocab_size) logits and their
+# gradient are never materialized. The backward pass recomputes the logits of each tile from the
+# saved log-sum-exp and accumulates the gradients of the hidden states and of the weight.
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def _tile_logits(hidden_states, weight, bias, logit_scale):
+    logits = F.linear(hidden_states, weight, bias).float()
+    return logits * logit_scale if logit_scale != 1.0 else logits
+
+
+class LinearCrossEntropyLossFn(torch.autograd.Function):
+
+    @staticmethod
+    def forward(
+        ctx,
+        hidden_states,
+        weight,
+        bias,
+        labels,
+        smoothing=0.0,
+        logit_scale=1.0,
+        lse_square_scale=0.0,
+        ignore_index=-100,
+        token_chunk_size=4096,
+        vocab_chunk_size=8192,
+    ):
+        n_rows, _ = hidden_states.shape
+        vocab_size = weight.shape[0]
+        assert labels.shape == (n_rows,)
+        losses = torch.empty(n_rows, dtype=torch.float, device=hidden_states.device)
+        lse = torch.empty(n_rows, dtype=torch.float, device=hidden_states.device)
+        for start in range(0, n_rows, token_chunk_size):
+            end = min(start + token_chunk_size, n_rows)
+            hidden_chunk, labels_chunk = hidden_states[start:end], labels[start:end]
+            # Running max and running sum of exp(logits - max) of each row
+            row_max = torch.full((end - start,), float("-inf"), device=hidden_states.device)
+            row_sum = torch.zeros(end - start, device=hidden_states.device)
+            sum_logits = torch.zeros(end - start, device=hidden_states.device)
+            logits_label = torch.zeros(end - start, device=hidden_states.device)
+            for vstart in range(0, vocab_size, vocab_chunk_size):
+                vend = min(vstart + vocab_chunk_size, vocab_size)
+                logits = _tile_logits(
+                    hidden_chunk,
+                    weight[vstart:vend],
+                    bias[vstart:vend] if bias is not None else None,
+                    logit_scale,
+                )
+                new_max = torch.maximum(row_max, logits.amax(dim=-1))
+                row_sum = row_sum * torch.exp(row_max - new_max) + torch.exp(
+                    logits - new_max[:, None]
+                ).sum(dim=-1)
+                row_max = new_max
+                if smoothing > 0.0:
+                    sum_logits += logits.sum(dim=-1)
+                in_chunk = (labels_chunk >= vstart) & (labels_chunk < vend)
+                label_idx = torch.where(in_chunk, labels_chunk - vstart, 0)
+                logits_label += torch.where(
+                    in_chunk, logits.gather(1, label_idx[:, None]).squeeze(1), 0.0
+                )
+            lse_chunk = row_max + torch.log(row_sum)
+            if smoothing > 0.0:
+                loss = (
+                    lse_chunk - smoothing * sum_logits / vocab_size - (1 - smoothing) * logits_label
+                )
+            else:
+                loss = lse_chunk - logits_label
+            losses[start:end] = loss
+            lse[start:end] = lse_chunk
+        ignored_mask = labels == ignore_index
+        losses.masked_fill_(ignored_mask, 0.0)
+        if lse_square_scale != 0.0:
+            z_losses = lse_square_scale * lse.square()
+            z_losses.masked_fill_(ignored_mask, 0.0)
+            losses += z_losses
+        else:
+            z_losses = torch.zeros_like(losses)
+        ctx.mark_non_differentiable(z_losses)
+        ctx.save_for_backward(hidden_states, weight, bias, labels, lse)
+        ctx.smoothing = smoothing
+        ctx.logit_scale = logit_scale
+        ctx.lse_square_scale = lse_square_scale
+        ctx.ignore_index = ignore_index
+        ctx.token_chunk_size = token_chunk_size
+        ctx.vocab_chunk_size = vocab_chunk_size
+        return losses, z_losses
+
+    @staticmethod
+    def backward(ctx, grad_losses, grad_z_losses):
+        del grad_z_losses  # z_losses are only for logging.
+        hidden_states, weight, bias, labels, lse = ctx.saved_tensors
+        smoothing, logit_scale = ctx.smoothing, ctx.logit_scale
+        n_rows, vocab_size = hidden_states.shape[0], weight.shape[0]
+        grad_losses = grad_losses.float().masked_fill(labels == ctx.ignore_index, 0.0)
+        # dloss / dlogits = softmax * (1 + 2 * lse_square_scale * lse) - smoothing / vocab_size
+        #                   - (1 - smoothing) * onehot(label), scaled by logit_scale
+        probs_scale = 1.0 + 2.0 * ctx.lse_square_scale * lse
+        grad_hidden = torch.empty_like(hidden_states) if ctx.needs_input_grad[0] else None
+        # The weight gradient is accumulated over token chunks, in fp32
+        grad_weight = (
+            torch.zeros_like(weight, dtype=torch.float) if ctx.needs_input_grad[1] else None
+        )
+        grad_bias = (
+            torch.zeros(vocab_size, dtype=torch.float, device=weight.device)
+            if bias is not None and ctx.needs_input_grad[2]
+            else None
+        )
+        for start in range(0, n_rows, ctx.token_chunk_size):
+            end = min(start + ctx.token_chunk_size, n_rows)
+            hidden_chunk, labels_chunk = hidden_states[start:end], labels[start:end]
+            dloss = grad_losses[start:end, None] * logit_scale
+            grad_hidden_chunk = (
+                torch.zeros(hidden_chunk.shape, dtype=torch.float, device=hidden_chunk.device)
+                if grad_hidden is not None
+                else None
+            )
+            for vstart in range(0, vocab_size, ctx.vocab_chunk_size):
+                vend = min(vstart + ctx.vocab_chunk_size, vocab_size)
+                weight_chunk = weight[vstart:vend]
+                logits = _tile_logits(
+                    hidden_chunk,
+                    weight_chunk,
+                    bias[vstart:vend] if bias is not None else None,
+                    logit_scale,
+                )
+                dlogits = torch.exp(logits - lse[start:end, None]) * probs_scale[start:end, None]
+                if smoothing > 0.0:
+                    dlogits -= smoothing / vocab_size
+                in_chunk = (labels_chunk >= vstart) & (labels_chunk < vend)
+                rows = in_chunk.nonzero(as_tuple=True)[0]
+                dlogits[rows, labels_chunk[rows] - vstart] -= 1.0 - smoothing
+                dlogits *= dloss
+                if grad_hidden_chunk is not None:
+                    grad_hidden_chunk += dlogits @ weight_chunk.float()
+                if grad_weight is not None:
+                    grad_weight[vstart:vend] += dlogits.t() @ hidden_chunk.float()
+                if grad_bias is not None:
+                    grad_bias[vstart:vend] += dlogits.sum(dim=0)
+            if grad_hidden is not None:
+                grad_hidden[start:end] = grad_hidden_chunk
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        if grad_bias is not None:
+            grad_bias = grad_bias.to(bias.dtype)
+        return grad_hidden, grad_weight, grad_bias, None, None, None, None, None, None, None
+
+
+def linear_cross_entropy_loss(
+    hidden_states: torch.Tensor,
+    weight: torch.Tensor,
+    labels: torch.Tensor,
+    bias: torch.Tensor = None,
+    label_smoothing: float = 0.0,
+    logit_scale: float = 1.0,
+    lse_square_scale: float = 0.0,
+    ignore_index=-100,
+    token_chunk_size: int = 4096,
+    vocab_chunk_size: int = 8192,
+) -> torch.Tensor:
+    """
+    Arguments:
+        hidden_states: (batch, hidden_dim)
+        weight: (vocab_size, hidden_dim), the weight of the LM head
+        labels: (batch,)
+        bias: (vocab_size,) or None
+        label_smoothing: float
+        logit_scale: float. Multiply logits by this scale before calculating the loss.
+        lse_square_scale: float. If > 0, we add lse_square_scale * lse(logits) ^ 2 to the loss.
+            This is also referred to as "z-loss".
+        ignore_index: int. If labels == ignore_index, the loss is set to 0.0.
+        token_chunk_size, vocab_chunk_size: int. The logits are computed in tiles of
+            (token_chunk_size, vocab_chunk_size), in fp32.
+    Returns:
+        losses: (batch,), float
+        z_losses: (batch,), float
+    """
+    return LinearCrossEntropyLossFn.apply(
+        hidden_states,
+        weight,
+        bias,
+        labels,
+        label_smoothing,
+        logit_scale,
+        lse_square_scale,
+        ignore_index,
+        token_chunk_size,
+        vocab_chunk_size,
+    )
+
+
+class LinearCrossEntropyLoss(nn.Module):
+    def __init__(
+        self,
+        ignore_index=-100,
+        reduction="mean",
+        label_smoothing=0.0,
+        logit_scale=1.0,
+        lse_square_scale=0.0,
+        return_z_loss=False,
+        token_chunk_size=4096,
+        vocab_chunk_size=8192,
+    ):
+        """Same as CrossEntropyLoss, but takes the hidden states and the weight of the LM head
+        instead of the logits.
+        Arguments:
+            ignore_index: int. If labels == ignore_index, the loss is set to 0.0.
+            label_smoothing: float
+            lse_square_scale: float. If > 0, we add lse_square_scale * lse(logits) ^ 2 to the loss.
+                This is also referred to as "z-loss".
+            return_z_loss: bool. If True, we return the component of the loss contributed by
+                the lse_square_scale value. This value is only for logging and does not support
+                backprop.
+            token_chunk_size, vocab_chunk_size: int. Size of the tiles of logits that are
+                materialized at a time.
+        """
+        super().__init__()
+        if reduction not in ["mean", "none", "sum"]:
+            raise NotImplementedError("Only support reduction = 'mean' or 'none' or 'sum'")
+        self.ignore_index = ignore_index
+        self.reduction = reduction
+        self.label_smoothing = label_smoothing
+        self.logit_scale = logit_scale
+        self.lse_square_scale = lse_square_scale
+        self.return_z_loss = return_z_loss
+        self.token_chunk_size = token_chunk_size
+        self.vocab_chunk_size = vocab_chunk_size
+
+    def forward(self, hidden_states, weight, target, bias=None):
+        """
+        Arguments:
+            hidden_states: (..., hidden_dim)
+            weight: (vocab_size, hidden_dim)
+            target: (...)
+            bias: (vocab_size,) or None
+        Returns:
+            losses: (...) if reduction is 'none', else (1,), dtype float
+            z_loss: (...) if reduction is 'none', else (1,), dtype float (if self.return_z_loss)
+        """
+        batch_shape = target.shape
+        loss, z_loss = linear_cross_entropy_loss(
+            hidden_states.reshape(-1, hidden_states.shape[-1]),
+            weight,
+            target.reshape(-1),
+            bias=bias,
+            label_smoothing=self.label_smoothing,
+            logit_scale=self.logit_scale,
+            lse_square_scale=self.lse_square_scale,
+            ignore_index=self.ignore_index,
+            token_chunk_size=self.token_chunk_size,
+            vocab_chunk_size=self.vocab_chunk_size,
+        )
+        if self.reduction == "mean":
+            loss = loss.sum() / (target != self.ignore_index).sum()
+        elif self.reduction == "sum":
+            loss = loss.sum()
+        else:
+            loss = loss.reshape(batch_shape)
+
+        if not self.return_z_loss:
+            return loss
+
+        if self.reduction == "mean":
+            z_loss = z_loss.sum() / (target != self.ignore_index).sum()
+        elif self.reduction == "sum":
+            z_loss = z_loss.sum()
+        else:
+            z_loss = z_loss.reshape(batch_shape)
+
+        return loss, z_loss
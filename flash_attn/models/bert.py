@@ -161,8 +161,10 @@ class BertEncoder(nn.Module):
         """If subset_mask is not None, we only want output for the subset of the sequence.
         This means that we only compute the last layer output for these tokens.
         subset_mask: (batch, seqlen), dtype=torch.bool
+        If key_padding_mask is not None, the padding tokens are removed before the first layer
+        (with or without FlashAttention), so no compute is spent on them.
         """
-        if key_padding_mask is None or not self.use_flash_attn:
+        if key_padding_mask is None:
             mixer_kwargs = (
                 {"key_padding_mask": key_padding_mask} if key_padding_mask is not None else None
             )
@@ -0,0 +1,168 @@
+# Convert a Hugging Face checkpoint to the flash_attn format, already remapped and sharded for
+# tensor parallel, so that starting a replica only has to read the file of its rank:
+#   python -m flash_attn.models.convert_checkpoint meta-llama/Llama-2-70b-hf llama-70b-tp8 \
+#       --world-size 8 --dtype bfloat16
+# Then GPTLMHeadModel.from_pretrained("llama-70b-tp8", config, world_size=8, rank=rank, ...).
+# The conversion can be reversed (for the models that have an inverse remap):
+#   python -m flash_attn.models.convert_checkpoint llama-70b-tp8 llama-70b-hf --reverse
+import argparse
+import json
+import os
+
+import torch
+from safetensors.torch import save_file
+from transformers import AutoConfig, GPT2Config
+from transformers.utils import SAFE_WEIGHTS_NAME
+
+from flash_attn.models.bigcode import (
+    bigcode_config_to_gpt2_config,
+    inv_remap_state_dict_hf_bigcode,
+    remap_state_dict_hf_bigcode,
+)
+from flash_attn.models.falcon import falcon_config_to_gpt2_config, remap_state_dict_hf_falcon
+from flash_attn.models.gpt import (
+    combine_state_dicts_tp,
+    remap_state_dict_hf_gpt2,
+    shard_state_dict_tp,
+)
+from flash_attn.models.gpt_neox import gpt_neox_config_to_gpt2_config, remap_state_dict_hf_gpt_neox
+from flash_attn.models.gptj import gptj_config_to_gpt2_config, remap_state_dict_hf_gptj
+from flash_attn.models.llama import (
+    inv_remap_state_dict_hf_llama,
+    llama_config_to_gpt2_config,
+    remap_state_dict_hf_llama,
+)
+from flash_attn.models.opt import opt_config_to_gpt2_config, remap_state_dict_hf_opt
+from flash_attn.utils.pretrained import (
+    TP_CHECKPOINT_FORMAT_VERSION,
+    TP_MANIFEST_NAME,
+    load_tp_manifest,
+    state_dict_from_pretrained,
+    state_dict_from_tp_checkpoint,
+    tp_checkpoint_filename,
+)
+
+# Hugging Face model_type -> (config to GPT2Config, remap_state_dict, inverse remap_state_dict)
+MODEL_TYPES = {
+    "gpt2": (lambda config: config, remap_state_dict_hf_gpt2, None),
+    "opt": (opt_config_to_gpt2_config, remap_state_dict_hf_opt, None),
+    "gptj": (gptj_config_to_gpt2_config, remap_state_dict_hf_gptj, None),
+    "gpt_neox": (gpt_neox_config_to_gpt2_config, remap_state_dict_hf_gpt_neox, None),
+    "falcon": (falcon_config_to_gpt2_config, remap_state_dict_hf_falcon, None),
+    "llama": (
+        llama_config_to_gpt2_config,
+        remap_state_dict_hf_llama,
+        inv_remap_state_dict_hf_llama,
+    ),
+    "gpt_bigcode": (
+        bigcode_config_to_gpt2_config,
+        remap_state_dict_hf_bigcode,
+        inv_remap_state_dict_hf_bigcode,
+    ),
+}
+
+
+def _save_state_dict(state_dict, path):
+    # safetensors doesn't save tensors that share memory (e.g. tied embeddings, or the shards of
+    # the same tensor), so each tensor gets its own contiguous copy.
+    state_dict = {k: v.clone(memory_format=torch.contiguous_format) for k, v in state_dict.items()}
+    save_file(state_dict, path, metadata={"format": "pt"})
+
+
+def convert_to_tp_checkpoint(
+    model_name, output_dir, world_size=1, dtype=None, num_workers=1, progress=False
+):
+    """Remap the Hugging Face checkpoint of model_name to the flash_attn format, shard it for
+    world_size ranks, and write one safetensors file per rank to output_dir, together with a
+    manifest recording the config, dtype and world_size.
+    Return the manifest.
+    """
+    hf_config = AutoConfig.from_pretrained(model_name)
+    if hf_config.model_type not in MODEL_TYPES:
+        raise NotImplementedError(f"Model type {hf_config.model_type} not supported")
+    config_to_gpt2_config, remap_state_dict, _ = MODEL_TYPES[hf_config.model_type]
+    config = config_to_gpt2_config(hf_config)
+    state_dict = state_dict_from_pretrained(
+        model_name, dtype=dtype, num_workers=num_workers, progress=progress
+    )
+    state_dict = remap_state_dict(state_dict, config)
+    if dtype is None:
+        dtype = next(v.dtype for v in state_dict.values() if v.is_floating_point())
+    os.makedirs(output_dir, exist_ok=True)
+    files = []
+    for rank in range(world_size):
+        # shard_state_dict_tp modifies the state_dict in place
+        shard = (
+            shard_state_dict_tp(dict(state_dict), config, world_size, rank)
+            if world_size > 1
+            else state_dict
+        )
+        files.append(tp_checkpoint_filename(rank, world_size))
+        _save_state_dict(shard, os.path.join(output_dir, files[-1]))
+    manifest = {
+        "format_version": TP_CHECKPOINT_FORMAT_VERSION,
+        "model_name": model_name,
+        "model_type": hf_config.model_type,
+        "world_size": world_size,
+        "dtype": str(dtype).split(".")[-1],
+        "files": files,
+        "config": config.to_dict(),
+        "hf_config": hf_config.to_dict(),
+    }
+    with open(os.path.join(output_dir, TP_MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def convert_from_tp_checkpoint(path, output_dir):
+    """Combine the shards of the checkpoint written by convert_to_tp_checkpoint in path, and write
+    it back in the Hugging Face format (model.safetensors and config.json) to output_dir.
+    """
+    manifest = load_tp_manifest(path)
+    _, _, inv_remap_state_dict = MODEL_TYPES[manifest["model_type"]]
+    if inv_remap_state_dict is None:
+        raise NotImplementedError(f"Model type {manifest['model_type']} can't be converted back")
+    config = GPT2Config.from_dict(manifest["config"])
+    world_size = manifest["world_size"]
+    state_dicts = [
+        state_dict_from_tp_checkpoint(path, world_size, rank) for rank in range(world_size)
+    ]
+    state_dict = combine_state_dicts_tp(state_dicts, config) if world_size > 1 else state_dicts[0]
+    state_dict = inv_remap_state_dict(state_dict, config)
+    os.makedirs(output_dir, exist_ok=True)
+    _save_state_dict(state_dict, os.path.join(output_dir, SAFE_WEIGHTS_NAME))
+    with open(os.path.join(output_dir, "config.json"), "w") as f:
+        json.dump(manifest["hf_config"], f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a Hugging Face checkpoint to a flash_attn checkpoint pre-sharded for "
+        "tensor parallel, or back with --reverse."
+    )
+    parser.add_argument("model_name", help="Hugging Face model name or path")
+    parser.add_argument("output_dir")
+    parser.add_argument("--world-size", type=int, default=1)
+    parser.add_argument("--dtype", choices=["float32", "float16", "bfloat16"], default=None)
+    parser.add_argument("--num-workers", type=int, default=1)
+    parser.add_argument(
+        "--reverse",
+        action="store_true",
+        help="Convert the flash_attn checkpoint in model_name back to the Hugging Face format",
+    )
+    args = parser.parse_args()
+    if args.reverse:
+        convert_from_tp_checkpoint(args.model_name, args.output_dir)
+    else:
+        convert_to_tp_checkpoint(
+            args.model_name,
+            args.output_dir,
+            world_size=args.world_size,
+            dtype=getattr(torch, args.dtype) if args.dtype is not None else None,
+            num_workers=args.num_workers,
+            progress=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
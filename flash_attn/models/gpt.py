@@ -14,6 +14,7 @@ import torch.nn.functional as F
 from einops import rearrange
 from transformers import GPT2Config
 
+from flash_attn.losses.linear_cross_entropy import LinearCrossEntropyLoss
 from flash_attn.models.bigcode import remap_state_dict_hf_bigcode
 from flash_attn.models.falcon import remap_state_dict_hf_falcon
 from flash_attn.models.gpt_neox import remap_state_dict_hf_gpt_neox
@@ -39,7 +40,12 @@ from flash_attn.utils.distributed import (
     sync_shared_params,
 )
 from flash_attn.utils.generation import GenerationMixin
-from flash_attn.utils.pretrained import state_dict_from_pretrained
+from flash_attn.utils.pretrained import (
+    is_tp_checkpoint,
+    load_state_dict_streaming,
+    load_tp_checkpoint,
+    state_dict_from_pretrained,
+)
 
 try:
     from flash_attn.ops.fused_dense import ColumnParallelLinear
@@ -80,6 +86,7 @@ def create_mixer_cls(config, layer_idx=None, process_group=None, device=None, dt
     use_alibi = getattr(config, "use_alibi", False)
     window_size = getattr(config, "window_size", (-1, -1))
     use_flash_attn = getattr(config, "use_flash_attn", False)
+    attn_chunk_size = getattr(config, "attn_chunk_size", None)
     fused_bias_fc = getattr(config, "fused_bias_fc", False)
     if not fused_bias_fc:
         assert process_group is None, "TensorParallel MHA requires fused_bias_fc"
@@ -113,6 +120,7 @@ def create_mixer_cls(config, layer_idx=None, process_group=None, device=None, dt
         use_alibi=use_alibi,
         window_size=window_size,
         use_flash_attn=use_flash_attn,
+        attn_chunk_size=attn_chunk_size,
         **serial_kwargs,
         **parallel_kwargs,
         **factory_kwargs,
@@ -336,39 +344,73 @@ class GPTPreTrainedModel(nn.Module):
         dtype=None,
         world_size=1,
         rank=0,
+        streaming=False,
+        num_workers=1,
+        progress=False,
         **kwargs,
     ):
         """
         Instantiate a GPTPreTrainedModel from a pre-trained model file or a pytorch state dict.
         Download and cache the pre-trained model file if needed.
+        If model_name is a directory written by flash_attn/models/convert_checkpoint.py, only the
+        file of this rank is read.
+        If streaming=True, the checkpoint is memory-mapped and loaded one layer at a time
+        (see load_state_dict_streaming), instead of loading the whole state_dict in memory.
+        num_workers: number of threads loading the checkpoint shards (or the layers, if
+            streaming=True) in parallel. The result doesn't depend on num_workers.
+        progress: whether to print the progress and timing of the loading.
         """
         # Instantiate model.
         model = cls(config, *args, device=device, dtype=dtype, **kwargs)
-        # Load state_dict in cpu because we already initialized the model in GPU, and we don't
-        # want extra stuff taking up more GPU memory
-        state_dict = state_dict_from_pretrained(model_name, device="cpu", dtype=dtype)
+        if is_tp_checkpoint(model_name):
+            # Already remapped and sharded, we only need to read the file of this rank
+            load_tp_checkpoint(model, model_name, world_size=world_size, rank=rank, strict=strict)
+            return model
         if model_name.startswith("gpt2"):
-            state_dict = remap_state_dict_hf_gpt2(state_dict, config)
+            remap_state_dict = remap_state_dict_hf_gpt2
         elif model_name.startswith("facebook/opt"):
-            state_dict = remap_state_dict_hf_opt(state_dict, config)
+            remap_state_dict = remap_state_dict_hf_opt
         elif model_name.startswith("EleutherAI/gpt-j-") or model_name.startswith(
             "togethercomputer/GPT-JT-"
         ):
-            state_dict = remap_state_dict_hf_gptj(state_dict, config)
+            remap_state_dict = remap_state_dict_hf_gptj
         elif (
             model_name.startswith("EleutherAI/gpt-neox-")
             or model_name.startswith("EleutherAI/pythia-")
             or model_name.startswith("togethercomputer/RedPajama-INCITE-")
         ):
-            state_dict = remap_state_dict_hf_gpt_neox(state_dict, config)
+            remap_state_dict = remap_state_dict_hf_gpt_neox
         elif model_name.startswith("tiiuae/falcon-"):
-            state_dict = remap_state_dict_hf_falcon(state_dict, config)
+            remap_state_dict = remap_state_dict_hf_falcon
         elif model_name.startswith("meta-llama/Llama-"):
-            state_dict = remap_state_dict_hf_llama(state_dict, config)
+            remap_state_dict = remap_state_dict_hf_llama
         elif model_name.startswith("bigcode/") or model_name.startswith("WizardLM/"):
-            state_dict = remap_state_dict_hf_bigcode(state_dict, config)
+            remap_state_dict = remap_state_dict_hf_bigcode
         else:
             raise NotImplementedError(f"Model {model_name} not supported")
+        if streaming:
+            shard_fn = (
+                partial(shard_state_dict_tp, config=config, world_size=world_size, rank=rank)
+                if world_size > 1
+                else None
+            )
+            load_state_dict_streaming(
+                model,
+                model_name,
+                remap_fn=partial(remap_state_dict, config=config),
+                shard_fn=shard_fn,
+                dtype=dtype,
+                strict=strict,
+                num_workers=num_workers,
+                progress=progress,
+            )
+            return model
+        # Load state_dict in cpu because we already initialized the model in GPU, and we don't
+        # want extra stuff taking up more GPU memory
+        state_dict = state_dict_from_pretrained(
+            model_name, device="cpu", dtype=dtype, num_workers=num_workers, progress=progress
+        )
+        state_dict = remap_state_dict(state_dict, config)
         if world_size > 1:
             state_dict = shard_state_dict_tp(state_dict, config, world_size, rank)
         load_return = model.load_state_dict(state_dict, strict=strict)
@@ -511,10 +553,26 @@ class GPTModel(GPTPreTrainedModel):
             for i, layer in enumerate(self.layers)
         }
 
-    def forward(self, input_ids, position_ids=None, inference_params=None):
+    def forward(
+        self, input_ids, position_ids=None, inference_params=None, cu_seqlens=None, max_seqlen=None
+    ):
         # If using Tensor Parallel with sequence parallel, we combine the batch and the seqlen
         # dimensions so that we can split on it easily, in case of small batch size.
         # Only the attention layers need to know the seqlen.
+        # If cu_seqlens is not None, the sequences of input_ids are made of documents packed
+        # together: cu_seqlens (n_docs + 1,) int32 are the offsets of the documents in the
+        # flattened (batch * seqlen) tokens, and max_seqlen is their max length. Each document
+        # only attends to itself (varlen attention path), and its positions start from 0, for both
+        # the position embeddings and the rotary embeddings.
+        if cu_seqlens is not None:
+            assert max_seqlen is not None
+            assert inference_params is None, "cu_seqlens is not supported in generation mode"
+            assert self.process_group is None, "cu_seqlens is not supported with Tensor Parallel"
+            if position_ids is None:
+                cu_seqlens_long = cu_seqlens.long()
+                doc_starts = torch.repeat_interleave(cu_seqlens_long[:-1], cu_seqlens_long.diff())
+                position_ids = torch.arange(input_ids.numel(), device=input_ids.device)
+                position_ids = (position_ids - doc_starts).reshape(input_ids.shape)
         embedding_kwargs = (
             {"combine_batch_seqlen_dim": True}
             if self.process_group is not None and self.sequence_parallel
@@ -533,6 +591,9 @@ class GPTModel(GPTPreTrainedModel):
         )
         if inference_params is not None:
             mixer_kwargs["inference_params"] = inference_params
+        if cu_seqlens is not None:
+            hidden_states = rearrange(hidden_states, "b s d -> (b s) d")
+            mixer_kwargs.update(cu_seqlens=cu_seqlens, max_seqlen=max_seqlen)
         for layer in self.layers:
             if self.prenorm:
                 if not self.parallel_block:
@@ -571,6 +632,8 @@ class GPTModel(GPTPreTrainedModel):
                     prenorm=False,
                     is_rms_norm=isinstance(self.ln_f, RMSNorm)
                 )
+        if cu_seqlens is not None:
+            hidden_states = rearrange(hidden_states, "(b s) d -> b s d", b=input_ids.shape[0])
         return hidden_states
 
 
@@ -632,19 +695,39 @@ class GPTLMHeadModel(GPTPreTrainedModel, GenerationMixin):
             batch_size, max_seqlen, dtype=dtype, **kwargs
         )
 
-    def forward(self, input_ids, position_ids=None, inference_params=None, num_last_tokens=0):
+    def forward(
+        self,
+        input_ids,
+        position_ids=None,
+        inference_params=None,
+        num_last_tokens=0,
+        labels=None,
+        loss_fn=None,
+        cu_seqlens=None,
+        max_seqlen=None,
+    ):
         """
         input_ids: (batch, seqlen) int tensor
         inference_params: for generation. Adapted from Megatron-LM (and Apex)
         https://github.com/NVIDIA/apex/blob/3ff1a10f72ec07067c4e44759442329804ac5162/apex/transformer/testing/standalone_transformer_lm.py#L470
         num_last_tokens: if > 0, only return the logits for the last n tokens
+        labels: if not None, (batch, seqlen) int tensor, labels[:, t] is the target of position t
+            (i.e. shift them before calling, there's no shift here). Return the loss instead of
+            the logits, computed by loss_fn (LinearCrossEntropyLoss() by default) from the hidden
+            states and the LM head weight, so that the full logits are never materialized.
+        cu_seqlens, max_seqlen: for documents packed into the sequences of input_ids, see
+            GPTModel.forward.
         """
         assert (
             input_ids.ndim == 2
         ), f"Expected `input_ids` to have shape [b, slen], but got shape {input_ids.shape}"
         b, slen = input_ids.shape
         hidden_states = self.transformer(
-            input_ids, position_ids=position_ids, inference_params=inference_params
+            input_ids,
+            position_ids=position_ids,
+            inference_params=inference_params,
+            cu_seqlens=cu_seqlens,
+            max_seqlen=max_seqlen,
         )
         if inference_params is not None:
             assert hidden_states.ndim == 3, "sequence_parallel is not supported in generation mode"
@@ -654,6 +737,19 @@ class GPTLMHeadModel(GPTPreTrainedModel, GenerationMixin):
             hidden_states = self.project_out(hidden_states)
         if self.output_scale != 1.0:
             hidden_states = hidden_states * self.output_scale
+        if labels is not None:
+            assert num_last_tokens == 0, "num_last_tokens is not supported with labels"
+            assert not isinstance(
+                self.lm_head, ColumnParallelLinear
+            ), "Loss from hidden states is not supported with Tensor Parallel"
+            if loss_fn is None:
+                loss_fn = LinearCrossEntropyLoss()
+            lm_head_weight = self.lm_head.weight
+            if self.norm_head:
+                lm_head_weight = F.normalize(lm_head_weight)
+            loss = loss_fn(hidden_states, lm_head_weight, labels, bias=self.lm_head.bias)
+            CausalLMLoss = namedtuple("CausalLMLoss", ["loss"])
+            return CausalLMLoss(loss=loss)
         if not self.norm_head:
             lm_logits = self.lm_head(hidden_states)
         else:
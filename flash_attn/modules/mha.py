@@ -8,6 +8,7 @@ import torch.nn as nn
 from einops import rearrange, repeat
 
 from flash_attn.utils.distributed import get_dim_for_local_rank
+from flash_attn.utils.quantized_kv_cache import QuantizedKVCache
 
 try:
     from flash_attn import (
@@ -227,6 +228,148 @@ class FlashCrossAttention(nn.Module):
             )
 
 
+def _local_attention_mask(row_idx, col_idx, seqlen_q, seqlen_k, window_size):
+    """Return True for the key positions outside of the (sliding) window of each query.
+    The window is aligned to the bottom right corner of the attention matrix, as in FlashAttention:
+    query i attends to keys in [i + seqlen_k - seqlen_q - window_size[0],
+    i + seqlen_k - seqlen_q + window_size[1]]. seqlen_k can be a tensor of shape (B, 1, 1, 1).
+    """
+    diag = row_idx + seqlen_k - seqlen_q
+    mask = torch.zeros_like(col_idx > diag)
+    if window_size[1] >= 0:
+        mask = mask | (col_idx > diag + window_size[1])
+    if window_size[0] >= 0:
+        mask = mask | (col_idx < diag - window_size[0])
+    return mask
+
+
+def _alibi_bias(alibi_slopes, row_idx, col_idx, seqlen_q, seqlen_k):
+    """alibi_slopes: (H,) or (B, H). Return -alibi_slope * |i + seqlen_k - seqlen_q - j|,
+    of shape (B or 1, H, Sq, Sk)."""
+    slopes = alibi_slopes.to(torch.float32)
+    slopes = rearrange(slopes, "h -> 1 h 1 1" if slopes.dim() == 1 else "b h -> b h 1 1")
+    return -slopes * (row_idx + seqlen_k - seqlen_q - col_idx).abs()
+
+
+def _chunked_attention(
+    q,
+    k,
+    v,
+    softmax_scale,
+    chunk_size,
+    causal=False,
+    key_padding_mask=None,
+    seqlens_k=None,
+    window_size=(-1, -1),
+    alibi_slopes=None,
+    attn_mask=None,
+    dropout=None,
+    causal_additive=False,
+):
+    """Attention computed one (chunk_size x chunk_size) block of the score matrix at a time, with
+    a running max and sum of the softmax (the FlashAttention algorithm, in PyTorch). Only a block of
+    scores is ever materialized instead of the full (B, H, Sq, Sk) matrix.
+    q: (B, Sq, H, D), k, v: (B, Sk, H_k, D). MQA/GQA is handled without repeating k and v.
+    seqlens_k: None or (B,). Number of keys of each sequence that the causal mask / local window /
+        ALiBi are aligned to (default Sk).
+    attn_mask: None or (B, Sq, Sk) boolean, True means to keep, False means to mask out.
+    causal_additive: the masks are applied as in the dense attention, so that rows where all the
+        keys are masked out get the same output: -10000.0 is added for the key padding mask, and
+        for the causal mask if causal_additive (SelfAttention) else the scores are set to -10000.0
+        (CrossAttention), as for the local window and attn_mask.
+    Return: (B, Sq, H, D)
+    """
+    batch_size, seqlen_q, nheads, headdim = q.shape
+    seqlen_k, nheads_k = k.shape[1], k.shape[2]
+    q = rearrange(q, "b t (h g) d -> b t h g d", g=nheads // nheads_k)
+    sk = seqlen_k if seqlens_k is None else rearrange(seqlens_k, "b -> b 1 1 1 1")
+    # The keys outside of the causal mask / local window, whose blocks can be skipped
+    skip_window_size = (window_size[0], 0) if causal else window_size
+    if alibi_slopes is not None:
+        alibi_slopes = alibi_slopes.to(torch.float32)
+        if alibi_slopes.dim() == 1:
+            alibi_slopes = rearrange(alibi_slopes, "h -> 1 h")
+        alibi_slopes = rearrange(alibi_slopes, "b (h g) -> b h g 1 1", g=nheads // nheads_k)
+    output = torch.empty_like(q)
+    for q_start in range(0, seqlen_q, chunk_size):
+        q_end = min(q_start + chunk_size, seqlen_q)
+        q_chunk = q[:, q_start:q_end] * softmax_scale
+        row_idx = rearrange(torch.arange(q_start, q_end, device=q.device), "s -> s 1")
+        # The rows where all the keys are masked out attend to all of them (uniformly if they're
+        # all set to -10000.0) as in the dense attention, including the keys of the skipped blocks.
+        # If there are any, the chunk is computed again without skipping blocks.
+        for skip_blocks in [True, False]:
+            row_max = torch.full(
+                (batch_size, nheads_k, q.shape[3], q_end - q_start),
+                float("-inf"),
+                dtype=torch.float32,
+                device=q.device,
+            )
+            row_sum = torch.zeros_like(row_max)
+            acc = torch.zeros(*row_max.shape, headdim, dtype=torch.float32, device=q.device)
+            visible = torch.zeros_like(row_max, dtype=torch.bool)
+            skipped = False
+            for k_start in range(0, seqlen_k, chunk_size):
+                k_end = min(k_start + chunk_size, seqlen_k)
+                # Skip the blocks that are entirely masked out by the causal mask / local window
+                if skip_blocks and (
+                    skip_window_size[1] >= 0
+                    and k_start > q_end - 1 + seqlen_k - seqlen_q + skip_window_size[1]
+                ):
+                    skipped = True
+                    break
+                if skip_blocks and (
+                    seqlens_k is None
+                    and skip_window_size[0] >= 0
+                    and k_end - 1 < q_start + seqlen_k - seqlen_q - skip_window_size[0]
+                ):
+                    skipped = True
+                    continue
+                col_idx = torch.arange(k_start, k_end, device=q.device)
+                scores = torch.einsum("bthgd,bshd->bhgts", q_chunk, k[:, k_start:k_end]).float()
+                mask = None
+                if key_padding_mask is not None:
+                    mask = rearrange(~key_padding_mask[:, k_start:k_end], "b s -> b 1 1 1 s")
+                    scores = scores - 10000.0 * mask
+                if causal:
+                    causal_mask = _local_attention_mask(row_idx, col_idx, seqlen_q, sk, (-1, 0))
+                    if causal_additive:
+                        scores = scores - 10000.0 * causal_mask
+                    else:
+                        scores = scores.masked_fill(causal_mask, -10000.0)
+                    mask = causal_mask if mask is None else mask | causal_mask
+                if window_size != (-1, -1):
+                    local_mask = _local_attention_mask(row_idx, col_idx, seqlen_q, sk, window_size)
+                    scores = scores.masked_fill(local_mask, -10000.0)
+                    mask = local_mask if mask is None else mask | local_mask
+                if alibi_slopes is not None:
+                    scores = scores - alibi_slopes * (row_idx + sk - seqlen_q - col_idx).abs()
+                if attn_mask is not None:
+                    block_mask = ~attn_mask[:, q_start:q_end, k_start:k_end]
+                    block_mask = rearrange(block_mask, "b t s -> b 1 1 t s")
+                    scores = scores.masked_fill(block_mask, -10000.0)
+                    mask = block_mask if mask is None else mask | block_mask
+                visible = visible | (True if mask is None else (~mask).any(dim=-1))
+                new_max = torch.maximum(row_max, scores.amax(dim=-1))
+                probs = torch.exp(scores - new_max.unsqueeze(-1))
+                correction = torch.exp(row_max - new_max)
+                row_sum = row_sum * correction + probs.sum(dim=-1)
+                if dropout is not None:
+                    probs = dropout(probs)
+                acc = (
+                    acc * correction.unsqueeze(-1)
+                    + torch.einsum(
+                        "bhgts,bshd->bhgtd", probs.to(v.dtype), v[:, k_start:k_end]
+                    ).float()
+                )
+                row_max = new_max
+            if not skipped or visible.all():
+                break
+        acc = acc / row_sum.unsqueeze(-1)
+        output[:, q_start:q_end] = rearrange(acc, "b h g t d -> b t h g d").to(q.dtype)
+    return rearrange(output, "b t h g d -> b t (h g) d")
+
+
 class SelfAttention(nn.Module):
     """Implement the scaled dot product attention with softmax.
     Arguments
@@ -236,27 +379,79 @@ class SelfAttention(nn.Module):
                       runtime)
         attention_dropout: The dropout rate to apply to the attention
                            (default: 0.0)
+        window_size: (left, right). If not (-1, -1), implements sliding window local attention.
+        alibi_slopes: (H,) or (B, H). If not None, add ALiBi biases to the attention scores.
+        chunk_size: if not None, process the query and key / value in chunks of this size with
+                    an online softmax, so that memory is linear instead of quadratic in the
+                    sequence length.
     """
 
-    def __init__(self, causal=False, softmax_scale=None, attention_dropout=0.0):
+    def __init__(
+        self,
+        causal=False,
+        softmax_scale=None,
+        attention_dropout=0.0,
+        window_size=(-1, -1),
+        alibi_slopes=None,
+        chunk_size=None,
+    ):
         super().__init__()
         self.causal = causal
         self.softmax_scale = softmax_scale
         self.drop = nn.Dropout(attention_dropout)
+        self.window_size = window_size
+        self.register_buffer("alibi_slopes", alibi_slopes, persistent=False)
+        self.chunk_size = chunk_size
 
-    def forward(self, qkv, causal=None, key_padding_mask=None):
+    def forward(self, qkv, causal=None, key_padding_mask=None, cu_seqlens=None, max_seqlen=None):
         """Implements the multihead softmax attention.
         Arguments
         ---------
-            qkv: The tensor containing the query, key, and value. (B, S, 3, H, D)
+            qkv: The tensor containing the query, key, and value.
+                If cu_seqlens is None, then qkv has shape (B, S, 3, H, D).
+                If cu_seqlens is not None, then qkv has shape (total, 3, H, D), where total is the
+                sum of the sequence lengths in the batch.
             causal: if passed, will override self.causal
             key_padding_mask: boolean mask to apply to the attention weights. True means to keep,
                 False means to mask out. (B, S)
+            cu_seqlens: (batch_size + 1,), dtype torch.int32. The cumulative sequence lengths
+                of the sequences in the batch, used to index into qkv. Each sequence only attends
+                to itself (block-diagonal attention), without padding the batch.
+            max_seqlen: int. Maximum sequence length in the batch. For compatibility with
+                FlashSelfAttention, not used.
+        Returns:
+        --------
+            out: (total, H, D) if cu_seqlens is not None, else (B, S, H, D).
         """
-        batch_size, seqlen = qkv.shape[0], qkv.shape[1]
         causal = self.causal if causal is None else causal
+        if cu_seqlens is not None:
+            assert key_padding_mask is None
+            assert self.alibi_slopes is None or self.alibi_slopes.dim() == 1
+            cu_seqlens = cu_seqlens.tolist()
+            return torch.cat(
+                [
+                    self(qkv[start:end].unsqueeze(0), causal=causal).squeeze(0)
+                    for start, end in zip(cu_seqlens[:-1], cu_seqlens[1:])
+                ],
+                dim=0,
+            )
+        batch_size, seqlen = qkv.shape[0], qkv.shape[1]
         q, k, v = qkv.unbind(dim=2)
         softmax_scale = self.softmax_scale or 1.0 / math.sqrt(q.shape[-1])
+        if self.chunk_size is not None:
+            return _chunked_attention(
+                q,
+                k,
+                v,
+                softmax_scale,
+                self.chunk_size,
+                causal=causal,
+                key_padding_mask=key_padding_mask,
+                window_size=self.window_size,
+                alibi_slopes=self.alibi_slopes,
+                dropout=self.drop if self.training else None,
+                causal_additive=True,
+            )
         scores = torch.einsum("bthd,bshd->bhts", q, k * softmax_scale)
         if key_padding_mask is not None:
             padding_mask = torch.full(
@@ -273,6 +468,17 @@ class SelfAttention(nn.Module):
             )
             # TD [2022-09-30]: Adding is faster than masked_fill_ (idk why, just better kernel I guess)
             scores = scores + causal_mask.to(dtype=scores.dtype)
+        if self.window_size != (-1, -1) or self.alibi_slopes is not None:
+            row_idx = rearrange(torch.arange(seqlen, device=q.device), "s -> s 1")
+            col_idx = torch.arange(seqlen, device=q.device)
+            if self.window_size != (-1, -1):
+                local_mask = _local_attention_mask(
+                    row_idx, col_idx, seqlen, seqlen, self.window_size
+                )
+                scores = scores.masked_fill(local_mask, -10000.0)
+            if self.alibi_slopes is not None:
+                bias = _alibi_bias(self.alibi_slopes, row_idx, col_idx, seqlen, seqlen)
+                scores = scores + bias.to(dtype=scores.dtype)
         attention = torch.softmax(scores, dim=-1, dtype=v.dtype)
         attention_drop = self.drop(attention)
         output = torch.einsum("bhts,bshd->bthd", attention_drop, v)
@@ -288,32 +494,103 @@ class CrossAttention(nn.Module):
                       runtime)
         attention_dropout: The dropout rate to apply to the attention
                            (default: 0.0)
+        window_size: (left, right). If not (-1, -1), implements sliding window local attention.
+        alibi_slopes: (H,) or (B, H). If not None, add ALiBi biases to the attention scores.
+        chunk_size: if not None, process the query and key / value in chunks of this size with
+                    an online softmax, so that memory is linear instead of quadratic in the
+                    sequence length.
     """
 
-    def __init__(self, causal=False, softmax_scale=None, attention_dropout=0.0):
+    def __init__(
+        self,
+        causal=False,
+        softmax_scale=None,
+        attention_dropout=0.0,
+        window_size=(-1, -1),
+        alibi_slopes=None,
+        chunk_size=None,
+    ):
         super().__init__()
         self.causal = causal
         self.softmax_scale = softmax_scale
         self.drop = nn.Dropout(attention_dropout)
+        self.window_size = window_size
+        self.register_buffer("alibi_slopes", alibi_slopes, persistent=False)
+        self.chunk_size = chunk_size
 
-    def forward(self, q, kv, causal=None, key_padding_mask=None):
+    def forward(
+        self,
+        q,
+        kv,
+        causal=None,
+        key_padding_mask=None,
+        cu_seqlens=None,
+        max_seqlen=None,
+        cu_seqlens_k=None,
+        max_seqlen_k=None,
+        attn_mask=None,
+    ):
         """Implements the multihead softmax attention.
         Arguments
         ---------
-            q: The tensor containing the query. (B, Sq, H, D)
-            kv: The tensor containing the key and value. (B, Sk, 2, H_k, D)
+            q: The tensor containing the query. (B, Sq, H, D), or (total_q, H, D) if cu_seqlens
+                is not None.
+            kv: The tensor containing the key and value. (B, Sk, 2, H_k, D), or
+                (total_k, 2, H_k, D) if cu_seqlens is not None.
             causal: if passed, will override self.causal
             key_padding_mask: boolean mask to apply to the attention weights. True means to keep,
                 False means to mask out. (B, Sk)
+            cu_seqlens: (batch_size + 1,), dtype torch.int32. The cumulative sequence lengths
+                of the sequences in the batch, used to index into q. Each sequence of q only
+                attends to the corresponding sequence of kv, without padding the batch.
+            max_seqlen: int. Maximum sequence length in the batch of q. Not used.
+            cu_seqlens_k: (batch_size + 1,), dtype torch.int32. The cumulative sequence lengths
+                of the sequences in the batch, used to index into kv. If None, use cu_seqlens.
+            max_seqlen_k: int. Maximum sequence length in the batch of k and v. Not used.
+            attn_mask: boolean mask over the whole attention matrix, applied on top of
+                key_padding_mask and the causal mask. True means to keep, False means to mask
+                out. (B, Sq, Sk)
         """
-        batch_size, seqlen_q = q.shape[0], q.shape[1]
         causal = self.causal if causal is None else causal
+        if cu_seqlens is not None:
+            assert key_padding_mask is None and attn_mask is None
+            assert self.alibi_slopes is None or self.alibi_slopes.dim() == 1
+            cu_seqlens_k = cu_seqlens if cu_seqlens_k is None else cu_seqlens_k
+            cu_seqlens, cu_seqlens_k = cu_seqlens.tolist(), cu_seqlens_k.tolist()
+            return torch.cat(
+                [
+                    self(
+                        q[start:end].unsqueeze(0), kv[start_k:end_k].unsqueeze(0), causal=causal
+                    ).squeeze(0)
+                    for start, end, start_k, end_k in zip(
+                        cu_seqlens[:-1], cu_seqlens[1:], cu_seqlens_k[:-1], cu_seqlens_k[1:]
+                    )
+                ],
+                dim=0,
+            )
+        batch_size, seqlen_q = q.shape[0], q.shape[1]
         seqlen_k = kv.shape[1]
         assert kv.shape[0] == batch_size and kv.shape[4] == q.shape[3]
+        softmax_scale = self.softmax_scale or 1.0 / math.sqrt(q.shape[-1])
+        if self.chunk_size is not None:
+            k, v = kv.unbind(dim=2)
+            return _chunked_attention(
+                q,
+                k,
+                v,
+                softmax_scale,
+                self.chunk_size,
+                causal=causal,
+                key_padding_mask=key_padding_mask,
+                seqlens_k=key_padding_mask.sum(-1) if key_padding_mask is not None else None,
+                window_size=self.window_size,
+                alibi_slopes=self.alibi_slopes,
+                attn_mask=attn_mask,
+                dropout=self.drop if self.training else None,
+            )
         if kv.shape[3] != q.shape[2]:  # MQA/GQA
             kv = repeat(kv, "... hkv d -> ... (hkv g) d", g=q.shape[2] // kv.shape[3])
         k, v = kv.unbind(dim=2)
-        softmax_scale = self.softmax_scale or 1.0 / math.sqrt(q.shape[-1])
         scores = torch.einsum("bthd,bshd->bhts", q, k * softmax_scale)
         if key_padding_mask is not None:
             padding_mask = torch.full(
@@ -322,19 +599,25 @@ class CrossAttention(nn.Module):
             padding_mask.masked_fill_(key_padding_mask, 0.0)
             # TD [2022-09-30]: Adding is faster than masked_fill_ (idk why, just better kernel I guess)
             scores = scores + rearrange(padding_mask, "b s -> b 1 1 s")
+        row_idx = rearrange(torch.arange(seqlen_q, device=q.device, dtype=torch.long), "s -> s 1")
+        col_idx = torch.arange(seqlen_k, device=kv.device, dtype=torch.long)
+        sk = (
+            seqlen_k
+            if key_padding_mask is None
+            else rearrange(key_padding_mask.sum(-1), "b -> b 1 1 1")
+        )
         if causal:
             # causal mask needs to take into account the difference between seqlen_q and seqlen_k
-            row_idx = rearrange(
-                torch.arange(seqlen_q, device=q.device, dtype=torch.long), "s -> s 1"
-            )
-            col_idx = torch.arange(seqlen_k, device=kv.device, dtype=torch.long)
-            sk = (
-                seqlen_k
-                if key_padding_mask is None
-                else rearrange(key_padding_mask.sum(-1), "b -> b 1 1 1")
-            )
             causal_mask = col_idx > row_idx + sk - seqlen_q
             scores = scores.masked_fill(causal_mask, -10000.0)
+        if self.window_size != (-1, -1):
+            local_mask = _local_attention_mask(row_idx, col_idx, seqlen_q, sk, self.window_size)
+            scores = scores.masked_fill(local_mask, -10000.0)
+        if self.alibi_slopes is not None:
+            bias = _alibi_bias(self.alibi_slopes, row_idx, col_idx, seqlen_q, sk)
+            scores = scores + bias.to(dtype=scores.dtype)
+        if attn_mask is not None:
+            scores = scores.masked_fill(rearrange(~attn_mask, "b t s -> b 1 t s"), -10000.0)
         attention = torch.softmax(scores, dim=-1, dtype=v.dtype)
         attention_drop = self.drop(attention)
         output = torch.einsum("bhts,bshd->bthd", attention_drop, v)
@@ -348,23 +631,56 @@ class LinearResidual(nn.Linear):
         return super().forward(input), input
 
 
-def _update_kv_cache(kv, inference_params, layer_idx):
-    """kv: (batch_size, seqlen, 2, nheads, head_dim) or (batch_size, 1, 2, nheads, head_dim)"""
+def _allocate_kv_cache(shape, dtype, device, quant_dtype=None, group_size=None):
+    """Allocate a KV cache of shape, quantized to quant_dtype (see QuantizedKVCache) if not None."""
+    if quant_dtype is None:
+        return torch.empty(*shape, dtype=dtype, device=device)
+    return QuantizedKVCache(
+        shape, dtype=dtype, device=device, quant_dtype=quant_dtype, group_size=group_size
+    )
+
+
+def _is_quantized_kv_cache(inference_params, layer_idx):
+    return inference_params.kv_cache_quant_dtype is not None or isinstance(
+        inference_params.key_value_memory_dict.get(layer_idx), QuantizedKVCache
+    )
+
+
+def _uses_ring_kv_cache(inference_params, window_size):
+    return inference_params.sliding_window_kv_cache and window_size[0] >= 0
+
+
+def _supports_flash_attn_with_kvcache(inference_params, layer_idx, window_size):
+    """flash_attn_with_kvcache can't handle tree masks, a quantized KV cache, or a ring buffer KV
+    cache, these use the inner attention (e.g. the PyTorch attention) instead."""
+    return not (
+        inference_params.tree_mask is not None
+        or _is_quantized_kv_cache(inference_params, layer_idx)
+        or _uses_ring_kv_cache(inference_params, window_size)
+    )
+
+
+def _get_kv_cache(kv, inference_params, layer_idx):
+    """Return the KV cache of layer_idx, allocating it on first use."""
     # Pre-allocate memory for key-values for inference.
     num_heads, head_dim = kv.shape[-2:]
     if layer_idx not in inference_params.key_value_memory_dict:
-        kv_cache = torch.empty(
-            inference_params.max_batch_size,
-            inference_params.max_seqlen,
-            2,
-            num_heads,
-            head_dim,
-            dtype=kv.dtype,
-            device=kv.device,
+        kv_cache = _allocate_kv_cache(
+            (inference_params.max_batch_size, inference_params.max_seqlen, 2, num_heads, head_dim),
+            kv.dtype,
+            kv.device,
+            quant_dtype=inference_params.kv_cache_quant_dtype,
+            group_size=inference_params.kv_cache_quant_group_size,
         )
         inference_params.key_value_memory_dict[layer_idx] = kv_cache
     else:
         kv_cache = inference_params.key_value_memory_dict[layer_idx]
+    return kv_cache
+
+
+def _update_kv_cache(kv, inference_params, layer_idx):
+    """kv: (batch_size, seqlen, 2, nheads, head_dim) or (batch_size, 1, 2, nheads, head_dim)"""
+    kv_cache = _get_kv_cache(kv, inference_params, layer_idx)
     # Adjust key and value for inference
     batch_start = inference_params.batch_size_offset
     batch_end = batch_start + kv.shape[0]
@@ -377,6 +693,186 @@ def _update_kv_cache(kv, inference_params, layer_idx):
     return kv_cache[batch_start:batch_end, :sequence_end, ...]
 
 
+def _get_cache_batch_idx(inference_params, batch_size, device):
+    """Return the rows of the KV cache used by the sequences in the batch, (batch_size,) int64."""
+    if inference_params.cache_batch_idx is not None:
+        return inference_params.cache_batch_idx[:batch_size].long()
+    return torch.arange(batch_size, device=device) + inference_params.batch_size_offset
+
+
+def _get_cache_seqlens(inference_params, batch_size, device):
+    """Return the number of tokens already cached for each sequence, (batch_size,) int64."""
+    if inference_params.lengths_per_sample is not None:
+        return inference_params.lengths_per_sample[:batch_size].long()
+    return torch.full(
+        (batch_size,), inference_params.seqlen_offset, dtype=torch.long, device=device
+    )
+
+
+def _update_ring_kv_cache(kv, inference_params, layer_idx, window_size):
+    """Same as _update_kv_cache for sliding window local attention: the KV cache only keeps the
+    last window_size[0] tokens of each sequence, in a ring buffer of shape
+    (max_batch_size, window_size[0], 2, nheads, head_dim) where token t is at position
+    t % window_size[0], so that its memory doesn't grow with the sequence length.
+    kv: (batch_size, seqlen, 2, nheads, head_dim), the tokens at positions seqlen_offset, ...
+    Return: (batch_size, min(seqlen_offset, window_size[0]) + seqlen, 2, nheads, head_dim), the
+        cached tokens in the window of the first new token followed by the new tokens, in order.
+        With the local attention mask aligned to the bottom right corner, each new token attends
+        to exactly the same keys as with the full KV cache.
+    """
+    assert inference_params.lengths_per_sample is None, "Ring buffer KV cache needs seqlen_offset"
+    assert inference_params.cache_batch_idx is None and inference_params.block_table is None
+    batch_size, seqlen, _, num_heads, head_dim = kv.shape
+    window = max(window_size[0], 1)
+    if layer_idx not in inference_params.key_value_memory_dict:
+        inference_params.key_value_memory_dict[layer_idx] = _allocate_kv_cache(
+            (inference_params.max_batch_size, window, 2, num_heads, head_dim),
+            kv.dtype,
+            kv.device,
+            quant_dtype=inference_params.kv_cache_quant_dtype,
+            group_size=inference_params.kv_cache_quant_group_size,
+        )
+    kv_cache = inference_params.key_value_memory_dict[layer_idx]
+    assert kv_cache.shape[1] == window, "The ring buffer must have the size of the window"
+    batch_start = inference_params.batch_size_offset
+    batch_end = batch_start + batch_size
+    assert batch_end <= kv_cache.shape[0]
+    offset = inference_params.seqlen_offset
+    past_idx = torch.arange(max(offset - window, 0), offset, device=kv.device) % window
+    kv_past = kv_cache[batch_start:batch_end, past_idx]
+    # Only the last window tokens are needed for the next steps
+    num_new = min(seqlen, window)
+    new_idx = torch.arange(offset + seqlen - num_new, offset + seqlen, device=kv.device) % window
+    kv_cache[batch_start:batch_end, new_idx] = kv[:, seqlen - num_new :]
+    return torch.cat([kv_past, kv], dim=1)
+
+
+def _update_kv_cache_per_sample(kv, inference_params, layer_idx):
+    """Same as _update_kv_cache, but each sequence in the batch is written at its own offset
+    inference_params.lengths_per_sample, into the cache row given by
+    inference_params.cache_batch_idx, or into the blocks given by inference_params.block_table if
+    the cache is paged. This is the reference (non-flash) version of what flash_attn_with_kvcache
+    does with cache_seqlens, cache_batch_idx and block_table.
+    kv: (batch_size, seqlen, 2, nheads, head_dim)
+    Return:
+        kv: (batch_size, seqlen_k, 2, nheads, head_dim), the cached keys and values of the batch.
+            Positions past the end of a sequence are zeroed out.
+        key_padding_mask: (batch_size, seqlen_k), True for the valid positions of each sequence.
+    """
+    batch_size, seqlen = kv.shape[:2]
+    cache_seqlens = _get_cache_seqlens(inference_params, batch_size, kv.device)
+    seq_idx = cache_seqlens[:, None] + torch.arange(seqlen, device=kv.device)
+    seqlen_k = int(cache_seqlens.max()) + seqlen
+    if inference_params.block_table is None:
+        kv_cache = _get_kv_cache(kv, inference_params, layer_idx)
+        assert seqlen_k <= kv_cache.shape[1]
+        batch_idx = _get_cache_batch_idx(inference_params, batch_size, kv.device)
+        kv_cache[batch_idx[:, None], seq_idx] = kv
+        kv = kv_cache[batch_idx, :seqlen_k]
+    else:
+        # Paged KV cache: (num_blocks, block_size, 2, nheads, head_dim)
+        kv_cache = inference_params.key_value_memory_dict[layer_idx]
+        block_size = kv_cache.shape[1]
+        block_table = inference_params.block_table[:batch_size].long()
+        assert seqlen_k <= block_table.shape[1] * block_size
+        block_idx = block_table.gather(1, seq_idx // block_size)
+        kv_cache[block_idx, seq_idx % block_size] = kv
+        num_blocks = (seqlen_k + block_size - 1) // block_size
+        kv = rearrange(kv_cache[block_table[:, :num_blocks]], "b n s ... -> b (n s) ...")
+        kv = kv[:, :seqlen_k]
+    key_padding_mask = torch.arange(seqlen_k, device=kv.device) < (cache_seqlens[:, None] + seqlen)
+    # Rows that are shorter than seqlen_k might have garbage (e.g. NaN) past their end, which
+    # would leak through the softmax even if masked with a large negative number.
+    kv = kv.masked_fill(rearrange(~key_padding_mask, "b s -> b s 1 1 1"), 0.0)
+    return kv, key_padding_mask
+
+
+def _tree_attention_mask(tree_mask, key_padding_mask, window_size=(-1, -1)):
+    """Attention mask of the tokens of a tree (see InferenceParams.tree_mask) that were just
+    appended to the KV cache: each token attends to all the tokens cached before the tree, and to
+    its ancestors in the tree and itself.
+    tree_mask: (seqlen_q, seqlen_q) boolean. key_padding_mask: (batch_size, seqlen_k), as returned
+    by _update_kv_cache_per_sample, the tree occupies the last seqlen_q valid positions.
+    window_size: (left, right), sliding window local attention, where the position of each token
+    of the tree is the number of cached tokens plus its depth in the tree.
+    Return: (batch_size, seqlen_q, seqlen_k) boolean, True means to keep.
+    """
+    seqlen_q, seqlen_k = tree_mask.shape[0], key_padding_mask.shape[1]
+    cache_seqlens = key_padding_mask.sum(-1, keepdim=True) - seqlen_q  # (batch_size, 1)
+    col_idx = torch.arange(seqlen_k, device=tree_mask.device)
+    tree_idx = col_idx - cache_seqlens
+    in_tree = (tree_idx >= 0) & (tree_idx < seqlen_q)
+    mask = rearrange(tree_mask[:, tree_idx.clamp(0, seqlen_q - 1)], "t b s -> b t s")
+    mask = torch.where(
+        rearrange(in_tree, "b s -> b 1 s"), mask, rearrange(key_padding_mask, "b s -> b 1 s")
+    )
+    if window_size != (-1, -1):
+        depth = tree_mask.sum(-1) - 1  # (seqlen_q,)
+        query_pos = cache_seqlens + depth  # (batch_size, seqlen_q)
+        key_pos = torch.where(
+            in_tree, cache_seqlens + depth[tree_idx.clamp(0, seqlen_q - 1)], col_idx
+        )  # (batch_size, seqlen_k)
+        diff = rearrange(query_pos, "b t -> b t 1") - rearrange(key_pos, "b s -> b 1 s")
+        if window_size[0] >= 0:
+            mask = mask & (diff <= window_size[0])
+        if window_size[1] >= 0:
+            mask = mask & (-diff <= window_size[1])
+    return mask
+
+
+def _tree_attention(inner_cross_attn, q, kv, key_padding_mask, tree_mask):
+    """Attention of the tokens of a tree to the KV cache, with the PyTorch CrossAttention
+    (FlashAttention doesn't support arbitrary masks). inner_cross_attn gives the softmax_scale,
+    ALiBi slopes and sliding window if it's a FlashCrossAttention. The sliding window is applied
+    from the depth of the tokens in the tree rather than their index, so it's part of the mask."""
+    window_size = getattr(inner_cross_attn, "window_size", (-1, -1))
+    if not isinstance(inner_cross_attn, CrossAttention) or window_size != (-1, -1):
+        inner_cross_attn = CrossAttention(
+            softmax_scale=inner_cross_attn.softmax_scale,
+            alibi_slopes=getattr(inner_cross_attn, "alibi_slopes", None),
+        )
+    attn_mask = _tree_attention_mask(tree_mask, key_padding_mask, window_size=window_size)
+    return inner_cross_attn(
+        q, kv, causal=False, key_padding_mask=key_padding_mask, attn_mask=attn_mask
+    )
+
+
+def _apply_rotary_emb(
+    rotary_emb, qkv, kv=None, seqlen_offset=0, max_seqlen=None, tree_mask=None, cu_seqlens=None
+):
+    """Apply rotary_emb as in RotaryEmbedding.forward. If tree_mask is not None, the tokens are
+    the nodes of a tree, and the position of each token is seqlen_offset plus its depth in the tree
+    instead of seqlen_offset plus its index: tokens are moved to the batch dimension so that each
+    of them gets its own offset.
+    If cu_seqlens is not None, qkv and kv are (total, ...) tokens of documents packed together,
+    max_seqlen is the max length of the documents, and the position of each token is its index in
+    its document, the same way.
+    """
+    if cu_seqlens is not None:
+        cu_seqlens = cu_seqlens.long()
+        doc_starts = torch.repeat_interleave(cu_seqlens[:-1], cu_seqlens.diff())
+        offsets = torch.arange(qkv.shape[0], device=qkv.device) - doc_starts
+        qkv = rearrange(qkv, "t ... -> t 1 ...")
+        kv = rearrange(kv, "t ... -> t 1 ...") if kv is not None else None
+        out = rotary_emb(qkv, kv, seqlen_offset=offsets.to(torch.int32), max_seqlen=max_seqlen)
+        if kv is None:
+            return rearrange(out, "t 1 ... -> t ...")
+        return tuple(rearrange(t, "t 1 ... -> t ...") for t in out)
+    if tree_mask is None:
+        return rotary_emb(qkv, kv, seqlen_offset=seqlen_offset, max_seqlen=max_seqlen)
+    batch_size, seqlen = qkv.shape[:2]
+    depth = tree_mask.sum(-1) - 1
+    if not isinstance(seqlen_offset, torch.Tensor):
+        seqlen_offset = torch.full((batch_size,), seqlen_offset, device=qkv.device)
+    offsets = rearrange(seqlen_offset[:batch_size, None] + depth, "b s -> (b s)")
+    qkv = rearrange(qkv, "b s ... -> (b s) 1 ...")
+    kv = rearrange(kv, "b s ... -> (b s) 1 ...") if kv is not None else None
+    out = rotary_emb(qkv, kv, seqlen_offset=offsets.to(torch.int32), max_seqlen=max_seqlen)
+    if kv is None:
+        return rearrange(out, "(b s) 1 ... -> b s ...", b=batch_size)
+    return tuple(rearrange(t, "(b s) 1 ... -> b s ...", b=batch_size) for t in out)
+
+
 class MHA(nn.Module):
     """Multi-head self-attention and cross-attention"""
 
@@ -401,6 +897,7 @@ class MHA(nn.Module):
         window_size=(-1, -1),
         fused_bias_fc=False,
         use_flash_attn=False,
+        attn_chunk_size=None,
         return_residual=False,
         checkpointing=False,
         device=None,
@@ -408,6 +905,9 @@ class MHA(nn.Module):
     ) -> None:
         """
         num_heads_kv: can be used to toggle MQA / GQA. If None, use num_heads.
+        attn_chunk_size: only used when use_flash_attn=False. If not None, the PyTorch attention
+            is computed in blocks of this size with an online softmax instead of materializing the
+            full attention matrix.
         return_residual: whether to return the input x along with the output. This is for
             performance reason: for post-norm architecture, returning the input allows us
             to fuse the backward of nn.Linear with the residual connection.
@@ -424,12 +924,10 @@ class MHA(nn.Module):
         self.return_residual = return_residual
         self.checkpointing = checkpointing
         if use_alibi:
-            assert use_flash_attn, "ALiBi code path requires flash_attn"
             alibi_slopes = torch.tensor(get_alibi_slopes(num_heads), device=device)
         else:
             alibi_slopes = None
-        if window_size != (-1, -1):
-            assert use_flash_attn, "Local (sliding window) attention code path requires flash_attn"
+        self.window_size = window_size
 
         self.num_heads = num_heads
         self.num_heads_kv = num_heads_kv if num_heads_kv is not None else num_heads
@@ -462,12 +960,22 @@ class MHA(nn.Module):
         inner_attn_cls = (
             partial(FlashSelfAttention, alibi_slopes=alibi_slopes, window_size=window_size)
             if use_flash_attn
-            else SelfAttention
+            else partial(
+                SelfAttention,
+                alibi_slopes=alibi_slopes,
+                window_size=window_size,
+                chunk_size=attn_chunk_size,
+            )
         )
         inner_cross_attn_cls = (
             partial(FlashCrossAttention, alibi_slopes=alibi_slopes, window_size=window_size)
             if use_flash_attn
-            else CrossAttention
+            else partial(
+                CrossAttention,
+                alibi_slopes=alibi_slopes,
+                window_size=window_size,
+                chunk_size=attn_chunk_size,
+            )
         )
         if not self.cross_attn:
             self.Wqkv = wqkv_cls(embed_dim, qkv_dim, bias=qkv_proj_bias, **factory_kwargs)
@@ -494,17 +1002,40 @@ class MHA(nn.Module):
         )
         self.out_proj = linear_cls(embed_dim, embed_dim, bias=out_proj_bias, **factory_kwargs)
 
-    def allocate_inference_cache(self, batch_size, max_seqlen, dtype=None):
+    def allocate_inference_cache(
+        self,
+        batch_size,
+        max_seqlen,
+        dtype=None,
+        num_blocks=None,
+        block_size=None,
+        kv_cache_quant_dtype=None,
+        kv_cache_quant_group_size=None,
+        sliding_window_kv_cache=False,
+    ):
+        """If num_blocks is not None, allocate a paged KV cache of num_blocks blocks of block_size
+        tokens each, to be indexed with InferenceParams.block_table. FlashAttention requires
+        block_size to be a multiple of 256.
+        If kv_cache_quant_dtype is not None, the KV cache is stored in that dtype (torch.int8 or
+        fp8) with a scale per kv_cache_quant_group_size channels (default: per head), see
+        flash_attn.utils.quantized_kv_cache. It is then only read by the PyTorch attention.
+        If sliding_window_kv_cache and the attention is local, allocate a ring buffer of
+        window_size[0] tokens instead of max_seqlen (see InferenceParams.sliding_window_kv_cache).
+        """
         dtype = self.out_proj.weight.dtype if dtype is None else dtype
         device = self.out_proj.weight.device
-        return torch.empty(
-            batch_size,
-            max_seqlen,
-            2,
-            self.num_heads_kv,
-            self.head_dim,
-            dtype=dtype,
-            device=device,
+        if num_blocks is not None:
+            assert block_size is not None, "Paged KV cache requires block_size"
+            batch_size, max_seqlen = num_blocks, block_size
+        if sliding_window_kv_cache and self.window_size[0] >= 0:
+            assert num_blocks is None, "Ring buffer KV cache can't be paged"
+            max_seqlen = max(self.window_size[0], 1)
+        return _allocate_kv_cache(
+            (batch_size, max_seqlen, 2, self.num_heads_kv, self.head_dim),
+            dtype,
+            device,
+            quant_dtype=kv_cache_quant_dtype,
+            group_size=kv_cache_quant_group_size,
         )
 
     def _update_kv_cache(self, kv, inference_params):
@@ -513,6 +1044,12 @@ class MHA(nn.Module):
         assert self.layer_idx is not None, "Generation requires layer_idx in the constructor"
         return _update_kv_cache(kv, inference_params, self.layer_idx)
 
+    def _update_kv_cache_per_sample(self, kv, inference_params):
+        """kv: (batch_size, seqlen, 2, nheads, head_dim). Return kv and key_padding_mask."""
+        assert not self.dwconv, "Generation does not support dwconv yet"
+        assert self.layer_idx is not None, "Generation requires layer_idx in the constructor"
+        return _update_kv_cache_per_sample(kv, inference_params, self.layer_idx)
+
     def _apply_rotary_update_kvcache_attention(self, q, kv, inference_params):
         """
         Fast path that combine 3 steps: apply rotary to Q and K, update kv cache, and apply attention.
@@ -530,7 +1067,9 @@ class MHA(nn.Module):
         else:
             rotary_cos, rotary_sin = None, None
         batch = q.shape[0]
-        kv_cache = inference_params.key_value_memory_dict[self.layer_idx][:batch]
+        kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+        if inference_params.cache_batch_idx is None and inference_params.block_table is None:
+            kv_cache = kv_cache[:batch]
         cache_seqlens = (
             inference_params.lengths_per_sample[:batch]
             if inference_params.lengths_per_sample is not None
@@ -546,6 +1085,8 @@ class MHA(nn.Module):
             rotary_cos=rotary_cos,
             rotary_sin=rotary_sin,
             cache_seqlens=cache_seqlens,
+            cache_batch_idx=inference_params.cache_batch_idx,
+            block_table=inference_params.block_table,
             softmax_scale=self.inner_cross_attn.softmax_scale,
             causal=self.inner_cross_attn.causal,
             rotary_interleaved=self.rotary_emb.interleaved if self.rotary_emb_dim > 0 else False,
@@ -555,17 +1096,36 @@ class MHA(nn.Module):
 
     def _update_kvcache_attention(self, q, kv, inference_params):
         """Write kv to inference_params, then do attention"""
+        if _uses_ring_kv_cache(inference_params, self.window_size):
+            assert inference_params.tree_mask is None, "Ring buffer KV cache doesn't support trees"
+            kv = _update_ring_kv_cache(kv, inference_params, self.layer_idx, self.window_size)
+            return self.inner_cross_attn(q, kv)
+        if inference_params.tree_mask is not None:
+            kv, key_padding_mask = self._update_kv_cache_per_sample(kv, inference_params)
+            return _tree_attention(
+                self.inner_cross_attn, q, kv, key_padding_mask, inference_params.tree_mask
+            )
         if (
-            inference_params.seqlen_offset == 0
+            (inference_params.seqlen_offset == 0 and inference_params.block_table is None)
             or flash_attn_with_kvcache is None
             or not self.use_flash_attn
+            or not _supports_flash_attn_with_kvcache(
+                inference_params, self.layer_idx, self.window_size
+            )
         ):
-            # TODO: this only uses seqlen_offset and not lengths_per_sample.
+            if inference_params.block_table is not None or (
+                inference_params.seqlen_offset > 0
+                and inference_params.lengths_per_sample is not None
+            ):
+                kv, key_padding_mask = self._update_kv_cache_per_sample(kv, inference_params)
+                return self.inner_cross_attn(q, kv, key_padding_mask=key_padding_mask)
             kv = self._update_kv_cache(kv, inference_params)
             return self.inner_cross_attn(q, kv)
         else:
             batch = q.shape[0]
-            kv_cache = inference_params.key_value_memory_dict[self.layer_idx][:batch]
+            kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+            if inference_params.cache_batch_idx is None and inference_params.block_table is None:
+                kv_cache = kv_cache[:batch]
             cache_seqlens = (
                 inference_params.lengths_per_sample[:batch]
                 if inference_params.lengths_per_sample is not None
@@ -579,6 +1139,8 @@ class MHA(nn.Module):
                 kv[:, :, 0],
                 kv[:, :, 1],
                 cache_seqlens=cache_seqlens,
+                cache_batch_idx=inference_params.cache_batch_idx,
+                block_table=inference_params.block_table,
                 softmax_scale=self.inner_cross_attn.softmax_scale,
                 causal=self.inner_cross_attn.causal,
                 alibi_slopes=alibi_slopes,
@@ -602,8 +1164,8 @@ class MHA(nn.Module):
                 is the is the sum of the sequence lengths in the batch.
             x_kv: (batch, seqlen, hidden_dim), only applicable for cross-attention. If None, use x.
             cu_seqlens: (batch_size + 1,), dtype torch.int32. The cumulative sequence lengths
-                of the sequences in the batch, used to index into x. Only applicable when using
-                FlashAttention.
+                of the sequences in the batch, used to index into x. With rotary embeddings,
+                the positions of each sequence start from 0.
             max_seqlen: int. Maximum sequence length in the batch.
             key_padding_mask: boolean mask, True means to keep, False means to mask out.
                 (batch, seqlen). Only applicable when not using FlashAttention.
@@ -616,9 +1178,7 @@ class MHA(nn.Module):
         if cu_seqlens is not None:
             assert max_seqlen is not None
             assert key_padding_mask is None
-            assert self.use_flash_attn
             assert not self.dwconv
-            assert self.rotary_emb_dim == 0
         if key_padding_mask is not None:
             assert cu_seqlens is None
             assert max_seqlen is None
@@ -630,7 +1190,7 @@ class MHA(nn.Module):
 
         kwargs = (
             {"cu_seqlens": cu_seqlens, "max_seqlen": max_seqlen, **kwargs}
-            if self.use_flash_attn
+            if self.use_flash_attn or cu_seqlens is not None
             else {"key_padding_mask": key_padding_mask, **kwargs}
         )
         seqlen_offset = (
@@ -642,7 +1202,12 @@ class MHA(nn.Module):
                 else inference_params.seqlen_offset
             )
         )
-        rotary_max_seqlen = inference_params.max_seqlen if inference_params is not None else None
+        rotary_max_seqlen = (
+            inference_params.max_seqlen
+            if inference_params is not None
+            else (max_seqlen if cu_seqlens is not None else None)
+        )
+        tree_mask = inference_params.tree_mask if inference_params is not None else None
         batch, seqlen = x.shape[:2]
         if not self.cross_attn and self.num_heads_kv == self.num_heads:
             assert x_kv is None and mixer_subset is None
@@ -660,10 +1225,18 @@ class MHA(nn.Module):
                 or inference_params.seqlen_offset == 0
                 or (self.rotary_emb_dim == 0 or self.rotary_emb_dim % 16 != 0)
                 or not self.use_flash_attn
+                or not _supports_flash_attn_with_kvcache(
+                    inference_params, self.layer_idx, self.window_size
+                )
             ):
                 if self.rotary_emb_dim > 0:
-                    qkv = self.rotary_emb(
-                        qkv, seqlen_offset=seqlen_offset, max_seqlen=rotary_max_seqlen
+                    qkv = _apply_rotary_emb(
+                        self.rotary_emb,
+                        qkv,
+                        seqlen_offset=seqlen_offset,
+                        max_seqlen=rotary_max_seqlen,
+                        tree_mask=tree_mask,
+                        cu_seqlens=cu_seqlens,
                     )
                 if inference_params is None:
                     if not self.checkpointing:
@@ -711,10 +1284,19 @@ class MHA(nn.Module):
                 or inference_params.seqlen_offset == 0
                 or (self.rotary_emb_dim == 0 or self.rotary_emb_dim % 16 != 0)
                 or not self.use_flash_attn
+                or not _supports_flash_attn_with_kvcache(
+                    inference_params, self.layer_idx, self.window_size
+                )
             ):
                 if self.rotary_emb_dim > 0:
-                    q, kv = self.rotary_emb(
-                        q, kv, seqlen_offset=seqlen_offset, max_seqlen=rotary_max_seqlen
+                    q, kv = _apply_rotary_emb(
+                        self.rotary_emb,
+                        q,
+                        kv,
+                        seqlen_offset=seqlen_offset,
+                        max_seqlen=rotary_max_seqlen,
+                        tree_mask=tree_mask,
+                        cu_seqlens=cu_seqlens,
                     )
                 if inference_params is None:
                     if not self.checkpointing:
@@ -753,6 +1335,7 @@ class ParallelMHA(nn.Module):
         use_alibi=False,
         window_size=(-1, -1),
         use_flash_attn=False,
+        attn_chunk_size=None,
         checkpointing=False,
         sequence_parallel=True,
         device=None,
@@ -788,7 +1371,6 @@ class ParallelMHA(nn.Module):
         qkv_dim = self.head_dim * (self.num_heads + 2 * self.num_heads_kv)
 
         if use_alibi:
-            assert use_flash_attn, "ALiBi code path requires flash_attn"
             num_heads_local = math.ceil(self.num_heads / self.world_size)
             alibi_slopes = torch.tensor(
                 get_alibi_slopes(num_heads)[
@@ -798,8 +1380,7 @@ class ParallelMHA(nn.Module):
             )
         else:
             alibi_slopes = None
-        if window_size != (-1, -1):
-            assert use_flash_attn, "Local (sliding window) attention code path requires flash_attn"
+        self.window_size = window_size
 
         if self.rotary_emb_dim > 0:
             assert RotaryEmbedding is not None, "rotary_emb is not installed"
@@ -825,12 +1406,22 @@ class ParallelMHA(nn.Module):
         inner_attn_cls = (
             partial(FlashSelfAttention, alibi_slopes=alibi_slopes, window_size=window_size)
             if use_flash_attn
-            else SelfAttention
+            else partial(
+                SelfAttention,
+                alibi_slopes=alibi_slopes,
+                window_size=window_size,
+                chunk_size=attn_chunk_size,
+            )
         )
         inner_cross_attn_cls = (
             partial(FlashCrossAttention, alibi_slopes=alibi_slopes, window_size=window_size)
             if use_flash_attn
-            else CrossAttention
+            else partial(
+                CrossAttention,
+                alibi_slopes=alibi_slopes,
+                window_size=window_size,
+                chunk_size=attn_chunk_size,
+            )
         )
         self.inner_attn = inner_attn_cls(
             causal=causal, softmax_scale=softmax_scale, attention_dropout=dropout
@@ -848,17 +1439,40 @@ class ParallelMHA(nn.Module):
             **factory_kwargs,
         )
 
-    def allocate_inference_cache(self, batch_size, max_seqlen, dtype=None):
+    def allocate_inference_cache(
+        self,
+        batch_size,
+        max_seqlen,
+        dtype=None,
+        num_blocks=None,
+        block_size=None,
+        kv_cache_quant_dtype=None,
+        kv_cache_quant_group_size=None,
+        sliding_window_kv_cache=False,
+    ):
+        """If num_blocks is not None, allocate a paged KV cache of num_blocks blocks of block_size
+        tokens each, to be indexed with InferenceParams.block_table. FlashAttention requires
+        block_size to be a multiple of 256.
+        If kv_cache_quant_dtype is not None, the KV cache is stored in that dtype (torch.int8 or
+        fp8) with a scale per kv_cache_quant_group_size channels (default: per head), see
+        flash_attn.utils.quantized_kv_cache. It is then only read by the PyTorch attention.
+        If sliding_window_kv_cache and the attention is local, allocate a ring buffer of
+        window_size[0] tokens instead of max_seqlen (see InferenceParams.sliding_window_kv_cache).
+        """
         dtype = self.out_proj.weight.dtype if dtype is None else dtype
         device = self.out_proj.weight.device
-        return torch.empty(
-            batch_size,
-            max_seqlen,
-            2,
-            self.num_heads_kv_per_rank,
-            self.head_dim,
-            dtype=dtype,
-            device=device,
+        if num_blocks is not None:
+            assert block_size is not None, "Paged KV cache requires block_size"
+            batch_size, max_seqlen = num_blocks, block_size
+        if sliding_window_kv_cache and self.window_size[0] >= 0:
+            assert num_blocks is None, "Ring buffer KV cache can't be paged"
+            max_seqlen = max(self.window_size[0], 1)
+        return _allocate_kv_cache(
+            (batch_size, max_seqlen, 2, self.num_heads_kv_per_rank, self.head_dim),
+            dtype,
+            device,
+            quant_dtype=kv_cache_quant_dtype,
+            group_size=kv_cache_quant_group_size,
         )
 
     def _update_kv_cache(self, kv, inference_params):
@@ -866,6 +1480,11 @@ class ParallelMHA(nn.Module):
         assert self.layer_idx is not None, "Generation requires layer_idx in the constructor"
         return _update_kv_cache(kv, inference_params, self.layer_idx)
 
+    def _update_kv_cache_per_sample(self, kv, inference_params):
+        """kv: (batch_size, seqlen, 2, nheads, head_dim). Return kv and key_padding_mask."""
+        assert self.layer_idx is not None, "Generation requires layer_idx in the constructor"
+        return _update_kv_cache_per_sample(kv, inference_params, self.layer_idx)
+
     def _apply_rotary_update_kvcache_attention(self, q, kv, inference_params):
         """
         Fast path that combine 3 steps: apply rotary to Q and K, update kv cache, and apply attention.
@@ -883,7 +1502,9 @@ class ParallelMHA(nn.Module):
         else:
             rotary_cos, rotary_sin = None, None
         batch = q.shape[0]
-        kv_cache = inference_params.key_value_memory_dict[self.layer_idx][:batch]
+        kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+        if inference_params.cache_batch_idx is None and inference_params.block_table is None:
+            kv_cache = kv_cache[:batch]
         cache_seqlens = (
             inference_params.lengths_per_sample[:batch]
             if inference_params.lengths_per_sample is not None
@@ -899,6 +1520,8 @@ class ParallelMHA(nn.Module):
             rotary_cos=rotary_cos,
             rotary_sin=rotary_sin,
             cache_seqlens=cache_seqlens,
+            cache_batch_idx=inference_params.cache_batch_idx,
+            block_table=inference_params.block_table,
             softmax_scale=self.inner_cross_attn.softmax_scale,
             causal=self.inner_cross_attn.causal,
             rotary_interleaved=self.rotary_emb.interleaved if self.rotary_emb_dim > 0 else False,
@@ -908,13 +1531,35 @@ class ParallelMHA(nn.Module):
 
     def _update_kvcache_attention(self, q, kv, inference_params):
         """Write kv to inference_params, then do attention"""
-        if inference_params.seqlen_offset == 0 or not self.use_flash_attn:
-            # TODO: this only uses seqlen_offset and not lengths_per_sample.
+        if _uses_ring_kv_cache(inference_params, self.window_size):
+            assert inference_params.tree_mask is None, "Ring buffer KV cache doesn't support trees"
+            kv = _update_ring_kv_cache(kv, inference_params, self.layer_idx, self.window_size)
+            return self.inner_cross_attn(q, kv)
+        if inference_params.tree_mask is not None:
+            kv, key_padding_mask = self._update_kv_cache_per_sample(kv, inference_params)
+            return _tree_attention(
+                self.inner_cross_attn, q, kv, key_padding_mask, inference_params.tree_mask
+            )
+        if (
+            (inference_params.seqlen_offset == 0 and inference_params.block_table is None)
+            or not self.use_flash_attn
+            or not _supports_flash_attn_with_kvcache(
+                inference_params, self.layer_idx, self.window_size
+            )
+        ):
+            if inference_params.block_table is not None or (
+                inference_params.seqlen_offset > 0
+                and inference_params.lengths_per_sample is not None
+            ):
+                kv, key_padding_mask = self._update_kv_cache_per_sample(kv, inference_params)
+                return self.inner_cross_attn(q, kv, key_padding_mask=key_padding_mask)
             kv = self._update_kv_cache(kv, inference_params)
             return self.inner_cross_attn(q, kv)
         else:
             batch = q.shape[0]
-            kv_cache = inference_params.key_value_memory_dict[self.layer_idx][:batch]
+            kv_cache = inference_params.key_value_memory_dict[self.layer_idx]
+            if inference_params.cache_batch_idx is None and inference_params.block_table is None:
+                kv_cache = kv_cache[:batch]
             cache_seqlens = (
                 inference_params.lengths_per_sample[:batch]
                 if inference_params.lengths_per_sample is not None
@@ -928,6 +1573,8 @@ class ParallelMHA(nn.Module):
                 kv[:, :, 0],
                 kv[:, :, 1],
                 cache_seqlens=cache_seqlens,
+                cache_batch_idx=inference_params.cache_batch_idx,
+                block_table=inference_params.block_table,
                 softmax_scale=self.inner_cross_attn.softmax_scale,
                 causal=self.inner_cross_attn.causal,
                 alibi_slopes=alibi_slopes,
@@ -955,6 +1602,7 @@ class ParallelMHA(nn.Module):
             )
         )
         rotary_max_seqlen = inference_params.max_seqlen if inference_params is not None else None
+        tree_mask = inference_params.tree_mask if inference_params is not None else None
         if self.num_heads_kv == self.num_heads:
             qkv = rearrange(qkv, "b s (three h d) -> b s three h d", three=3, d=self.head_dim)
             if (
@@ -962,10 +1610,17 @@ class ParallelMHA(nn.Module):
                 or inference_params.seqlen_offset == 0
                 or (self.rotary_emb_dim == 0 or self.rotary_emb_dim % 16 != 0)
                 or not self.use_flash_attn
+                or not _supports_flash_attn_with_kvcache(
+                    inference_params, self.layer_idx, self.window_size
+                )
             ):
                 if self.rotary_emb_dim > 0:
-                    qkv = self.rotary_emb(
-                        qkv, seqlen_offset=seqlen_offset, max_seqlen=rotary_max_seqlen
+                    qkv = _apply_rotary_emb(
+                        self.rotary_emb,
+                        qkv,
+                        seqlen_offset=seqlen_offset,
+                        max_seqlen=rotary_max_seqlen,
+                        tree_mask=tree_mask,
                     )
                 if inference_params is None:
                     if not self.checkpointing:
@@ -997,10 +1652,18 @@ class ParallelMHA(nn.Module):
                 or inference_params.seqlen_offset == 0
                 or (self.rotary_emb_dim == 0 or self.rotary_emb_dim % 16 != 0)
                 or not self.use_flash_attn
+                or not _supports_flash_attn_with_kvcache(
+                    inference_params, self.layer_idx, self.window_size
+                )
             ):
                 if self.rotary_emb_dim > 0:
-                    q, kv = self.rotary_emb(
-                        q, kv, seqlen_offset=seqlen_offset, max_seqlen=rotary_max_seqlen
+                    q, kv = _apply_rotary_emb(
+                        self.rotary_emb,
+                        q,
+                        kv,
+                        seqlen_offset=seqlen_offset,
+                        max_seqlen=rotary_max_seqlen,
+                        tree_mask=tree_mask,
                     )
                 if inference_params is None:
                     if not self.checkpointing:
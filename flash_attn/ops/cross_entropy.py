@@ -0,0 +1,178 @@
+# Copyright (c) 2024, Tri Dao.
+
+# Pure PyTorch implementation of flash_attn.ops.triton.cross_entropy, for CPU tensors. Same
+# semantics (label smoothing, logit_scale, z-loss, ignore_index, vocab split across a process
+# group, e.g. gloo), processed in chunks of rows so that the fp32 copy of the logits is bounded.
+# Each chunk is large enough for the ops to be parallelized over torch's intra-op threads.
+
+from typing import Optional, Tuple
+
+import torch
+
+# Number of fp32 logits processed at a time
+CHUNK_NUMEL = 16 * 1024 * 1024
+
+
+def _chunk_size(n_rows, n_cols, chunk_size):
+    if chunk_size is None:
+        chunk_size = max(CHUNK_NUMEL // max(n_cols, 1), 1)
+    return min(chunk_size, max(n_rows, 1))
+
+
+class CrossEntropyLoss(torch.autograd.Function):
+
+    @staticmethod
+    def forward(
+        ctx,
+        logits,
+        labels,
+        precomputed_lse=None,
+        smoothing=0.0,
+        logit_scale=1.0,
+        lse_square_scale=0.0,
+        ignore_index=-100,
+        inplace_backward=False,
+        process_group=None,
+        chunk_size=None,
+    ):
+        n_rows, n_cols = logits.shape
+        assert labels.shape == (n_rows,)
+        world_size = 1 if process_group is None else torch.distributed.get_world_size(process_group)
+        total_classes = world_size * n_cols
+        rank = 0 if process_group is None else torch.distributed.get_rank(process_group)
+        class_start_idx = rank * n_cols
+        use_precomputed_lse = precomputed_lse is not None and logit_scale == 1.0 and smoothing == 0.0
+        chunk_size = _chunk_size(n_rows, n_cols, chunk_size)
+
+        losses = torch.empty(n_rows, dtype=torch.float, device=logits.device)
+        if use_precomputed_lse:
+            assert precomputed_lse.shape == (n_rows,)
+            lse = precomputed_lse.float().contiguous()
+        else:
+            lse = torch.empty(n_rows, dtype=torch.float, device=logits.device)
+        label_idx = labels - class_start_idx
+        # Labels in the vocab of this partition
+        in_partition = (label_idx >= 0) & (label_idx < n_cols) & (labels != ignore_index)
+        for start in range(0, n_rows, chunk_size):
+            end = min(start + chunk_size, n_rows)
+            logits_chunk = logits[start:end].float()
+            if logit_scale != 1.0:
+                logits_chunk = logits_chunk * logit_scale
+            if not use_precomputed_lse:
+                lse[start:end] = torch.logsumexp(logits_chunk, dim=-1)
+            logits_label = logits_chunk.gather(
+                1, torch.where(in_partition[start:end], label_idx[start:end], 0)[:, None]
+            ).squeeze(1)
+            logits_label.masked_fill_(~in_partition[start:end], 0.0)
+            if smoothing > 0.0:
+                sum_logits = logits_chunk.sum(dim=-1)
+                # Same as the Triton kernel: the lse is added after the reduction across partitions
+                losses[start:end] = (
+                    -smoothing * sum_logits / total_classes - (1 - smoothing) * logits_label
+                )
+            else:
+                losses[start:end] = -logits_label
+
+        if world_size > 1:
+            lse_allgather = torch.empty(world_size, n_rows, dtype=lse.dtype, device=lse.device)
+            # all_gather_into_tensor isn't supported by gloo
+            torch.distributed.all_gather(list(lse_allgather.unbind(0)), lse, group=process_group)
+            torch.distributed.all_reduce(
+                losses, op=torch.distributed.ReduceOp.SUM, group=process_group
+            )
+            lse = torch.logsumexp(lse_allgather, dim=0)
+        losses += lse
+        ignored_mask = labels == ignore_index
+        if lse_square_scale != 0.0:
+            z_losses = lse_square_scale * lse.square()
+            z_losses.masked_fill_(ignored_mask, 0.0)
+            losses += z_losses
+        else:
+            z_losses = torch.zeros_like(losses)
+        losses.masked_fill_(ignored_mask, 0.0)
+
+        ctx.save_for_backward(logits, lse, labels)
+        ctx.mark_non_differentiable(z_losses)
+        ctx.smoothing = smoothing
+        ctx.logit_scale = logit_scale
+        ctx.lse_square_scale = lse_square_scale
+        ctx.ignore_index = ignore_index
+        ctx.total_classes = total_classes
+        ctx.class_start_idx = class_start_idx
+        ctx.inplace_backward = inplace_backward
+        ctx.chunk_size = chunk_size
+        return losses, z_losses
+
+    @staticmethod
+    def backward(ctx, grad_losses, grad_z_losses):
+        del grad_z_losses  # z_losses are only for logging.
+
+        logits, lse, labels = ctx.saved_tensors
+        dlogits = logits if ctx.inplace_backward else torch.empty_like(logits)
+        n_rows, n_cols = logits.shape
+        smoothing = ctx.smoothing
+        dloss = grad_losses.float().masked_fill(labels == ctx.ignore_index, 0.0)
+        dloss = dloss * ctx.logit_scale
+        label_idx = labels - ctx.class_start_idx
+        in_partition = (label_idx >= 0) & (label_idx < n_cols)
+        for start in range(0, n_rows, ctx.chunk_size):
+            end = min(start + ctx.chunk_size, n_rows)
+            logits_chunk = logits[start:end].float()
+            if ctx.logit_scale != 1.0:
+                logits_chunk = logits_chunk * ctx.logit_scale
+            lse_chunk = lse[start:end, None]
+            probs = torch.exp(logits_chunk - lse_chunk)
+            if ctx.lse_square_scale != 0.0:
+                probs *= 1.0 + 2.0 * ctx.lse_square_scale * lse_chunk
+            if smoothing > 0.0:
+                probs -= smoothing / ctx.total_classes
+            rows = in_partition[start:end].nonzero(as_tuple=True)[0]
+            probs[rows, label_idx[start:end][rows]] -= 1.0 - smoothing
+            probs *= dloss[start:end, None]
+            dlogits[start:end] = probs
+        return dlogits, None, None, None, None, None, None, None, None, None
+
+
+def cross_entropy_loss(
+    logits: torch.Tensor,
+    labels: torch.Tensor,
+    precomputed_lse: Optional[torch.Tensor] = None,
+    label_smoothing: float = 0.0,
+    logit_scale: float = 1.0,
+    lse_square_scale: float = 0.0,
+    ignore_index=-100,
+    inplace_backward: bool = False,
+    process_group=None,
+    chunk_size: Optional[int] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Arguments:
+        logits: (batch, vocab_size)
+        labels: (batch,)
+        label_smoothing: float
+        logit_scale: float. Multiply logits by this scale before calculating the loss.
+        lse_square_scale: float. If > 0, we add lse_square_scale * lse(logits) ^ 2 to the loss.
+            This is also referred to as "z-loss".
+        ignore_index: int. If labels == ignore_index, the loss is set to 0.0.
+        inplace_backward: bool. If True, we do the backward pass in-place by modifying the logits.
+            This saves memory.
+        process_group: if not None, we're doing Tensor Parallel: each process is responsible for
+            one part of the vocab. The loss will be aggregated across processes.
+        chunk_size: int. Number of rows processed at a time. By default, chunks of about 16M
+            logits.
+    Returns:
+        losses: (batch,), float
+        z_losses: (batch,), float
+    """
+    return CrossEntropyLoss.apply(
+        logits,
+        labels,
+        precomputed_lse,
+        label_smoothing,
+        logit_scale,
+        lse_square_scale,
+        ignore_index,
+        inplace_backward,
+        process_group,
+        chunk_size,
+    )
@@ -0,0 +1,361 @@
+# Continuous batching: requests are admitted into free slots of a fixed-size KV cache as soon as
+# other requests finish, instead of waiting for the whole batch to finish as in `decode`.
+import heapq
+from collections import deque
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional
+
+import torch
+from torch import Tensor
+
+from flash_attn.utils.generation import InferenceParams, SamplingParams, sample_batched
+from flash_attn.utils.kv_cache_offload import KVCacheOffloader, PreemptionPolicy
+
+
+@dataclass
+class GenerationRequest:
+    """A single sequence to generate.
+    input_ids: (seqlen,) prompt tokens.
+    max_new_tokens: number of tokens to generate, including the one sampled after the prompt.
+    sampling_params: how the tokens of this request are sampled, independently of the other
+        requests in the batch.
+    """
+
+    request_id: int
+    input_ids: Tensor
+    max_new_tokens: int
+    eos_token_id: Optional[int] = None
+    sampling_params: SamplingParams = field(default_factory=SamplingParams)
+    output_ids: List[int] = field(default_factory=list)
+    slot: Optional[int] = None
+    finished: bool = False
+    # Set when the request is preempted and its KV cache is in host memory
+    swapped: bool = False
+    num_preemptions: int = 0
+    # Set while the prefill is in progress, num_prefilled tokens are in the KV cache so far
+    prefilling: bool = False
+    num_prefilled: int = 0
+
+    @property
+    def seqlen(self):
+        """Number of tokens currently in the KV cache for this request."""
+        # The last sampled token has not been fed to the model yet.
+        return self.input_ids.shape[0] + max(len(self.output_ids) - 1, 0)
+
+    def append_token(self, token):
+        self.output_ids.append(token)
+        if len(self.output_ids) >= self.max_new_tokens or (
+            self.eos_token_id is not None and token == self.eos_token_id
+        ):
+            self.finished = True
+
+
+class SlotScheduler:
+    """First-come first-served admission of requests into a fixed number of batch slots.
+    Each slot is one row of the KV cache. Freed slots are reused by the lowest index first, so
+    that the active rows stay packed at the start of the cache as much as possible.
+    """
+
+    def __init__(self, max_batch_size, max_seqlen):
+        self.max_batch_size = max_batch_size
+        self.max_seqlen = max_seqlen
+        self.free_slots = list(range(max_batch_size))
+        heapq.heapify(self.free_slots)
+        self.waiting = deque()
+        self.running: Dict[int, GenerationRequest] = {}
+
+    def add_request(self, request):
+        if request.input_ids.shape[0] + request.max_new_tokens > self.max_seqlen:
+            raise ValueError(
+                f"Request {request.request_id} needs {request.input_ids.shape[0]} + "
+                f"{request.max_new_tokens} tokens, more than max_seqlen={self.max_seqlen}"
+            )
+        self.waiting.append(request)
+
+    def schedule(self):
+        """Move as many waiting requests as there are free slots to running.
+        Return the list of newly admitted requests."""
+        admitted = []
+        while self.waiting and self.free_slots:
+            request = self.waiting.popleft()
+            request.slot = heapq.heappop(self.free_slots)
+            self.running[request.slot] = request
+            admitted.append(request)
+        return admitted
+
+    def release(self, request):
+        del self.running[request.slot]
+        heapq.heappush(self.free_slots, request.slot)
+
+    def preempt(self, request):
+        """Free the slot of a running request and put it back at the front of the waiting queue,
+        so that it's resumed before the requests that haven't started yet."""
+        self.release(request)
+        request.slot = None
+        request.num_preemptions += 1
+        self.waiting.appendleft(request)
+
+    def active_slots(self):
+        """The slots of the requests that are being decoded."""
+        return sorted(
+            slot
+            for slot, request in self.running.items()
+            if not request.finished and not request.prefilling
+        )
+
+    def prefilling_slots(self):
+        return sorted(slot for slot, request in self.running.items() if request.prefilling)
+
+    def has_unfinished(self):
+        return bool(self.waiting) or bool(self.running)
+
+
+class ContinuousBatchingEngine:
+    """Generate from many requests with a single KV cache of max_batch_size rows.
+    After every step, finished requests free their slot and waiting requests are admitted into it.
+
+    A new request is prefilled on its own (batch of 1), writing into its KV cache row through
+    InferenceParams.batch_size_offset. All active requests are then decoded together, one token
+    per step: InferenceParams.cache_batch_idx maps each sequence of the batch to its row in the
+    cache and InferenceParams.lengths_per_sample holds the current length of each sequence, so the
+    active slots don't have to be contiguous and can have different lengths.
+    Works with FlashAttention (through flash_attn_with_kvcache) and with the PyTorch attention.
+
+    A scheduler can preempt running requests (preempt) to free their slots. The preemption_policy
+    chooses which requests, and whether their KV cache is swapped out to num_host_blocks blocks of
+    host_block_size tokens of host memory (see KVCacheOffloader) or dropped, in which case it's
+    recomputed with a prefill of the prompt and the tokens generated so far when the request
+    is resumed.
+
+    Each request has its own SamplingParams (the engine's top_k, top_p and temperature by default),
+    and all the requests are sampled together by sample_batched. A request without a seed gets one
+    from the global RNG when it's added, so that its tokens don't depend on the other requests.
+
+    If prefill_chunk_size is not None, the prompt of a new request is prefilled one chunk of
+    prefill_chunk_size tokens per step, and the other requests are decoded between the chunks:
+    the prefill of a long prompt doesn't stall the batch, and its activation memory is bounded.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size,
+        max_seqlen,
+        top_k=1,
+        top_p=0.0,
+        temperature=1.0,
+        vocab_size=None,
+        dtype=None,
+        num_host_blocks=0,
+        host_block_size=256,
+        preemption_policy=None,
+        prefill_chunk_size=None,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_seqlen = max_seqlen
+        self.sampling_params = SamplingParams(top_k=top_k, top_p=top_p, temperature=temperature)
+        self.vocab_size = vocab_size
+        self.prefill_chunk_size = prefill_chunk_size
+        self.scheduler = SlotScheduler(max_batch_size, max_seqlen)
+        param_example = next(iter(model.parameters()))
+        self.device = param_example.device
+        dtype = param_example.dtype if dtype is None else dtype
+        self.inference_params = InferenceParams(
+            max_seqlen=max_seqlen,
+            max_batch_size=max_batch_size,
+            key_value_memory_dict=model.allocate_inference_cache(max_batch_size, max_seqlen, dtype),
+        )
+        # Per-slot state, kept on device so that decoding doesn't need to go through the host
+        self.lengths = torch.zeros(max_batch_size, dtype=torch.int32, device=self.device)
+        self.last_tokens = torch.zeros(max_batch_size, dtype=torch.long, device=self.device)
+        self._next_request_id = 0
+        self.offloader = (
+            KVCacheOffloader(
+                self.inference_params.key_value_memory_dict, num_host_blocks, host_block_size
+            )
+            if num_host_blocks > 0
+            else None
+        )
+        self.preemption_policy = (
+            PreemptionPolicy() if preemption_policy is None else preemption_policy
+        )
+
+    def add_request(
+        self, input_ids, max_new_tokens, eos_token_id=None, request_id=None, sampling_params=None
+    ):
+        """input_ids: (seqlen,) or (1, seqlen). Return the request, whose output_ids will be
+        filled in as generation progresses."""
+        if sampling_params is None:
+            sampling_params = self.sampling_params
+        if sampling_params.seed is None:
+            seed = torch.randint(2**62, (1,)).item()
+            sampling_params = replace(sampling_params, seed=seed)
+        if input_ids.dim() == 2:
+            assert input_ids.shape[0] == 1
+            input_ids = input_ids[0]
+        if request_id is None:
+            request_id = self._next_request_id
+        self._next_request_id += 1
+        request = GenerationRequest(
+            request_id,
+            input_ids.to(self.device),
+            max_new_tokens,
+            eos_token_id=eos_token_id,
+            sampling_params=sampling_params,
+        )
+        self.scheduler.add_request(request)
+        return request
+
+    def _get_logits(self, input_ids, position_ids):
+        logits = self.model(
+            input_ids,
+            position_ids=position_ids,
+            inference_params=self.inference_params,
+            num_last_tokens=1,
+        ).logits[:, -1]
+        return logits[..., : self.vocab_size] if self.vocab_size is not None else logits
+
+    def _prefill(self, request):
+        """Prefill the next prefill_chunk_size tokens of the request (all of them if None).
+        Return True when the prefill is done."""
+        params = self.inference_params
+        input_ids = request.input_ids
+        if request.output_ids:  # Resumed after preemption, the last token is already sampled
+            output_ids = torch.tensor(request.output_ids[:-1], dtype=torch.long, device=self.device)
+            input_ids = torch.cat([input_ids, output_ids.to(input_ids.dtype)])
+        start = request.num_prefilled
+        end = input_ids.shape[0]
+        if self.prefill_chunk_size is not None:
+            end = min(start + self.prefill_chunk_size, end)
+        params.seqlen_offset = start
+        params.batch_size_offset = request.slot
+        if start == 0:
+            params.lengths_per_sample = None
+            params.cache_batch_idx = None
+            position_ids = None
+        else:
+            # The next chunks attend to the KV cache of the previous ones, with the same
+            # cache_batch_idx and lengths_per_sample as a decoding step
+            params.lengths_per_sample = torch.full(
+                (1,), start, dtype=torch.int32, device=self.device
+            )
+            params.cache_batch_idx = torch.full(
+                (1,), request.slot, dtype=torch.int32, device=self.device
+            )
+            position_ids = torch.arange(start, end, dtype=torch.long, device=self.device)[None]
+        logits = self._get_logits(input_ids[None, start:end], position_ids)
+        params.batch_size_offset = 0
+        request.num_prefilled = end
+        if end < input_ids.shape[0]:
+            return False
+        self.lengths[request.slot] = input_ids.shape[0]
+        if request.output_ids:
+            self.last_tokens[request.slot] = request.output_ids[-1]
+            return True
+        token = self._sample(logits, [request])
+        self.last_tokens[request.slot] = token[0]
+        request.append_token(token[0].item())
+        return True
+
+    def _sample(self, logits, requests):
+        """Sample the next token of each request with its own sampling parameters. The random
+        stream of a request is indexed by the position of the token, so its tokens don't depend
+        on when it's scheduled, preempted or how its prefill is chunked."""
+        params = [r.sampling_params for r in requests]
+        kwargs = {
+            name: torch.tensor([getattr(p, name) for p in params], device=self.device)
+            for name in ["top_k", "top_p", "min_p", "temperature", "seed"]
+        }
+        offset = [r.input_ids.shape[0] + len(r.output_ids) for r in requests]
+        if any(p.repetition_penalty != 1.0 for p in params):
+            kwargs["repetition_penalty"] = torch.tensor(
+                [p.repetition_penalty for p in params], device=self.device
+            )
+            prev_tokens = torch.full(
+                (len(requests), max(offset)), -1, dtype=torch.long, device=self.device
+            )
+            for i, request in enumerate(requests):
+                prompt_len = request.input_ids.shape[0]
+                prev_tokens[i, :prompt_len] = request.input_ids
+                prev_tokens[i, prompt_len : offset[i]] = torch.tensor(
+                    request.output_ids, dtype=torch.long
+                )
+            kwargs["prev_tokens"] = prev_tokens
+        offset = torch.tensor(offset, dtype=torch.long, device=self.device)
+        return sample_batched(logits, offset=offset, **kwargs)
+
+    def _swap_in(self, request):
+        self.offloader.swap_in(request.request_id, request.slot)
+        request.swapped = False
+        self.lengths[request.slot] = request.seqlen
+        self.last_tokens[request.slot] = request.output_ids[-1]
+
+    def preempt(self, num_slots=1, requests=None):
+        """Preempt requests to free num_slots slots, chosen by the preemption policy among the
+        running requests (or the given requests). Their KV cache is swapped out to host memory if
+        the policy says so, otherwise it will be recomputed. Return the preempted requests."""
+        if requests is None:
+            running = [self.scheduler.running[slot] for slot in self.scheduler.active_slots()]
+            requests = self.preemption_policy.select(running, num_slots)
+        for request in requests:
+            assert not request.finished and request.slot is not None
+            if request.prefilling:  # Only part of the prompt is in the KV cache, start over
+                request.prefilling, request.num_prefilled = False, 0
+            elif self.preemption_policy.should_swap(request, self.offloader):
+                self.offloader.swap_out(request.request_id, request.slot, request.seqlen)
+                request.swapped = True
+            self.scheduler.preempt(request)
+        return requests
+
+    def _decode(self, requests):
+        params = self.inference_params
+        slots = torch.tensor([r.slot for r in requests], dtype=torch.long, device=self.device)
+        lengths = self.lengths[slots]
+        # Only used to tell prefill from decoding, each sequence uses its own lengths_per_sample
+        params.seqlen_offset = max(r.seqlen for r in requests)
+        params.lengths_per_sample = lengths
+        params.cache_batch_idx = slots.to(torch.int32)
+        logits = self._get_logits(
+            self.last_tokens[slots].unsqueeze(1), lengths.unsqueeze(1).to(torch.long)
+        )
+        tokens = self._sample(logits, requests)
+        self.lengths[slots] = lengths + 1
+        self.last_tokens[slots] = tokens
+        for request, token in zip(requests, tokens.tolist()):
+            request.append_token(token)
+
+    @torch.inference_mode()
+    def step(self):
+        """Admit waiting requests, run the next chunk of the prefills in progress, then run one
+        decoding step for all active requests.
+        Return the list of requests that finished during this step."""
+        for request in self.scheduler.schedule():
+            if self.offloader is not None:
+                # The slot might still be being copied to the host
+                self.offloader.wait([request.slot])
+            if request.swapped:
+                self._swap_in(request)
+            else:
+                request.prefilling, request.num_prefilled = True, 0
+        for slot in self.scheduler.prefilling_slots():
+            request = self.scheduler.running[slot]
+            if self._prefill(request):
+                request.prefilling = False
+        active = [self.scheduler.running[slot] for slot in self.scheduler.active_slots()]
+        if active:
+            if self.offloader is not None:
+                self.offloader.wait([request.slot for request in active])
+            self._decode(active)
+        finished = [r for r in self.scheduler.running.values() if r.finished]
+        for request in finished:
+            self.scheduler.release(request)
+        return finished
+
+    def generate(self):
+        """Run until all requests are finished. Return {request_id: output_ids}."""
+        outputs = {}
+        while self.scheduler.has_unfinished():
+            for request in self.step():
+                outputs[request.request_id] = request.output_ids
+        return outputs
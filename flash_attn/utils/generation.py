@@ -1,8 +1,9 @@
 # Copyright (c) 2023, Tri Dao.
 # Adapted from https://github.com/NVIDIA/Megatron-LM/blob/0bb597b42c53355a567aba2a1357cc34b9d99ddd/megatron/text_generation/forward_step.py#L31
+import asyncio
 import gc
 import time
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from dataclasses import dataclass, field
 from functools import partial
 from typing import Callable, Optional, Sequence, Union
@@ -19,6 +20,16 @@ except ImportError:
     GreedySearchDecoderOnlyOutput = namedtuple("GreedySearchDecoderOnlyOutput", ["sequences", "scores"])
     SampleDecoderOnlyOutput = namedtuple("SampleDecoderOnlyOutput", ["sequences", "scores"])
 
+try:
+    from transformers.generation import BeamSearchDecoderOnlyOutput
+except ImportError:
+    BeamSearchDecoderOnlyOutput = namedtuple(
+        "BeamSearchDecoderOnlyOutput", ["sequences", "sequences_scores"]
+    )
+
+
+DecodeStreamOutput = namedtuple("DecodeStreamOutput", ["tokens", "scores", "finished"])
+
 
 @dataclass
 class InferenceParams:
@@ -31,6 +42,28 @@ class InferenceParams:
     batch_size_offset: int = 0
     key_value_memory_dict: dict = field(default_factory=dict)
     lengths_per_sample: Optional[Tensor] = None
+    # (batch_size,), dtype torch.int32. Which row of the KV cache each sequence in the batch uses.
+    # If None, sequence i uses row batch_size_offset + i.
+    cache_batch_idx: Optional[Tensor] = None
+    # (batch_size, max_num_blocks_per_seq), dtype torch.int32. If not None, the KV cache of each
+    # layer is paged, of shape (num_blocks, block_size, 2, nheads, headdim), and this is the list of
+    # blocks of each sequence. See flash_attn.utils.paged_kv_cache.
+    block_table: Optional[Tensor] = None
+    # (seqlen, seqlen), dtype torch.bool. If not None, the seqlen new tokens are the nodes of a
+    # tree (in topological order) instead of a sequence: tree_mask[i, j] is True iff token j is
+    # token i or one of its ancestors. Each token attends to the cached tokens and to its
+    # ancestors, and its position is the number of cached tokens plus its depth.
+    # Used by decode_speculative_tree.
+    tree_mask: Optional[Tensor] = None
+    # If not None (torch.int8 or fp8), the KV cache allocated on first use is quantized to this
+    # dtype, with one scale per kv_cache_quant_group_size channels of each head (default: one
+    # scale per head). See flash_attn.utils.quantized_kv_cache.
+    kv_cache_quant_dtype: Optional[torch.dtype] = None
+    kv_cache_quant_group_size: Optional[int] = None
+    # If True, the layers with sliding window local attention (window_size[0] >= 0) only keep the
+    # last window_size[0] tokens in a ring buffer, so that the memory of their KV cache doesn't
+    # grow with the sequence length. Requires the same seqlen_offset for the whole batch.
+    sliding_window_kv_cache: bool = False
 
     def reset(self, max_seqlen, max_batch_size):
         self.max_seqlen = max_seqlen
@@ -95,8 +128,180 @@ def sample(logits, top_k=1, top_p=0.0, temperature=1.0):
             )
 
 
+@dataclass
+class SamplingParams:
+    """Sampling parameters of one sequence, see sample_batched.
+    seed: if not None, the sequence is sampled from its own random stream, so that its tokens
+        don't depend on the other sequences in the batch.
+    """
+
+    top_k: int = 1
+    top_p: float = 0.0
+    min_p: float = 0.0
+    temperature: float = 1.0
+    repetition_penalty: float = 1.0
+    seed: Optional[int] = None
+
+    @property
+    def greedy(self):
+        return self.top_k == 1 or self.temperature == 0.0
+
+
+def _per_row(value, default, batch_size, dtype, device):
+    value = default if value is None else value
+    return torch.as_tensor(value, dtype=dtype, device=device).expand(batch_size)
+
+
+def _hash32(x):
+    """Integer hash (lowbias32) of x, elementwise. x: int64 tensor. Return values in [0, 2**32)."""
+    mask = 0xFFFFFFFF
+    x = x & mask
+    x = x ^ (x >> 16)
+    x = (x * 0x7FEB352D) & mask
+    x = x ^ (x >> 15)
+    x = (x * 0x846CA68B) & mask
+    return x ^ (x >> 16)
+
+
+def random_uniform_per_row(seed, offset):
+    """Counter-based random numbers: one uniform in [0, 1) for each row, that only depends on the
+    seed and offset of that row (e.g. the position of the token being sampled), so each row has
+    its own reproducible stream whatever the batch it's in and on any device.
+    seed, offset: (batch_size,) int64 tensors.
+    Return: (batch_size,) float32
+    """
+    x = _hash32(seed ^ _hash32(offset))
+    x = _hash32((seed >> 32) ^ x)
+    return (x >> 8).float() / 2**24
+
+
+def sample_batched(
+    logits,
+    top_k=None,
+    top_p=None,
+    min_p=None,
+    temperature=None,
+    repetition_penalty=None,
+    prev_tokens=None,
+    seed=None,
+    offset=None,
+    generator=None,
+):
+    """Sample with different parameters for each row of the batch, without branching on them:
+    a single sort of the logits, then masking, then inverse transform sampling.
+    Rows with top_k == 1 or temperature == 0 are greedy (argmax).
+    Arguments:
+        logits: (batch_size, vocab_size)
+        top_k, top_p, min_p, temperature, repetition_penalty: scalars or (batch_size,) tensors,
+            same meaning as in sample, None means disabled (top_k = 0 for top_k).
+            min_p: keep the tokens with probability at least min_p times the largest one.
+            repetition_penalty: divide the positive logits (multiply the negative ones) of the
+            tokens in prev_tokens by repetition_penalty, as in the CTRL paper.
+        prev_tokens: (batch_size, seqlen), the previous tokens of each row, padded with -1.
+        seed, offset: (batch_size,) int64 tensors. If seed is provided, row i is sampled with the
+            random number random_uniform_per_row(seed[i], offset[i]) (offset defaults to 0).
+            Otherwise the random numbers are drawn from generator (default: the global one).
+    Return: (batch_size,) int64
+    """
+    batch_size, vocab_size = logits.shape
+    device = logits.device
+    logits = logits.float()
+    if repetition_penalty is not None and prev_tokens is not None:
+        penalty = _per_row(repetition_penalty, 1.0, batch_size, torch.float32, device)[:, None]
+        seen = torch.zeros(batch_size, vocab_size, dtype=torch.int32, device=device)
+        seen.scatter_add_(1, prev_tokens.clamp(min=0), (prev_tokens >= 0).int())
+        penalized = torch.where(logits > 0, logits / penalty, logits * penalty)
+        logits = torch.where(seen > 0, penalized, logits)
+    greedy_tokens = logits.argmax(dim=-1)
+    if not torch.is_tensor(top_k) and not torch.is_tensor(temperature):
+        if top_k == 1 or temperature == 0.0:  # Short-circuit for greedy decoding
+            return greedy_tokens
+    top_k = _per_row(top_k, 0, batch_size, torch.long, device)
+    temperature = _per_row(temperature, 1.0, batch_size, torch.float32, device)
+    greedy = (top_k == 1) | (temperature == 0.0)
+    logits = logits / temperature.masked_fill(greedy, 1.0)[:, None]
+    sorted_logits, sorted_indices = torch.sort(logits, dim=-1, descending=True)
+    probs = sorted_logits.softmax(dim=-1)
+    ranks = torch.arange(vocab_size, device=device)
+    # The most likely token is never removed
+    remove = (top_k[:, None] > 0) & (ranks >= top_k[:, None])
+    if top_p is not None:
+        top_p = _per_row(top_p, 0.0, batch_size, torch.float32, device)[:, None]
+        # As in sample, top-p applies to the probabilities renormalized after top-k
+        probs_top_k = probs.masked_fill(remove, 0.0)
+        probs_top_k = probs_top_k / probs_top_k.sum(dim=-1, keepdim=True)
+        cumulative_probs_before = probs_top_k.cumsum(dim=-1) - probs_top_k
+        remove |= (top_p > 0.0) & (top_p < 1.0) & (cumulative_probs_before >= top_p)
+    if min_p is not None:
+        min_p = _per_row(min_p, 0.0, batch_size, torch.float32, device)[:, None]
+        remove |= probs < min_p * probs[:, :1]
+    remove[:, 0] = False
+    cumulative_probs = probs.masked_fill(remove, 0.0).cumsum(dim=-1)
+    if seed is not None:
+        offset = _per_row(offset, 0, batch_size, torch.long, device)
+        uniform = random_uniform_per_row(seed.to(device=device, dtype=torch.long), offset)
+    else:
+        uniform = torch.rand(batch_size, device=device, generator=generator)
+    # Index of the first token whose cumulative probability is above u * total
+    threshold = (uniform * cumulative_probs[:, -1])[:, None]
+    idx = torch.searchsorted(cumulative_probs, threshold, right=True).clamp(max=vocab_size - 1)
+    tokens = sorted_indices.gather(1, idx).squeeze(1)
+    return torch.where(greedy, greedy_tokens, tokens)
+
+
+def compact_kv_cache_batch(inference_params, keep):
+    """Move the rows keep (a 1D tensor of int, in increasing order) of the KV cache of every layer
+    and of lengths_per_sample to the first len(keep) rows, e.g. to drop the finished sequences from
+    the batch. Only the first seqlen_offset tokens of each row are moved.
+    """
+    assert inference_params.block_table is None, "Paged KV cache is not supported"
+    assert inference_params.cache_batch_idx is None
+    num_rows = keep.shape[0]
+    for kv_cache in inference_params.key_value_memory_dict.values():
+        # The ring buffer KV cache has fewer than seqlen_offset tokens
+        seqlen = min(inference_params.seqlen_offset, kv_cache.shape[1])
+        # Indexing with a tensor makes a copy, so the source and destination can overlap
+        kv_cache[:num_rows, :seqlen] = kv_cache[keep.to(kv_cache.device), :seqlen]
+    if inference_params.lengths_per_sample is not None:
+        lengths = inference_params.lengths_per_sample
+        lengths[:num_rows] = lengths[keep.to(lengths.device)]
+
+
+def reorder_kv_cache_batch(inference_params, batch_idx):
+    """Set row i of the KV cache of every layer (and of lengths_per_sample) to row batch_idx[i],
+    e.g. to follow the beams selected by beam search. Only the rows that change are copied, and
+    only their first seqlen_offset tokens.
+    batch_idx: (batch_size,) int64
+    """
+    assert inference_params.block_table is None, "Paged KV cache is not supported"
+    assert inference_params.cache_batch_idx is None
+    rows = (batch_idx != torch.arange(batch_idx.shape[0], device=batch_idx.device)).nonzero()[:, 0]
+    if rows.shape[0] == 0:
+        return
+    src_rows = batch_idx[rows]
+    for kv_cache in inference_params.key_value_memory_dict.values():
+        seqlen = min(inference_params.seqlen_offset, kv_cache.shape[1])
+        dst, src = rows.to(kv_cache.device), src_rows.to(kv_cache.device)
+        # Indexing with a tensor makes a copy, so the source and destination can overlap
+        kv_cache[dst, :seqlen] = kv_cache[src, :seqlen]
+    if inference_params.lengths_per_sample is not None:
+        lengths = inference_params.lengths_per_sample
+        lengths[rows.to(lengths.device)] = lengths[src_rows.to(lengths.device)]
+
+
+def _stop_sequences_matched(recent_tokens, num_generated, stop_sequences):
+    """recent_tokens: (batch, max stop sequence length), the last tokens generated by each row.
+    Return: (batch,) bool, True for the rows whose generated tokens end with a stop sequence."""
+    matched = torch.zeros(recent_tokens.shape[0], dtype=torch.bool, device=recent_tokens.device)
+    for stop_sequence in stop_sequences:
+        length = stop_sequence.shape[0]
+        if num_generated >= length:
+            matched |= (recent_tokens[:, -length:] == stop_sequence).all(dim=-1)
+    return matched
+
+
 @torch.inference_mode()
-def decode(
+def decode_stream(
     input_ids,
     model,
     max_length,
@@ -109,25 +314,62 @@ def decode(
     tensor_parallel=1,
     cg=False,
     enable_timing=False,
+    prefix_cache=None,
+    kv_cache_quant_dtype=None,
+    kv_cache_quant_group_size=None,
+    sliding_window_kv_cache=False,
+    prefill_chunk_size=None,
+    stopping_criteria=None,
+    stop_sequences=None,
+    stream_interval=1,
+    stop_when_all_finished=True,
+    compact_interval=None,
+    pad_token_id=None,
+    output_scores=True,
+    stop_check_interval=8,
 ):
-    """Decoding, either greedy or with top-k or top-p sampling.
-    If top-k = 0, don't limit the number of candidates (pure sampling).
-    Top-k and top-p can be used together. If top_k > 0 and top_p > 0, then top-k is applied first,
-    then top-p.
-    We assume that all sequences in the same batch have the same length.
+    """Same as decode, but a generator that yields the new tokens as soon as they're sampled, e.g.
+    to stream them to the user: the first token is yielded right after the prefill. Stop iterating
+    (or call close()) to cancel the generation, the KV cache is only referenced by the generator.
 
-    Arguments:
-        input_ids: (batch, seq_len)
-        max_length: int
-        teacher_outputs (optional): (batch, seq_len). If provided, instead of sampling from the
-            logits, the next token is taken from the teacher_outputs. Useful for testing.
-    Returns: GreedySearchDecoderOnlyOutput or SampleDecoderOnlyOutput, with the following fields:
-        sequences: (batch, max_length)
-        scores: tuples of (batch, vocab_size)
+    Arguments: same as decode, and
+        stopping_criteria (optional): callable that takes the tokens just sampled, (batch,), and
+            returns a (batch,) bool tensor, True for the rows that are finished (e.g. they've
+            generated a stop sequence). It's called once per step and can keep state.
+        stop_sequences (optional): list of lists of token ids. A row is finished once its
+            generated tokens end with one of them.
+        stream_interval: yield every stream_interval tokens (and the remaining ones when decoding
+            stops). Larger values mean fewer, larger chunks.
+        stop_when_all_finished: if True, stop as soon as every row is finished, i.e. has sampled
+            eos_token_id or met stopping_criteria. If False (as in decode), stop when all the rows
+            sample eos_token_id at the same step, or at max_length.
+            If True, the tokens generated by the rows after they're finished are pad_token_id
+            (default: eos_token_id, or 0).
+        compact_interval (optional): every compact_interval steps, remove the finished rows from
+            the batch (and their KV cache and lengths_per_sample rows) so that the next steps run
+            with a smaller batch. Requires stop_when_all_finished and no CUDA graph.
+        output_scores: if False, don't keep the scores (the logits of each step).
+        stop_check_interval: whether decoding should stop (eos_token_id, stopping_criteria,
+            stop_sequences) is computed on device, and only read by the host every
+            stop_check_interval steps (and before yielding), since each read waits for the device.
+            The tokens generated after the stop are dropped, so the outputs don't depend on it.
+            Larger values mean fewer syncs, but up to stop_check_interval - 1 extra steps.
+    Yields: DecodeStreamOutput with the following fields:
+        tokens: (batch, n), the n <= stream_interval new tokens
+        scores: tuple of n (batch, vocab_size), None if not output_scores
+        finished: (batch,) bool, the rows that are finished. Their later tokens should be ignored.
+            The scores of the rows removed from the batch are 0.
     """
     batch_size, seqlen_og = input_ids.shape
+    if compact_interval is not None:
+        assert stop_when_all_finished, "Compacting the batch requires stop_when_all_finished"
+        assert not cg, "CUDA graph doesn't support compacting the batch"
+    if pad_token_id is None:
+        pad_token_id = eos_token_id if eos_token_id is not None else 0
     teacher_output_len = teacher_outputs.shape[1] if teacher_outputs is not None else 0
     if cg:
+        assert kv_cache_quant_dtype is None, "CUDA graph doesn't support quantized KV cache"
+        assert not sliding_window_kv_cache, "CUDA graph doesn't support ring buffer KV cache"
         if not hasattr(model, "_decoding_cache"):
             model._decoding_cache = None
         model._decoding_cache = update_graph_cache(
@@ -141,20 +383,54 @@ def decode(
         inference_params = model._decoding_cache.inference_params
         inference_params.reset(max_length, batch_size)
     else:
-        inference_params = InferenceParams(max_seqlen=max_length, max_batch_size=batch_size)
+        inference_params = InferenceParams(
+            max_seqlen=max_length,
+            max_batch_size=batch_size,
+            kv_cache_quant_dtype=kv_cache_quant_dtype,
+            kv_cache_quant_group_size=kv_cache_quant_group_size,
+            sliding_window_kv_cache=sliding_window_kv_cache,
+        )
+        if prefix_cache is not None:
+            assert not sliding_window_kv_cache, "Prefix cache needs the KV cache of all the tokens"
+            # The KV cache needs to exist before we can copy the cached prefix into it
+            quant_kwargs = (
+                dict(
+                    kv_cache_quant_dtype=kv_cache_quant_dtype,
+                    kv_cache_quant_group_size=kv_cache_quant_group_size,
+                )
+                if kv_cache_quant_dtype is not None
+                else {}
+            )
+            inference_params.key_value_memory_dict = model.allocate_inference_cache(
+                batch_size, max_length, **quant_kwargs
+            )
 
     def get_logits(input_ids, inference_params):
+        if prefill_chunk_size is not None and input_ids.shape[1] > prefill_chunk_size:
+            seqlen_offset = inference_params.seqlen_offset
+            chunks = input_ids.split(prefill_chunk_size, dim=1)
+            for chunk in chunks:
+                if inference_params.lengths_per_sample is not None:
+                    inference_params.lengths_per_sample[:] = inference_params.seqlen_offset
+                # Only the logits of the last chunk are needed
+                logits = get_logits(chunk, inference_params)
+                inference_params.seqlen_offset += chunk.shape[1]
+            inference_params.seqlen_offset = seqlen_offset
+            if inference_params.lengths_per_sample is not None:
+                inference_params.lengths_per_sample[:] = seqlen_offset
+            return logits
         decoding = inference_params.seqlen_offset > 0
         if decoding:
-            position_ids = torch.full(
-                (batch_size, 1),
-                inference_params.seqlen_offset,
-                dtype=torch.long,
-                device=input_ids.device,
+            position_ids = repeat(
+                torch.arange(input_ids.shape[1], dtype=torch.long, device=input_ids.device)
+                + inference_params.seqlen_offset,
+                "s -> b s",
+                b=input_ids.shape[0],
             )
         else:
             position_ids = None
-        if not cg or not decoding:
+        # The prefill of the part of the prompt that's not in the prefix cache has seqlen > 1
+        if not cg or not decoding or input_ids.shape[1] > 1:
             logits = model(
                 input_ids,
                 position_ids=position_ids,
@@ -172,14 +448,14 @@ def decode(
             token = sample(logits, top_k=top_k, top_p=top_p, temperature=temperature)
         else:
             token = teacher_outputs[:, inference_params.seqlen_offset]
+            if rows is not None:
+                token = token[rows]
         # return rearrange(token, "b -> b 1")
         return token.unsqueeze(1)
 
-    def should_stop(current_token, inference_params):
+    def should_stop(inference_params):
         if inference_params.seqlen_offset == 0:
             return False
-        if eos_token_id is not None and (current_token == eos_token_id).all():
-            return True
         if inference_params.seqlen_offset >= max_length - 1:
             return True
         return False
@@ -191,19 +467,447 @@ def decode(
         if tensor_parallel > 1:
             torch.distributed.barrier()
         start.record()
-    scores, sequences = [], [input_ids]
-    while not should_stop(sequences[-1], inference_params):
-        scores.append(get_logits(sequences[-1], inference_params))
-        inference_params.seqlen_offset += sequences[-1].shape[1]
-        sequences.append(sample_tokens(scores[-1], inference_params))
+    device = input_ids.device
+    # Output buffers, written in place at every step. The scores are kept in a list instead: a
+    # (max_new_tokens, batch, vocab_size) buffer could take many GBs, even if decoding stops early.
+    max_new_tokens = max(max_length - seqlen_og, 1)
+    tokens = torch.full(
+        (batch_size, max_new_tokens), pad_token_id, dtype=input_ids.dtype, device=device
+    )
+    scores = []
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    finished_per_step = torch.zeros(max_new_tokens, batch_size, dtype=torch.bool, device=device)
+    # Whether decoding should stop after each step, only read by the host every
+    # stop_check_interval steps to avoid a sync per token
+    stop_per_step = torch.zeros(max_new_tokens, dtype=torch.bool, device=device)
+    can_stop = (
+        eos_token_id is not None or stopping_criteria is not None or stop_sequences is not None
+    )
+    # The rows of the batch that are still decoded, None if the batch was never compacted
+    rows = None
+    num_generated, num_checked, num_yielded, stopped = 0, 0, 0, False
+    if stop_sequences is not None:
+        stop_sequences = [
+            torch.tensor(seq, dtype=torch.long, device=device) for seq in stop_sequences
+        ]
+        recent_tokens = torch.full(
+            (batch_size, max(seq.shape[0] for seq in stop_sequences)),
+            -1,
+            dtype=torch.long,
+            device=device,
+        )
+
+    def add_token(token, logits):
+        """Write the token (batch, 1) sampled from logits to the output buffers."""
+        nonlocal finished, num_generated, recent_tokens
+        step = num_generated
+        if rows is not None:
+            token = token.new_full((batch_size, 1), pad_token_id).index_copy_(0, rows, token)
+        if stop_when_all_finished:
+            token = token.masked_fill(finished[:, None], pad_token_id)
+        if output_scores:
+            if rows is not None:
+                logits = logits.new_zeros(batch_size, logits.shape[-1]).index_copy_(0, rows, logits)
+            scores.append(logits)
+        tokens[:, step] = token[:, 0]
+        num_generated += 1
+        if eos_token_id is not None:
+            finished = finished | (token[:, 0] == eos_token_id)
+        if stopping_criteria is not None:
+            finished = finished | stopping_criteria(token[:, 0]).to(device)
+        if stop_sequences is not None:
+            recent_tokens = torch.cat([recent_tokens[:, 1:], token], dim=1)
+            finished = finished | _stop_sequences_matched(
+                recent_tokens, num_generated, stop_sequences
+            )
+        finished_per_step[step] = finished
+        if stop_when_all_finished:
+            stop_per_step[step] = finished.all()
+        elif eos_token_id is not None:
+            stop_per_step[step] = (token[:, 0] == eos_token_id).all()
+
+    def check_stop():
+        """Read the stop flags of the steps since the last check (one sync with the device).
+        If decoding should have stopped, drop the tokens generated after that."""
+        nonlocal num_generated, num_checked, stopped
+        if can_stop and num_generated > num_checked:
+            stop_steps = stop_per_step[num_checked:num_generated].nonzero()
+            if stop_steps.shape[0] > 0:
+                num_generated = num_checked + stop_steps[0, 0].item() + 1
+                stopped = True
+        num_checked = num_generated
+
+    def next_chunk(last=False):
+        """Return the next DecodeStreamOutput if it's ready, otherwise None."""
+        nonlocal num_yielded
+        if (
+            last
+            or num_generated - num_checked >= stop_check_interval
+            or num_generated - num_yielded >= stream_interval
+        ):
+            check_stop()
+        if num_generated == num_yielded or not (
+            last or stopped or num_generated - num_yielded >= stream_interval
+        ):
+            return None
+        chunk = DecodeStreamOutput(
+            tokens=tokens[:, num_yielded:num_generated],
+            scores=tuple(scores[num_yielded:num_generated]) if output_scores else None,
+            finished=finished_per_step[num_generated - 1],
+        )
+        num_yielded = num_generated
+        return chunk
+
+    def compact(current_token):
+        """Remove the finished rows from the batch. Return the tokens of the remaining rows."""
+        nonlocal rows
+        current_rows = rows if rows is not None else torch.arange(batch_size, device=device)
+        keep = (~finished[current_rows]).nonzero()[:, 0]
+        if 0 < keep.shape[0] < current_rows.shape[0]:
+            compact_kv_cache_batch(inference_params, keep)
+            rows = current_rows[keep]
+            current_token = current_token[keep]
+        return current_token
+
+    current_token = input_ids
+    if prefix_cache is not None:
+        num_cached = prefix_cache.load(input_ids, inference_params)
+        if num_cached > 0:
+            if inference_params.lengths_per_sample is not None:
+                inference_params.lengths_per_sample[:] = num_cached
+            inference_params.seqlen_offset = num_cached
+            logits = get_logits(input_ids[:, num_cached:], inference_params)
+            inference_params.seqlen_offset = seqlen_og
+            prefix_cache.store(input_ids, inference_params)
+            current_token = sample_tokens(logits, inference_params)
+            add_token(current_token, logits)
+            chunk = next_chunk()
+            if chunk is not None:
+                yield chunk
+    while not stopped and not should_stop(inference_params):
+        if (
+            compact_interval is not None
+            and num_generated > 0
+            and num_generated % compact_interval == 0
+        ):
+            current_token = compact(current_token)
+        logits = get_logits(current_token, inference_params)
+        inference_params.seqlen_offset += current_token.shape[1]
+        if prefix_cache is not None and current_token is input_ids:
+            prefix_cache.store(input_ids, inference_params)
+        current_token = sample_tokens(logits, inference_params)
+        add_token(current_token, logits)
+        chunk = next_chunk()
+        if chunk is not None:
+            yield chunk
     if enable_timing:
         end.record()
         if tensor_parallel > 1:
             torch.distributed.barrier()
         torch.cuda.synchronize()
         print(f"Prompt processing + decoding time: {(start.elapsed_time(end)):.0f}ms")
+    chunk = next_chunk(last=True)
+    if chunk is not None:
+        yield chunk
+
+
+@torch.inference_mode()
+def decode(
+    input_ids,
+    model,
+    max_length,
+    top_k=1,
+    top_p=0.0,
+    temperature=1.0,
+    eos_token_id=None,
+    teacher_outputs=None,
+    vocab_size=None,
+    tensor_parallel=1,
+    cg=False,
+    enable_timing=False,
+    prefix_cache=None,
+    kv_cache_quant_dtype=None,
+    kv_cache_quant_group_size=None,
+    sliding_window_kv_cache=False,
+    prefill_chunk_size=None,
+    stop_sequences=None,
+    compact_interval=None,
+    pad_token_id=None,
+    output_scores=True,
+    stop_check_interval=8,
+):
+    """Decoding, either greedy or with top-k or top-p sampling.
+    If top-k = 0, don't limit the number of candidates (pure sampling).
+    Top-k and top-p can be used together. If top_k > 0 and top_p > 0, then top-k is applied first,
+    then top-p.
+    We assume that all sequences in the same batch have the same length.
+    See decode_stream to get the tokens as they're generated.
+
+    Arguments:
+        input_ids: (batch, seq_len)
+        max_length: int
+        teacher_outputs (optional): (batch, seq_len). If provided, instead of sampling from the
+            logits, the next token is taken from the teacher_outputs. Useful for testing.
+        prefix_cache (optional): flash_attn.utils.prefix_cache.PrefixCache. If provided, the KV
+            cache of the longest prompt prefix found in prefix_cache is reused and only the rest of
+            the prompt is prefilled. The KV cache of the prompt is then added to prefix_cache.
+        kv_cache_quant_dtype (optional): torch.int8 or fp8. If provided, the KV cache is quantized
+            to this dtype with one scale per kv_cache_quant_group_size channels of each head
+            (default: per head), see flash_attn.utils.quantized_kv_cache.
+        sliding_window_kv_cache (optional): if True, the layers with sliding window local attention
+            keep their KV cache in a ring buffer of the size of the window, so that memory doesn't
+            grow with the length of the generation.
+        prefill_chunk_size (optional): if provided, the prompt is prefilled in chunks of this many
+            tokens, each one attending to the KV cache of the previous ones, to bound the
+            activation memory of the prefill of long prompts.
+        stop_sequences (optional): list of lists of token ids. A row is finished once its
+            generated tokens end with one of them (or with eos_token_id).
+        compact_interval (optional): every compact_interval steps, remove the finished rows from
+            the batch, with their KV cache, so that the next steps run with a smaller batch.
+        If stop_sequences or compact_interval is provided, each row stops on its own: the tokens
+        after it's finished are pad_token_id (default: eos_token_id, or 0), and decoding stops
+        once all the rows are finished. Otherwise, decoding stops when all the rows sample
+        eos_token_id at the same step.
+        output_scores: if False, don't keep the scores, and the output scores are None.
+        stop_check_interval: only check whether decoding should stop every stop_check_interval
+            steps, to limit the syncs with the device, see decode_stream.
+    Returns: GreedySearchDecoderOnlyOutput or SampleDecoderOnlyOutput, with the following fields:
+        sequences: (batch, max_length)
+        scores: tuples of (batch, vocab_size)
+    """
+    scores, sequences = [], [input_ids]
+    for output in decode_stream(
+        input_ids,
+        model,
+        max_length,
+        top_k=top_k,
+        top_p=top_p,
+        temperature=temperature,
+        eos_token_id=eos_token_id,
+        teacher_outputs=teacher_outputs,
+        vocab_size=vocab_size,
+        tensor_parallel=tensor_parallel,
+        cg=cg,
+        enable_timing=enable_timing,
+        prefix_cache=prefix_cache,
+        kv_cache_quant_dtype=kv_cache_quant_dtype,
+        kv_cache_quant_group_size=kv_cache_quant_group_size,
+        sliding_window_kv_cache=sliding_window_kv_cache,
+        prefill_chunk_size=prefill_chunk_size,
+        stop_sequences=stop_sequences,
+        # Only yield once at the end
+        stream_interval=max_length,
+        stop_when_all_finished=stop_sequences is not None or compact_interval is not None,
+        compact_interval=compact_interval,
+        pad_token_id=pad_token_id,
+        output_scores=output_scores,
+        stop_check_interval=stop_check_interval,
+    ):
+        sequences.append(output.tokens)
+        if output_scores:
+            scores.extend(output.scores)
     output_cls = GreedySearchDecoderOnlyOutput if top_k == 1 else SampleDecoderOnlyOutput
-    return output_cls(sequences=torch.cat(sequences, dim=1), scores=tuple(scores))
+    return output_cls(
+        sequences=torch.cat(sequences, dim=1), scores=tuple(scores) if output_scores else None
+    )
+
+
+async def decode_stream_async(*args, executor=None, **kwargs):
+    """Async iterator version of decode_stream (same arguments), for asyncio servers: each step
+    runs in executor (default: the loop's default executor) so that the event loop isn't blocked.
+    Cancelling the task that iterates (or breaking out of the loop) cancels the generation, once
+    the step in progress is done.
+    """
+    loop = asyncio.get_running_loop()
+    stream = decode_stream(*args, **kwargs)
+    done = object()
+    step = None
+    try:
+        while True:
+            step = loop.run_in_executor(executor, next, stream, done)
+            # Shielded, so that cancelling the task doesn't mark the step as done while it runs
+            output = await asyncio.shield(step)
+            if output is done:
+                break
+            yield output
+    finally:
+        # The step in progress can't be interrupted, and the generator can't be closed while
+        # it's running in another thread
+        if step is not None and not step.done():
+            await asyncio.wait([step])
+        stream.close()
+
+
+class _BeamHypotheses:
+    """The num_beams best finished hypotheses of one sequence of the batch."""
+
+    def __init__(self, num_beams, length_penalty, early_stopping):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.hyps = []  # (score, tokens), sorted by decreasing score
+
+    def add(self, tokens, sum_logprobs, length):
+        score = sum_logprobs / length**self.length_penalty
+        if len(self.hyps) < self.num_beams or score > self.hyps[-1][0]:
+            self.hyps.append((score, tokens))
+            self.hyps.sort(key=lambda hyp: hyp[0], reverse=True)
+            del self.hyps[self.num_beams :]
+
+    def is_done(self, best_sum_logprobs, length):
+        """Whether none of the running beams, whose best log-probability is best_sum_logprobs, can
+        beat the worst hypothesis anymore (with early_stopping, as soon as there are num_beams
+        hypotheses)."""
+        if len(self.hyps) < self.num_beams:
+            return False
+        if self.early_stopping:
+            return True
+        return best_sum_logprobs / length**self.length_penalty <= self.hyps[-1][0]
+
+
+@torch.inference_mode()
+def decode_beam(
+    input_ids,
+    model,
+    max_length,
+    num_beams=4,
+    length_penalty=1.0,
+    early_stopping=False,
+    eos_token_id=None,
+    pad_token_id=None,
+    vocab_size=None,
+):
+    """Beam search. The num_beams beams of each sequence are rows of the batch, and the KV cache
+    rows are reordered after each step to follow the selected beams (see reorder_kv_cache_batch).
+    A beam is finished when it samples eos_token_id. Finished beams are scored by
+    sum of log-probabilities / (number of generated tokens) ** length_penalty, so that
+    length_penalty > 0 favors longer sequences.
+    If early_stopping, a sequence is done as soon as it has num_beams finished beams, otherwise
+    when no running beam can get a better score.
+
+    Arguments:
+        input_ids: (batch, seq_len)
+        max_length: int
+        pad_token_id (optional): pads the sequences shorter than the longest one in the batch
+            (default: eos_token_id, or 0).
+    Returns: BeamSearchDecoderOnlyOutput, with the following fields:
+        sequences: (batch, seq_len + the length of the longest best beam), the best beam of each
+            sequence, including eos_token_id if it finished.
+        sequences_scores: (batch,), the score of the best beam of each sequence.
+    """
+    batch_size, seqlen_og = input_ids.shape
+    device = input_ids.device
+    if pad_token_id is None:
+        pad_token_id = eos_token_id if eos_token_id is not None else 0
+    inference_params = InferenceParams(
+        max_seqlen=max_length, max_batch_size=batch_size * num_beams
+    )
+
+    def get_logprobs(input_ids):
+        position_ids = None
+        if inference_params.seqlen_offset > 0:
+            position_ids = torch.full(
+                (input_ids.shape[0], 1),
+                inference_params.seqlen_offset,
+                dtype=torch.long,
+                device=device,
+            )
+        logits = model(
+            input_ids,
+            position_ids=position_ids,
+            inference_params=inference_params,
+            num_last_tokens=1,
+        ).logits.squeeze(dim=1)
+        logits = logits[..., :vocab_size] if vocab_size is not None else logits
+        return torch.log_softmax(logits.float(), dim=-1)
+
+    # The prompt is the same for all the beams: prefill it once, then copy its KV cache
+    logprobs = get_logprobs(input_ids)
+    inference_params.seqlen_offset = seqlen_og
+    beam_to_batch = torch.arange(batch_size, device=device).repeat_interleave(num_beams)
+    reorder_kv_cache_batch(inference_params, beam_to_batch)
+    logprobs = logprobs[beam_to_batch]
+    vocab = logprobs.shape[-1]
+    sequences = input_ids[beam_to_batch]
+    # All the beams start from the prompt, only keep the candidates of the first one
+    beam_scores = torch.zeros(batch_size, num_beams, device=device)
+    beam_scores[:, 1:] = float("-inf")
+    hypotheses = [
+        _BeamHypotheses(num_beams, length_penalty, early_stopping) for _ in range(batch_size)
+    ]
+    done = [False] * batch_size
+    length = 0  # Number of generated tokens
+    while True:
+        length += 1
+        scores = (beam_scores.view(-1, 1) + logprobs).view(batch_size, num_beams * vocab)
+        # 2 * num_beams candidates, so that there are num_beams left even if num_beams end with EOS
+        top_scores, top_indices = torch.topk(scores, 2 * num_beams, dim=1)
+        top_beams, top_tokens = top_indices // vocab, top_indices % vocab
+        next_scores, next_beams, next_tokens = [], [], []
+        for b, (candidate_scores, candidate_beams, candidate_tokens) in enumerate(
+            zip(top_scores.tolist(), top_beams.tolist(), top_tokens.tolist())
+        ):
+            if done[b]:  # Keep running its beams (the tokens don't matter) until the batch is done
+                next_scores += [0.0] * num_beams
+                # Each beam stays in its row, so its KV cache isn't copied
+                next_beams += list(range(b * num_beams, (b + 1) * num_beams))
+                next_tokens += [0] * num_beams
+                continue
+            num_selected = 0
+            for rank, (score, beam, token) in enumerate(
+                zip(candidate_scores, candidate_beams, candidate_tokens)
+            ):
+                if eos_token_id is not None and token == eos_token_id:
+                    if rank < num_beams:  # Only if it's among the num_beams best candidates
+                        prev_tokens = sequences[b * num_beams + beam, seqlen_og:]
+                        tokens = torch.cat([prev_tokens, prev_tokens.new_tensor([token])])
+                        hypotheses[b].add(tokens, score, length)
+                else:
+                    next_scores.append(score)
+                    next_beams.append(b * num_beams + beam)
+                    next_tokens.append(token)
+                    num_selected += 1
+                if num_selected == num_beams:
+                    break
+            done[b] = hypotheses[b].is_done(max(candidate_scores[:num_beams]), length)
+        beam_scores = torch.tensor(next_scores, device=device).view(batch_size, num_beams)
+        beam_idx = torch.tensor(next_beams, dtype=torch.long, device=device)
+        tokens = torch.tensor(next_tokens, dtype=sequences.dtype, device=device)
+        sequences = torch.cat([sequences[beam_idx], tokens[:, None]], dim=1)
+        if all(done) or seqlen_og + length >= max_length:
+            break
+        reorder_kv_cache_batch(inference_params, beam_idx)
+        logprobs = get_logprobs(tokens[:, None])
+        inference_params.seqlen_offset += 1
+    # The beams still running at max_length are hypotheses too
+    for b in range(batch_size):
+        if not done[b]:
+            for k in range(num_beams):
+                row = b * num_beams + k
+                hypotheses[b].add(sequences[row, seqlen_og:], beam_scores[b, k].item(), length)
+    best = [hyps.hyps[0] for hyps in hypotheses]
+    max_new_tokens = max(tokens.shape[0] for _, tokens in best)
+    output = input_ids.new_full((batch_size, seqlen_og + max_new_tokens), pad_token_id)
+    output[:, :seqlen_og] = input_ids
+    for b, (_, tokens) in enumerate(best):
+        output[b, seqlen_og : seqlen_og + tokens.shape[0]] = tokens
+    return BeamSearchDecoderOnlyOutput(
+        sequences=output,
+        sequences_scores=torch.tensor([score for score, _ in best], device=device),
+    )
+
+
+def _sampling_probs(logits, top_k=1, top_p=0.0, temperature=1.0):
+    """The probabilities that sample(logits, top_k, top_p, temperature) samples from."""
+    if top_p > 0.0:
+        assert top_p <= 1.0, "top-p should be in (0, 1]."
+    # Clone so that when we modify for top_p we don't change the original logits
+    logits = logits / temperature if temperature != 1.0 else logits.clone()
+    if top_k > 0:
+        top_k = min(top_k, logits.size(-1))  # Safety check
+        modify_logits_for_top_k_filtering(logits, top_k)
+    modify_logits_for_top_p_filtering(logits, top_p)
+    return torch.softmax(logits, dim=-1)
 
 
 def sample_speculative(logits, logits_draft, tokens_draft, top_k=1, top_p=0.0, temperature=1.0):
@@ -228,19 +932,8 @@ def sample_speculative(logits, logits_draft, tokens_draft, top_k=1, top_p=0.0, t
     assert tokens_draft.shape == (batch, seqlen)
     assert tokens_draft.dtype in [torch.int64, torch.int32]
     # TODO: if top_k = 1 we can simplify things and only work with indices
-    if top_p > 0.0:
-        assert top_p <= 1.0, "top-p should be in (0, 1]."
-    # Clone so that when we modify for top_p we don't change the original logits
-    logits = logits / temperature if temperature != 1.0 else logits.clone()
-    logits_draft = logits_draft / temperature if temperature != 1.0 else logits_draft.clone()
-    if top_k > 0:
-        top_k = min(top_k, logits.size(-1))  # Safety check
-        modify_logits_for_top_k_filtering(logits, top_k)
-        modify_logits_for_top_k_filtering(logits_draft, top_k)
-    modify_logits_for_top_p_filtering(logits, top_p)
-    modify_logits_for_top_p_filtering(logits_draft, top_p)
-    probs = torch.softmax(logits, dim=-1)
-    probs_draft = torch.softmax(logits_draft, dim=-1)
+    probs = _sampling_probs(logits, top_k=top_k, top_p=top_p, temperature=temperature)
+    probs_draft = _sampling_probs(logits_draft, top_k=top_k, top_p=top_p, temperature=temperature)
     gather = lambda probs, tokens: rearrange(
         probs.gather(dim=-1, index=rearrange(tokens, "... -> ... 1")), "... 1 -> ..."
     )
@@ -261,7 +954,7 @@ def sample_speculative(logits, logits_draft, tokens_draft, top_k=1, top_p=0.0, t
     )
     resample = torch.multinomial(resample_probs, num_samples=1).squeeze(dim=-1)  # (batch,)
     tokens = F.pad(tokens_draft, (0, 1))
-    tokens[:, first_rejected_idx] = resample
+    tokens[torch.arange(batch, device=tokens.device), first_rejected_idx] = resample
     return tokens, first_rejected_idx + 1
 
 
@@ -281,9 +974,11 @@ def decode_speculative(
     cg=False,
     enable_timing=False,
     debug=False,
+    tree_branching=None,
 ):
     """
-    TD: WIP, for my own understanding, lightly tested. Only support batch_size == 1 for now.
+    TD: WIP, for my own understanding, lightly tested. Only support batch_size == 1 for now,
+    batch_size > 1 is handled by decode_speculative_batched.
 
     Speculative decoding, either greedy or with top-k or top-p sampling.
     If top-k = 0, don't limit the number of candidates (pure sampling).
@@ -294,12 +989,45 @@ def decode_speculative(
     Arguments:
         input_ids: (batch, seq_len)
         max_length: int
+        tree_branching: if not None, the draft model proposes a tree of tokens instead of a
+            sequence, see decode_speculative_tree. speculative_lookahead is then ignored.
     Returns: GreedySearchDecoderOnlyOutput or SampleDecoderOnlyOutput, with the following fields:
         sequences: (batch, max_length)
         scores: tuples of (batch, vocab_size)
     """
     batch_size, seqlen_og = input_ids.shape
-    assert batch_size == 1, "Speculative decoding implementation only supports batch_size=1"
+    if tree_branching is not None:
+        assert not cg, "Tree speculative decoding doesn't support CUDA graph"
+        return decode_speculative_tree(
+            input_ids,
+            model,
+            model_draft,
+            max_length,
+            tree_branching=tree_branching,
+            top_k=top_k,
+            top_p=top_p,
+            temperature=temperature,
+            eos_token_id=eos_token_id,
+            vocab_size=vocab_size,
+            tensor_parallel=tensor_parallel,
+            enable_timing=enable_timing,
+        )
+    if batch_size > 1:
+        assert not cg, "Batched speculative decoding doesn't support CUDA graph"
+        return decode_speculative_batched(
+            input_ids,
+            model,
+            model_draft,
+            max_length,
+            speculative_lookahead=speculative_lookahead,
+            top_k=top_k,
+            top_p=top_p,
+            temperature=temperature,
+            eos_token_id=eos_token_id,
+            vocab_size=vocab_size,
+            tensor_parallel=tensor_parallel,
+            enable_timing=enable_timing,
+        )
     assert eos_token_id is None, "Speculative decoding implementation doesn't support eos_token_id"
     if cg:
         if not hasattr(model_draft, "_decoding_cache"):
@@ -563,6 +1291,450 @@ def decode_speculative(
     return output_cls(sequences=sequences, scores=scores)
 
 
+@dataclass
+class SpeculativeDecodingStats:
+    num_main_model_calls: int = 0
+    # (batch_size,), number of draft tokens proposed / accepted for each sequence
+    num_draft_tokens: Optional[Tensor] = None
+    num_accepted_tokens: Optional[Tensor] = None
+
+    @property
+    def acceptance_rate(self):
+        """(batch_size,), fraction of the draft tokens of each sequence that were accepted."""
+        return self.num_accepted_tokens.float() / self.num_draft_tokens.clamp(min=1).float()
+
+
+@torch.inference_mode()
+def decode_speculative_batched(
+    input_ids,
+    model,
+    model_draft,
+    max_length,
+    speculative_lookahead=3,
+    top_k=1,
+    top_p=0.0,
+    temperature=1.0,
+    eos_token_id=None,
+    vocab_size=None,
+    tensor_parallel=1,
+    enable_timing=False,
+    return_stats=False,
+):
+    """Speculative decoding for batch_size >= 1, see decode_speculative.
+    Each sequence accepts a different number of draft tokens at each step, so each sequence
+    has its own length: the KV cache of the main model and of the draft model are indexed with
+    inference_params.lengths_per_sample, and rolling back the rejected draft tokens of a
+    sequence only means setting its length back (the stale KV are overwritten later).
+
+    Arguments:
+        input_ids: (batch, seq_len)
+        max_length: int
+        return_stats: if True, also return a SpeculativeDecodingStats with the number of draft
+            tokens proposed and accepted for each sequence.
+    Returns: GreedySearchDecoderOnlyOutput or SampleDecoderOnlyOutput, with the following fields:
+        sequences: (batch, max_length)
+        scores: (batch, max_length - seq_len, vocab_size)
+    """
+    batch_size, seqlen_og = input_ids.shape
+    assert eos_token_id is None, "Speculative decoding implementation doesn't support eos_token_id"
+    device = input_ids.device
+    # The draft tokens of the last step can go past max_length, they're dropped at the end
+    capacity = max_length + speculative_lookahead + 1
+    inference_params = InferenceParams(
+        max_seqlen=capacity,
+        max_batch_size=batch_size,
+        lengths_per_sample=torch.zeros(batch_size, dtype=torch.int32, device=device),
+    )
+    inference_params_draft = InferenceParams(
+        max_seqlen=capacity,
+        max_batch_size=batch_size,
+        lengths_per_sample=torch.zeros(batch_size, dtype=torch.int32, device=device),
+    )
+
+    def get_logits(model, input_ids, inference_params, cache_seqlens, num_last_tokens=1):
+        """Run model on input_ids, which start at position cache_seqlens (batch,) of each
+        sequence. The KV cache of the tokens before that must already be computed."""
+        inference_params.lengths_per_sample.copy_(cache_seqlens)
+        # seqlen_offset > 0 tells the attention to use lengths_per_sample
+        inference_params.seqlen_offset = int(cache_seqlens.max())
+        position_ids = cache_seqlens[:, None].long() + torch.arange(
+            input_ids.shape[1], dtype=torch.long, device=device
+        )
+        logits = model(
+            input_ids,
+            position_ids=position_ids,
+            inference_params=inference_params,
+            num_last_tokens=num_last_tokens,
+        ).logits
+        return logits[..., :vocab_size] if vocab_size is not None else logits
+
+    sampling_kwargs = dict(top_k=top_k, top_p=top_p, temperature=temperature)
+    sequences = torch.zeros(batch_size, capacity, dtype=input_ids.dtype, device=device)
+    sequences[:, :seqlen_og] = input_ids
+    scores = None
+    lengths = torch.full((batch_size,), seqlen_og, dtype=torch.long, device=device)
+    stats = SpeculativeDecodingStats(
+        num_draft_tokens=torch.zeros(batch_size, dtype=torch.long, device=device),
+        num_accepted_tokens=torch.zeros(batch_size, dtype=torch.long, device=device),
+    )
+    batch_idx = torch.arange(batch_size, device=device)
+
+    if enable_timing:
+        if tensor_parallel > 1:
+            torch.distributed.barrier()
+        torch.cuda.synchronize()
+        start = time.time()
+
+    # Both models get the prompt except the last token, which is passed in at the first step
+    if seqlen_og > 1:
+        zeros = torch.zeros(batch_size, dtype=torch.int32, device=device)
+        get_logits(model, input_ids[:, :-1], inference_params, zeros)
+        get_logits(model_draft, input_ids[:, :-1], inference_params_draft, zeros)
+    # The draft model has the KV cache of all the tokens but the last one at the first step.
+    # After that, it has the KV cache of all the tokens but the last two at least: if all the
+    # draft tokens are accepted, the last one was never passed to the draft model.
+    draft_window = 1
+    while True:
+        unfinished = lengths < max_length
+        if not unfinished.any():
+            break
+        n_spec_tokens = max(min(speculative_lookahead, int((max_length - lengths).max()) - 1), 1)
+        # The sequences that are done still go through the models with the others, but their
+        # length can be up to max_length + speculative_lookahead. We run them from max_length at
+        # most, so that their KV cache and position_ids stay within capacity. Their outputs are
+        # dropped.
+        cur_lengths = lengths.clamp(max=max_length)
+        # Sample from the draft model
+        draft_seqlens = cur_lengths - draft_window
+        cur_tokens = sequences.gather(
+            1, draft_seqlens[:, None] + torch.arange(draft_window, device=device)
+        )
+        tokens_draft, scores_draft = [], []
+        for _ in range(n_spec_tokens):
+            logits_draft = get_logits(
+                model_draft, cur_tokens, inference_params_draft, draft_seqlens.int()
+            )[:, -1]
+            draft_seqlens = draft_seqlens + cur_tokens.shape[1]
+            cur_tokens = sample(logits_draft, **sampling_kwargs).unsqueeze(1)
+            tokens_draft.append(cur_tokens)
+            scores_draft.append(logits_draft)
+        tokens_draft = torch.cat(tokens_draft, dim=1)
+        scores_draft = torch.stack(scores_draft, dim=1)
+        draft_window = 2
+        # Evaluate the last token and the draft tokens with the main model
+        logits = get_logits(
+            model,
+            torch.cat([sequences[batch_idx, cur_lengths - 1][:, None], tokens_draft], dim=1),
+            inference_params,
+            (cur_lengths - 1).int(),
+            num_last_tokens=n_spec_tokens + 1,
+        )  # (batch, n_spec_tokens + 1, vocab_size)
+        stats.num_main_model_calls += 1
+        tokens, num_generated_tokens = sample_speculative(
+            logits, scores_draft, tokens_draft, **sampling_kwargs
+        )
+        # The sequences that are already done don't change anymore
+        num_generated_tokens = torch.where(unfinished, num_generated_tokens, 0)
+        stats.num_draft_tokens += unfinished * n_spec_tokens
+        stats.num_accepted_tokens += (num_generated_tokens - 1).clamp(min=0)
+        if scores is None:
+            scores = logits.new_zeros(batch_size, capacity - seqlen_og, logits.shape[-1])
+        offsets = torch.arange(n_spec_tokens + 1, device=device)
+        valid = offsets < num_generated_tokens[:, None]
+        positions = lengths[:, None] + offsets
+        rows = batch_idx[:, None].expand_as(positions)
+        sequences[rows[valid], positions[valid]] = tokens[valid]
+        scores[rows[valid], positions[valid] - seqlen_og] = logits[valid]
+        # The main model has the KV cache of all the tokens but the last one, the KV cache of the
+        # rejected draft tokens is ignored (and later overwritten) since lengths_per_sample is
+        # set from lengths.
+        lengths += num_generated_tokens
+
+    if enable_timing:
+        if tensor_parallel > 1:
+            torch.distributed.barrier()
+        torch.cuda.synchronize()
+        print(f"Prompt processing + decoding time: {(time.time() - start) * 1000:.0f}ms")
+    output_cls = GreedySearchDecoderOnlyOutput if top_k == 1 else SampleDecoderOnlyOutput
+    if scores is not None:
+        scores = scores[:, : max_length - seqlen_og]
+    output = output_cls(sequences=sequences[:, :max_length], scores=scores)
+    return (output, stats) if return_stats else output
+
+
+def tree_attention_mask(parents, device=None):
+    """Return the tree_mask (see InferenceParams) of a tree given the parent of each node.
+    parents: list of int, the index of the parent of each node, -1 for the roots. The nodes must be
+        in topological order (each parent before its children).
+    Return: (num_nodes, num_nodes) boolean.
+    """
+    tree_mask = torch.eye(len(parents), dtype=torch.bool)
+    for i, parent in enumerate(parents):
+        if parent >= 0:
+            assert parent < i, "The nodes must be in topological order"
+            tree_mask[i] |= tree_mask[parent]
+    return tree_mask.to(device)
+
+
+def sample_speculative_tree(
+    logits, logits_draft, tokens, parents, top_k=1, top_p=0.0, temperature=1.0
+):
+    """Speculative sampling generalized to a tree of draft tokens: starting from the root, at each
+    node the children are tried one after the other, with the multi-step speculative sampling
+    of [1]. When a child is rejected, the target distribution becomes the residual
+    norm(max(p - q, 0)) for the next child. The output has the same distribution as sampling from
+    the main model, as long as the children of each node are sampled independently from the draft
+    distribution (with replacement). With greedy decoding (top_k == 1), the child that is the
+    argmax of the main model is accepted, if any.
+    [1] SpecInfer: Accelerating Generative LLM Serving with Tree-based Speculative Inference and
+    Verification. Xupeng Miao et al. https://arxiv.org/abs/2305.09781
+
+    Arguments:
+        logits: Tensor of shape (num_nodes, vocab_size), the logits of the main model at each node.
+        logits_draft: Tensor of shape (num_nodes, vocab_size), the logits of the draft model that
+            the children of each node were sampled from (ignored for the leaves).
+        tokens: list of int of length num_nodes, the token of each node. Node 0 is the root.
+        parents: list of int of length num_nodes, the parent of each node (-1 for the root).
+    Return:
+        path: list of int, the accepted nodes, excluding the root.
+        next_token: Tensor of shape (), the token sampled after the last accepted node.
+    """
+    num_nodes = len(tokens)
+    assert logits.shape[0] == num_nodes and logits_draft.shape[0] == num_nodes
+    assert len(parents) == num_nodes and parents[0] == -1
+    children = [[] for _ in range(num_nodes)]
+    for i in range(1, num_nodes):
+        children[parents[i]].append(i)
+    path, node = [], 0
+    if top_k == 1:
+        while True:
+            next_token = logits[node].argmax(dim=-1)
+            accepted = [c for c in children[node] if tokens[c] == next_token.item()]
+            if not accepted:
+                return path, next_token
+            node = accepted[0]
+            path.append(node)
+    sampling_kwargs = dict(top_k=top_k, top_p=top_p, temperature=temperature)
+    while True:
+        probs = _sampling_probs(logits[node], **sampling_kwargs)
+        if not children[node]:
+            return path, torch.multinomial(probs, num_samples=1).squeeze(dim=-1)
+        probs_draft = _sampling_probs(logits_draft[node], **sampling_kwargs)
+        for child in children[node]:
+            token = tokens[child]
+            r = torch.rand((), device=probs.device)
+            if probs[token] > 0 and r * probs_draft[token] <= probs[token]:
+                node = child
+                path.append(node)
+                break
+            residual = torch.clamp(probs - probs_draft, min=0.0)
+            # If p <= q everywhere then p == q, numerically this only happens when p(x) == 0
+            if residual.sum() > 0:
+                probs = residual / residual.sum()
+        else:
+            return path, torch.multinomial(probs, num_samples=1).squeeze(dim=-1)
+
+
+def compact_kv_cache(inference_params, positions, start):
+    """Move the KV cache at positions (a list or a 1D tensor of int) to start, start + 1, ... in the
+    KV cache of every layer, e.g. to keep the accepted path of a tree of draft tokens.
+    Only supports the (non-paged) KV cache of shape (batch_size, seqlen, 2, nheads, headdim).
+    """
+    assert inference_params.block_table is None, "Paged KV cache is not supported"
+    positions = torch.as_tensor(positions, dtype=torch.long)
+    for kv_cache in inference_params.key_value_memory_dict.values():
+        # Indexing with a tensor makes a copy, so the source and destination can overlap
+        kv_cache[:, start : start + len(positions)] = kv_cache[:, positions.to(kv_cache.device)]
+
+
+@torch.inference_mode()
+def decode_speculative_tree(
+    input_ids,
+    model,
+    model_draft,
+    max_length,
+    tree_branching=(2, 2, 1),
+    top_k=1,
+    top_p=0.0,
+    temperature=1.0,
+    eos_token_id=None,
+    vocab_size=None,
+    tensor_parallel=1,
+    enable_timing=False,
+    return_stats=False,
+):
+    """Tree-based speculative decoding [1], only support batch_size == 1.
+    Instead of a single sequence of draft tokens, the draft model proposes a tree of candidates:
+    each node at depth d has tree_branching[d] children (the most likely tokens with greedy
+    decoding, samples from the draft model otherwise). The main model scores all the nodes in a
+    single forward pass, where each node only attends to its ancestors (InferenceParams.tree_mask),
+    and the longest accepted path is chosen with sample_speculative_tree. The KV cache of the
+    accepted path is then moved next to the KV cache of the committed tokens (compact_kv_cache),
+    the KV cache of the rejected nodes is overwritten later.
+    [1] SpecInfer: Accelerating Generative LLM Serving with Tree-based Speculative Inference and
+    Verification. Xupeng Miao et al. https://arxiv.org/abs/2305.09781
+
+    Arguments:
+        input_ids: (1, seq_len)
+        max_length: int
+        tree_branching: tuple of int, the number of children of the nodes at each depth.
+            (1, 1, 1) is the same as decode_speculative with speculative_lookahead=3.
+        return_stats: if True, also return a SpeculativeDecodingStats, where num_draft_tokens is
+            the depth of the trees (the number of tokens that could have been accepted).
+    Returns: GreedySearchDecoderOnlyOutput or SampleDecoderOnlyOutput, with the following fields:
+        sequences: (1, max_length)
+        scores: (1, max_length - seq_len, vocab_size)
+    """
+    batch_size, seqlen_og = input_ids.shape
+    assert batch_size == 1, "Tree speculative decoding only supports batch_size == 1"
+    assert eos_token_id is None, "Speculative decoding implementation doesn't support eos_token_id"
+    assert len(tree_branching) > 0 and all(b > 0 for b in tree_branching)
+    device = input_ids.device
+    num_tree_nodes, level_size = 0, 1
+    for b in tree_branching:
+        level_size *= b
+        num_tree_nodes += level_size
+    # The tree is written to the KV cache after the committed tokens
+    capacity = max_length + num_tree_nodes + 1
+    inference_params = InferenceParams(max_seqlen=capacity, max_batch_size=batch_size)
+    inference_params_draft = InferenceParams(max_seqlen=capacity, max_batch_size=batch_size)
+
+    def get_logits(model, input_ids, inference_params, cache_seqlen, tree_mask=None):
+        """Run model on input_ids (a sequence, or the nodes of a tree if tree_mask is not None),
+        which start at position cache_seqlen. Return the logits of all the tokens."""
+        inference_params.seqlen_offset = cache_seqlen
+        inference_params.tree_mask = tree_mask
+        depth = (
+            tree_mask.sum(dim=-1) - 1
+            if tree_mask is not None
+            else torch.arange(input_ids.shape[1], device=device)
+        )
+        position_ids = rearrange(cache_seqlen + depth.long(), "s -> 1 s")
+        logits = model(
+            input_ids, position_ids=position_ids, inference_params=inference_params
+        ).logits[0]
+        inference_params.tree_mask = None
+        return logits[..., :vocab_size] if vocab_size is not None else logits
+
+    sampling_kwargs = dict(top_k=top_k, top_p=top_p, temperature=temperature)
+    sequences = torch.zeros(batch_size, capacity, dtype=input_ids.dtype, device=device)
+    sequences[:, :seqlen_og] = input_ids
+    scores = None
+    stats = SpeculativeDecodingStats(
+        num_draft_tokens=torch.zeros(batch_size, dtype=torch.long, device=device),
+        num_accepted_tokens=torch.zeros(batch_size, dtype=torch.long, device=device),
+    )
+
+    if enable_timing:
+        if tensor_parallel > 1:
+            torch.distributed.barrier()
+        torch.cuda.synchronize()
+        start = time.time()
+
+    # Both models get the prompt except the last token, which is the root of the first tree.
+    # The main model always has the KV cache of all the committed tokens but the last one, the
+    # draft model has the KV cache of the first draft_seqlen tokens.
+    if seqlen_og > 1:
+        get_logits(model, input_ids[:, :-1], inference_params, 0)
+        get_logits(model_draft, input_ids[:, :-1], inference_params_draft, 0)
+    draft_seqlen = seqlen_og - 1
+    seqlen = seqlen_og  # Number of committed tokens
+    while seqlen < max_length:
+        # The accepted path plus the next token must fit in max_length
+        depth = min(len(tree_branching), max_length - seqlen - 1)
+        tokens, parents = [sequences[0, seqlen - 1].item()], [-1]
+        logits_draft = None
+        if depth > 0:
+            # The committed tokens that the draft model hasn't seen yet, the last one is the root
+            logits_root = get_logits(
+                model_draft, sequences[:, draft_seqlen:seqlen], inference_params_draft, draft_seqlen
+            )[-1:]
+            draft_seqlen = seqlen
+            frontier = [0]
+            for d in range(depth):
+                if d == 0:
+                    logits_draft = logits_root
+                else:
+                    # Run the draft model on the whole tree (except the root) to get the logits
+                    # of the nodes at depth d. Without the root, the nodes at depth 1 are roots.
+                    logits_draft = torch.cat(
+                        [
+                            logits_root,
+                            get_logits(
+                                model_draft,
+                                torch.tensor([tokens[1:]], dtype=sequences.dtype, device=device),
+                                inference_params_draft,
+                                seqlen,
+                                tree_mask=tree_attention_mask(
+                                    [parent - 1 for parent in parents[1:]], device=device
+                                ),
+                            ),
+                        ]
+                    )
+                if top_k == 1:
+                    children_tokens = logits_draft[frontier].topk(tree_branching[d], dim=-1).indices
+                else:
+                    children_tokens = torch.multinomial(
+                        _sampling_probs(logits_draft[frontier], **sampling_kwargs),
+                        num_samples=tree_branching[d],
+                        replacement=True,
+                    )
+                new_frontier = []
+                for node, children in zip(frontier, children_tokens.tolist()):
+                    for token in children:
+                        tokens.append(token)
+                        parents.append(node)
+                        new_frontier.append(len(tokens) - 1)
+                frontier = new_frontier
+            # The draft model only ran on the nodes above the last level
+            num_draft_nodes = len(tokens) - len(frontier)
+            logits_draft = F.pad(logits_draft, (0, 0, 0, len(tokens) - logits_draft.shape[0]))
+        # Evaluate the root and all the nodes of the tree with the main model
+        tree_mask = tree_attention_mask(parents, device=device)
+        logits = get_logits(
+            model,
+            torch.tensor([tokens], dtype=sequences.dtype, device=device),
+            inference_params,
+            seqlen - 1,
+            tree_mask=tree_mask,
+        )  # (num_nodes, vocab_size)
+        stats.num_main_model_calls += 1
+        if logits_draft is None:
+            logits_draft = torch.zeros_like(logits)
+        path, next_token = sample_speculative_tree(
+            logits, logits_draft, tokens, parents, **sampling_kwargs
+        )
+        stats.num_draft_tokens += depth
+        stats.num_accepted_tokens += len(path)
+        if scores is None:
+            scores = logits.new_zeros(batch_size, capacity - seqlen_og, logits.shape[-1])
+        num_new_tokens = len(path) + 1
+        sequences[0, seqlen : seqlen + num_new_tokens] = torch.tensor(
+            [tokens[i] for i in path] + [next_token.item()], dtype=sequences.dtype, device=device
+        )
+        scores[0, seqlen - seqlen_og : seqlen - seqlen_og + num_new_tokens] = logits[[0] + path]
+        # Node i of the tree is at position seqlen - 1 + i in the KV cache of the main model, and
+        # node i > 0 at position seqlen + i - 1 in the KV cache of the draft model (if it was run
+        # on node i).
+        compact_kv_cache(inference_params, [seqlen - 1 + i for i in path], seqlen)
+        if depth > 0:
+            draft_path = [i for i in path if i < num_draft_nodes]
+            compact_kv_cache(inference_params_draft, [seqlen + i - 1 for i in draft_path], seqlen)
+            draft_seqlen = seqlen + len(draft_path)
+        seqlen += num_new_tokens
+
+    if enable_timing:
+        if tensor_parallel > 1:
+            torch.distributed.barrier()
+        torch.cuda.synchronize()
+        print(f"Prompt processing + decoding time: {(time.time() - start) * 1000:.0f}ms")
+    output_cls = GreedySearchDecoderOnlyOutput if top_k == 1 else SampleDecoderOnlyOutput
+    if scores is not None:
+        scores = scores[:, : max_length - seqlen_og]
+    output = output_cls(sequences=sequences[:, :max_length], scores=scores)
+    return (output, stats) if return_stats else output
+
+
 class GenerationMixin:
     def allocate_inference_cache(self, batch_size, max_seqlen, dtype=None, **kwargs):
         raise NotImplementedError
@@ -579,12 +1751,31 @@ class GenerationMixin:
         **kwargs,
     ):
         output = decode(
-            input_ids, self, max_length, top_k=top_k, top_p=top_p, temperature=temperature, **kwargs
+            input_ids,
+            self,
+            max_length,
+            top_k=top_k,
+            top_p=top_p,
+            temperature=temperature,
+            output_scores=output_scores,
+            **kwargs,
         )
-        if not output_scores:
-            output.scores = None
         return output if return_dict_in_generate else output.sequences
 
+    def generate_stream(self, input_ids, max_length, top_k=1, top_p=0.0, temperature=1.0, **kwargs):
+        """Same as generate, but return an iterator over the new tokens, see decode_stream."""
+        return decode_stream(
+            input_ids, self, max_length, top_k=top_k, top_p=top_p, temperature=temperature, **kwargs
+        )
+
+    def generate_stream_async(
+        self, input_ids, max_length, top_k=1, top_p=0.0, temperature=1.0, **kwargs
+    ):
+        """Same as generate_stream, but return an async iterator, see decode_stream_async."""
+        return decode_stream_async(
+            input_ids, self, max_length, top_k=top_k, top_p=top_p, temperature=temperature, **kwargs
+        )
+
 
 def allocate_inference_cache(
     max_batch_size,
@@ -602,13 +1793,85 @@ def allocate_inference_cache(
     return {i: torch.empty(kv_cache_shape, device=device, dtype=dtype) for i in layers}
 
 
+def _next_power_of_2(n):
+    return 1 << (n - 1).bit_length()
+
+
+class CUDAGraphBucketCache:
+    """Graphs captured for decoding, one per (batch size bucket, decoding_seqlen). Batch sizes are
+    rounded up to the next power of two (at most max_batch_size), and the inputs of a smaller
+    batch are padded to its bucket, so that all the batch sizes of a bucket reuse the same graph.
+    If the graphs use more than memory_budget bytes, the least recently used ones are evicted.
+
+    capture_fn(batch_size, decoding_seqlen) returns (run, nbytes): run(input_ids, position_ids,
+    seqlen) returns the logits of the batch_size sequences, and nbytes is the memory used by the
+    graph. See update_graph_cache for the CUDA graph one.
+    Call the cache like run, with any batch size up to max_batch_size.
+    """
+
+    def __init__(self, capture_fn, max_batch_size, memory_budget=None):
+        self.capture_fn = capture_fn
+        self.max_batch_size = max_batch_size
+        self.memory_budget = memory_budget
+        # (bucket, decoding_seqlen) -> (run, nbytes), least recently used first
+        self.graphs = OrderedDict()
+        self.memory_used = 0
+        self.num_captures = 0
+        self.num_evictions = 0
+
+    def bucket(self, batch_size):
+        assert 0 < batch_size <= self.max_batch_size, f"Batch size must be <= {self.max_batch_size}"
+        return min(_next_power_of_2(batch_size), self.max_batch_size)
+
+    def get(self, batch_size, decoding_seqlen=1):
+        """Return the run function of the bucket of batch_size, capturing it if needed."""
+        key = (self.bucket(batch_size), decoding_seqlen)
+        if key in self.graphs:
+            self.graphs.move_to_end(key)
+            return self.graphs[key][0]
+        run, nbytes = self.capture_fn(*key)
+        self.num_captures += 1
+        self.graphs[key] = (run, nbytes)
+        self.memory_used += nbytes
+        self.evict()
+        return run
+
+    def evict(self):
+        """Evict the least recently used graphs until they fit in memory_budget. The most recently
+        used one is kept even if it doesn't fit."""
+        while (
+            self.memory_budget is not None
+            and self.memory_used > self.memory_budget
+            and len(self.graphs) > 1
+        ):
+            _, (_, nbytes) = self.graphs.popitem(last=False)
+            self.memory_used -= nbytes
+            self.num_evictions += 1
+
+    def clear(self):
+        self.graphs.clear()
+        self.memory_used = 0
+
+    def __call__(self, input_ids, position_ids, seqlen):
+        batch_size, decoding_seqlen = input_ids.shape[:2]
+        run = self.get(batch_size, decoding_seqlen)
+        num_padding = self.bucket(batch_size) - batch_size
+        if num_padding > 0:
+            # The padding rows use KV cache rows that no sequence uses
+            input_ids = torch.cat([input_ids, input_ids.new_zeros(num_padding, decoding_seqlen)])
+            position_ids = torch.cat(
+                [position_ids, position_ids.new_zeros(num_padding, decoding_seqlen)]
+            )
+        return run(input_ids, position_ids, seqlen)[:batch_size]
+
+
 @dataclass
 class DecodingCGCache:
     max_batch_size: int = 0
     max_seqlen: int = 0
     device = None
     dtype = None
-    callables: dict = field(default_factory=dict)
+    graphs: Optional[CUDAGraphBucketCache] = None
     mempool = None
     inference_params: Optional[InferenceParams] = None
     run: Optional[Callable] = None
@@ -625,7 +1888,17 @@ def update_graph_cache(
     tensor_parallel=1,
     dtype=None,
     n_warmups=2,
+    memory_budget=None,
 ):
+    """Return cache (a new DecodingCGCache if None), with the CUDA graphs to decode batch_size
+    sequences of up to max_seqlen tokens, decoding_seqlens tokens at a time.
+    The graphs are captured per power of two batch size, capped at the number of sequences the KV
+    cache is allocated for (see CUDAGraphBucketCache): smaller batches reuse them with padding.
+    The KV cache and the graphs are only discarded if the batch size or max_seqlen outgrows the KV
+    cache. If memory_budget (in bytes) is provided, the least recently used graphs are evicted so
+    that they use at most that much memory (not counting the KV cache), and each graph gets its
+    own memory pool so that evicting it frees its memory.
+    """
     if cache is None:
         cache = DecodingCGCache()
     param_example = next(iter(model.parameters()))
@@ -637,14 +1910,22 @@ def update_graph_cache(
         or batch_size > cache.max_batch_size
         or max_seqlen > cache.max_seqlen
     ):  # Invalidate the cache
-        cache.callables = {}
+        same_device = (device, dtype) == (cache.device, cache.dtype)
+        if cache.graphs is not None:
+            cache.graphs.clear()
+        cache.graphs = None
         cache.mempool = None
         cache.inference_params = None
         gc.collect()
         cache.device, cache.dtype = device, dtype
-        cache.max_batch_size, cache.max_seqlen = batch_size, max_seqlen
+        # No rounding up here: the top bucket is capped at max_batch_size, so the KV cache isn't
+        # larger than needed
+        cache.max_batch_size = max(batch_size, cache.max_batch_size if same_device else 0)
+        cache.max_seqlen = max(max_seqlen, cache.max_seqlen if same_device else 0)
         if hasattr(model, "allocate_inference_cache"):
-            inf_cache = model.allocate_inference_cache(batch_size, max_seqlen, dtype)
+            inf_cache = model.allocate_inference_cache(
+                cache.max_batch_size, cache.max_seqlen, dtype
+            )
         else:
             headdim = getattr(
                 model.config,
@@ -652,40 +1933,49 @@ def update_graph_cache(
                 model.config.hidden_size // model.config.num_attention_heads,
             )
             inf_cache = allocate_inference_cache(
-                batch_size,
-                max_seqlen,
+                cache.max_batch_size,
+                cache.max_seqlen,
                 model.config.num_attention_heads // tensor_parallel,
                 headdim,
                 model.config.num_hidden_layers,
                 device,
                 dtype,
             )
-        lengths_per_sample = torch.full((batch_size,), seqlen_og, dtype=torch.int32, device=device)
+        lengths_per_sample = torch.full(
+            (cache.max_batch_size,), seqlen_og, dtype=torch.int32, device=device
+        )
         cache.inference_params = InferenceParams(
-            max_seqlen=max_seqlen,
-            max_batch_size=batch_size,
+            max_seqlen=cache.max_seqlen,
+            max_batch_size=cache.max_batch_size,
             seqlen_offset=seqlen_og,
             key_value_memory_dict=inf_cache,
             lengths_per_sample=lengths_per_sample,
         )
         cache.mempool = torch.cuda.graphs.graph_pool_handle()
-    for decoding_seqlen in decoding_seqlens:
-        if (batch_size, decoding_seqlen) not in cache.callables:
-            cache.callables[batch_size, decoding_seqlen] = capture_graph(
+
+        def capture(batch_size, decoding_seqlen):
+            memory_before = torch.cuda.memory_allocated(device)
+            run = capture_graph(
                 model,
                 cache.inference_params,
                 batch_size,
-                max_seqlen,
+                cache.max_seqlen,
                 decoding_seqlen=decoding_seqlen,
-                mempool=cache.mempool,
+                mempool=(
+                    cache.mempool
+                    if cache.graphs.memory_budget is None
+                    else torch.cuda.graphs.graph_pool_handle()
+                ),
                 n_warmups=n_warmups,
             )
+            return run, max(torch.cuda.memory_allocated(device) - memory_before, 0)
 
-    def dispatch(input_ids, position_ids, seqlen):
-        batch_size, decoding_seqlen = input_ids.shape[:2]
-        return cache.callables[batch_size, decoding_seqlen](input_ids, position_ids, seqlen)
-
-    cache.run = dispatch
+        cache.graphs = CUDAGraphBucketCache(capture, cache.max_batch_size, memory_budget)
+    cache.graphs.memory_budget = memory_budget
+    cache.graphs.evict()
+    for decoding_seqlen in decoding_seqlens:
+        cache.graphs.get(batch_size, decoding_seqlen)
+    cache.run = cache.graphs
     cache.inference_params.seqlen_offset = 0  # Reset so it's not confusing
     return cache
 
@@ -0,0 +1,220 @@
+# Swapping the KV cache of preempted sequences to host memory and back.
+# When a sequence is preempted (e.g. to make room for other requests), its KV cache can be copied
+# to host memory and copied back when it is resumed, instead of being dropped and recomputed with
+# a new prefill. The copies take (2 * nlayers * seqlen * nheads * headdim * element size) bytes
+# over PCIe in each direction, which is much cheaper than the prefill for long sequences.
+# Adapted from the swapping in vLLM: https://arxiv.org/abs/2309.06180
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import torch
+
+from flash_attn.utils.paged_kv_cache import BlockAllocator
+
+
+@dataclass
+class SwapStats:
+    num_swap_out: int = 0
+    num_swap_in: int = 0
+    bytes_swapped_out: int = 0
+    bytes_swapped_in: int = 0
+
+
+@dataclass
+class _SwappedSequence:
+    seqlen: int
+    blocks: List[int]
+    # Recorded after the copy to the host, None on CPU
+    event: Optional[torch.cuda.Event] = None
+
+
+class KVCacheOffloader:
+    """Copy the KV cache of a sequence, i.e. one row (slot) of the
+    (batch_size, seqlen, 2, nheads, headdim) KV cache of every layer, to host memory and back.
+
+    The host memory is a pool of num_host_blocks blocks of block_size tokens for each layer, so
+    that it's allocated (and pinned, if the KV cache is on GPU) only once. Each swapped out sequence
+    owns the blocks holding its tokens.
+
+    On GPU, the copies run on a separate stream so that they overlap with the computation of the
+    other sequences. At most num_buffers swaps are in flight (2: double buffering, the next swap is
+    queued while the current one is being transferred). The copies are ordered after the work
+    queued on the current stream when they are issued, and the computation that reads or
+    overwrites a slot must call wait(slots) first so that it's ordered after the copies of these
+    slots. On CPU, the copies are synchronous and wait is a no-op.
+
+    kv_caches: dict of layer_idx -> KV cache, e.g. InferenceParams.key_value_memory_dict.
+    """
+
+    def __init__(self, kv_caches, num_host_blocks, block_size=256, num_buffers=2, pin_memory=None):
+        assert num_buffers >= 1
+        self.kv_caches = kv_caches
+        self.block_size = block_size
+        self.num_buffers = num_buffers
+        self.device = next(iter(kv_caches.values())).device
+        if pin_memory is None:
+            pin_memory = self.device.type == "cuda"
+        self.host_caches = {
+            layer_idx: torch.empty(
+                num_host_blocks,
+                block_size,
+                *kv_cache.shape[2:],
+                dtype=kv_cache.dtype,
+                pin_memory=pin_memory,
+            )
+            for layer_idx, kv_cache in kv_caches.items()
+        }
+        self.allocator = BlockAllocator(num_host_blocks)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.swapped: Dict[int, _SwappedSequence] = {}
+        # Events recorded after the copies in flight, and the slots they read or write
+        self._in_flight = deque()
+        self._slot_events: Dict[int, torch.cuda.Event] = {}
+        # Host blocks that can only be reused once the copy to the device is done
+        self._pending_free = deque()
+        self.stats = SwapStats()
+
+    def _num_blocks(self, seqlen):
+        return (seqlen + self.block_size - 1) // self.block_size
+
+    def _reclaim(self, wait=False):
+        """Free the host blocks of the finished copies to the device."""
+        while self._pending_free and (
+            wait or self._pending_free[0][0] is None or self._pending_free[0][0].query()
+        ):
+            event, blocks = self._pending_free.popleft()
+            if event is not None:
+                event.synchronize()
+            for block in blocks:
+                self.allocator.free(block)
+
+    def can_swap_out(self, seqlen):
+        num_blocks = self._num_blocks(seqlen)
+        if num_blocks > self.allocator.num_free_blocks:
+            self._reclaim()
+        if num_blocks > self.allocator.num_free_blocks:
+            self._reclaim(wait=True)
+        return num_blocks <= self.allocator.num_free_blocks
+
+    def is_swapped(self, seq_id):
+        return seq_id in self.swapped
+
+    def _launch(self, copy_fn, slot):
+        """Run copy_fn on the copy stream, after the work already queued on the current stream.
+        Return the event recorded after the copies, None on CPU."""
+        if self.stream is None:
+            copy_fn()
+            return None
+        while len(self._in_flight) >= self.num_buffers:
+            self._in_flight.popleft().synchronize()
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            copy_fn()
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self._in_flight.append(event)
+        self._slot_events[slot] = event
+        return event
+
+    def _block_ranges(self, blocks, seqlen):
+        for i, block in enumerate(blocks):
+            start = i * self.block_size
+            yield block, start, min(start + self.block_size, seqlen)
+
+    def swap_out(self, seq_id, slot, seqlen):
+        """Copy the first seqlen tokens of row slot of the KV cache to host memory. The slot can be
+        reused after wait([slot])."""
+        assert seq_id not in self.swapped, f"Sequence {seq_id} is already swapped out"
+        if not self.can_swap_out(seqlen):
+            raise RuntimeError(f"Not enough host memory to swap out {seqlen} tokens")
+        blocks = [self.allocator.allocate() for _ in range(self._num_blocks(seqlen))]
+
+        def copy_fn():
+            for layer_idx, kv_cache in self.kv_caches.items():
+                host_cache = self.host_caches[layer_idx]
+                for block, start, end in self._block_ranges(blocks, seqlen):
+                    host_cache[block, : end - start].copy_(
+                        kv_cache[slot, start:end], non_blocking=True
+                    )
+
+        event = self._launch(copy_fn, slot)
+        self.swapped[seq_id] = _SwappedSequence(seqlen, blocks, event)
+        self.stats.num_swap_out += 1
+        self.stats.bytes_swapped_out += self._nbytes(seqlen)
+
+    def swap_in(self, seq_id, slot):
+        """Copy the KV cache of seq_id back to row slot of the KV cache. The slot can be read after
+        wait([slot]). Return the number of tokens of the sequence."""
+        swapped = self.swapped.pop(seq_id)
+
+        def copy_fn():
+            for layer_idx, kv_cache in self.kv_caches.items():
+                host_cache = self.host_caches[layer_idx]
+                for block, start, end in self._block_ranges(swapped.blocks, swapped.seqlen):
+                    src = host_cache[block, : end - start]
+                    if isinstance(kv_cache, torch.Tensor):
+                        kv_cache[slot, start:end].copy_(src, non_blocking=True)
+                    else:  # e.g. QuantizedKVCache, which quantizes on assignment
+                        kv_cache[slot, start:end] = src.to(self.device, non_blocking=True)
+
+        event = self._launch(copy_fn, slot)
+        self._pending_free.append((event, swapped.blocks))
+        self._reclaim()
+        self.stats.num_swap_in += 1
+        self.stats.bytes_swapped_in += self._nbytes(swapped.seqlen)
+        return swapped.seqlen
+
+    def free(self, seq_id):
+        """Drop the swapped out KV cache of seq_id, e.g. if the request is cancelled."""
+        swapped = self.swapped.pop(seq_id)
+        # The copy to the host might still be in flight
+        self._pending_free.append((swapped.event, swapped.blocks))
+
+    def wait(self, slots):
+        """Make the current stream wait for the copies from or to these slots."""
+        if self.stream is None:
+            return
+        current_stream = torch.cuda.current_stream(self.device)
+        for slot in slots:
+            event = self._slot_events.pop(slot, None)
+            if event is not None:
+                current_stream.wait_event(event)
+
+    def synchronize(self):
+        """Wait for all the copies, e.g. before measuring time."""
+        while self._in_flight:
+            self._in_flight.popleft().synchronize()
+        self._slot_events.clear()
+        self._reclaim(wait=True)
+
+    def _nbytes(self, seqlen):
+        return sum(
+            seqlen * host_cache[0, 0].numel() * host_cache.element_size()
+            for host_cache in self.host_caches.values()
+        )
+
+
+class PreemptionPolicy:
+    """Decide which running requests to preempt when a scheduler needs free slots, and whether
+    their KV cache is swapped out to host memory or dropped and recomputed when they're resumed.
+
+    By default, the requests that arrived last are preempted first (as in vLLM), and a request is
+    swapped if it has at least min_swap_tokens tokens and the host has room for it: the prefill of
+    short sequences is cheap, and they'd take host memory from the long ones.
+    Subclass and override select / should_swap for other policies.
+    """
+
+    def __init__(self, min_swap_tokens=0):
+        self.min_swap_tokens = min_swap_tokens
+
+    def select(self, requests, num_slots):
+        """requests: list of the running (unfinished) requests. Return the requests to preempt."""
+        return sorted(requests, key=lambda r: r.request_id, reverse=True)[:num_slots]
+
+    def should_swap(self, request, offloader: Optional[KVCacheOffloader]):
+        return (
+            offloader is not None
+            and request.seqlen >= self.min_swap_tokens
+            and offloader.can_swap_out(request.seqlen)
+        )
@@ -0,0 +1,156 @@
+# Block (page) management for paged KV cache.
+# Instead of a dense (max_batch_size, max_seqlen, 2, nheads, headdim) cache per layer, the KV cache
+# of each layer is a pool of (num_blocks, block_size, 2, nheads, headdim) and each sequence owns a
+# list of blocks (its block table), allocated as the sequence grows.
+# Adapted from the block manager in vLLM: https://arxiv.org/abs/2309.06180
+from typing import Dict, List, Sequence
+
+import torch
+
+
+class BlockAllocator:
+    """Free list of the blocks of the pool, with a reference count per block so that blocks
+    can be shared between sequences (e.g. a common prompt prefix)."""
+
+    def __init__(self, num_blocks):
+        self.num_blocks = num_blocks
+        # Pop from the end, so that the blocks freed last are reused first (they're more likely
+        # to still be in the cache of the GPU).
+        self.free_blocks: List[int] = list(reversed(range(num_blocks)))
+        self.ref_counts = [0] * num_blocks
+
+    @property
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    def allocate(self):
+        if not self.free_blocks:
+            raise RuntimeError(f"Out of KV cache blocks, all {self.num_blocks} blocks are in use")
+        block = self.free_blocks.pop()
+        self.ref_counts[block] = 1
+        return block
+
+    def fork(self, block):
+        assert self.ref_counts[block] > 0, f"Block {block} is not allocated"
+        self.ref_counts[block] += 1
+
+    def free(self, block):
+        assert self.ref_counts[block] > 0, f"Block {block} is already free"
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+
+class BlockManager:
+    """Block tables of the sequences being generated.
+
+    Usage, for each forward pass:
+        copies = manager.append_slots(seq_id, num_new_tokens)  # for each sequence in the batch
+        copy_blocks(inference_params.key_value_memory_dict, copies)
+        inference_params.block_table = manager.get_block_table(seq_ids, device)
+        inference_params.lengths_per_sample = manager.get_seqlens(seq_ids, device)
+        model(input_ids, inference_params=inference_params)
+        manager.advance(seq_id, num_new_tokens)  # for each sequence in the batch
+
+    Blocks shared between sequences (after fork) are copied on write: the first sequence that
+    writes into a shared block gets a fresh copy of it.
+    """
+
+    def __init__(self, num_blocks, block_size, max_num_blocks_per_seq=None):
+        self.block_size = block_size
+        self.allocator = BlockAllocator(num_blocks)
+        self.max_num_blocks_per_seq = max_num_blocks_per_seq
+        self.block_tables: Dict[int, List[int]] = {}
+        self.seqlens: Dict[int, int] = {}
+
+    @property
+    def num_free_blocks(self):
+        return self.allocator.num_free_blocks
+
+    def num_blocks_needed(self, seq_id, num_new_tokens):
+        """Number of blocks that append_slots would allocate, not counting copy-on-write."""
+        seqlen = self.seqlens.get(seq_id, 0) + num_new_tokens
+        num_blocks = (seqlen + self.block_size - 1) // self.block_size
+        return max(num_blocks - len(self.block_tables.get(seq_id, [])), 0)
+
+    def can_append(self, seq_id, num_new_tokens):
+        return self.num_blocks_needed(seq_id, num_new_tokens) <= self.num_free_blocks
+
+    def allocate(self, seq_id):
+        assert seq_id not in self.block_tables, f"Sequence {seq_id} already exists"
+        self.block_tables[seq_id] = []
+        self.seqlens[seq_id] = 0
+
+    def append_slots(self, seq_id, num_new_tokens):
+        """Make room for num_new_tokens more tokens in the blocks of seq_id.
+        Return the list of (src, dst) blocks that must be copied before writing, because the
+        blocks that will be written into were shared with another sequence.
+        """
+        if seq_id not in self.block_tables:
+            self.allocate(seq_id)
+        block_table = self.block_tables[seq_id]
+        seqlen = self.seqlens[seq_id]
+        copies = []
+        # Copy-on-write for the shared blocks that the new tokens will be written into
+        first_block = seqlen // self.block_size
+        last_block = min((seqlen + num_new_tokens - 1) // self.block_size, len(block_table) - 1)
+        for i in range(first_block, last_block + 1):
+            block = block_table[i]
+            if self.allocator.ref_counts[block] > 1:
+                new_block = self.allocator.allocate()
+                self.allocator.free(block)
+                block_table[i] = new_block
+                copies.append((block, new_block))
+        for _ in range(self.num_blocks_needed(seq_id, num_new_tokens)):
+            block_table.append(self.allocator.allocate())
+        if self.max_num_blocks_per_seq is not None:
+            assert len(block_table) <= self.max_num_blocks_per_seq
+        return copies
+
+    def advance(self, seq_id, num_new_tokens):
+        """Record that num_new_tokens tokens have been written into the cache of seq_id."""
+        self.seqlens[seq_id] += num_new_tokens
+        assert self.seqlens[seq_id] <= len(self.block_tables[seq_id]) * self.block_size
+
+    def fork(self, parent_seq_id, child_seq_id):
+        """The child sequence shares all the blocks of the parent, e.g. to sample several
+        completions of the same prompt without copying its KV cache."""
+        assert child_seq_id not in self.block_tables, f"Sequence {child_seq_id} already exists"
+        block_table = self.block_tables[parent_seq_id]
+        for block in block_table:
+            self.allocator.fork(block)
+        self.block_tables[child_seq_id] = list(block_table)
+        self.seqlens[child_seq_id] = self.seqlens[parent_seq_id]
+
+    def free(self, seq_id):
+        for block in self.block_tables.pop(seq_id):
+            self.allocator.free(block)
+        del self.seqlens[seq_id]
+
+    def get_block_table(self, seq_ids: Sequence[int], device=None):
+        """Return (len(seq_ids), max_num_blocks_per_seq) int32 tensor, padded with block 0."""
+        max_num_blocks = self.max_num_blocks_per_seq
+        if max_num_blocks is None:
+            max_num_blocks = max(len(self.block_tables[seq_id]) for seq_id in seq_ids)
+        block_table = torch.zeros(len(seq_ids), max_num_blocks, dtype=torch.int32)
+        for i, seq_id in enumerate(seq_ids):
+            blocks = self.block_tables[seq_id]
+            block_table[i, : len(blocks)] = torch.tensor(blocks, dtype=torch.int32)
+        return block_table.to(device=device)
+
+    def get_seqlens(self, seq_ids: Sequence[int], device=None):
+        return torch.tensor(
+            [self.seqlens[seq_id] for seq_id in seq_ids], dtype=torch.int32, device=device
+        )
+
+
+def copy_blocks(kv_caches, copies):
+    """Apply the copy-on-write copies returned by BlockManager.append_slots to the KV cache of
+    every layer.
+    kv_caches: dict of layer_idx -> (num_blocks, block_size, 2, nheads, headdim)
+    """
+    if not copies:
+        return
+    for kv_cache in kv_caches.values():
+        src, dst = torch.tensor(copies, dtype=torch.long, device=kv_cache.device).unbind(dim=1)
+        kv_cache[dst] = kv_cache[src]
@@ -0,0 +1,186 @@
+# Prefix cache: reuse the KV cache of prompts that share a prefix (e.g. a long system prompt)
+# instead of running the prefill again. Prefixes are stored in a radix tree, similar to
+# RadixAttention in SGLang: https://arxiv.org/abs/2312.07104
+import heapq
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence
+
+import torch
+from torch import Tensor
+
+
+class _RadixNode:
+    def __init__(self, tokens=(), kv=None, parent=None):
+        # Tokens on the edge from the parent to this node, and their KV for each layer,
+        # dict of layer_idx -> (len(tokens), 2, nheads, headdim)
+        self.tokens = tuple(tokens)
+        self.kv: Dict[int, Tensor] = kv if kv is not None else {}
+        self.parent = parent
+        self.children: Dict[int, "_RadixNode"] = {}
+        self.last_access = 0
+
+    def split(self, length):
+        """Split the edge to this node at length, return the new node for the first part."""
+        parent = _RadixNode(
+            self.tokens[:length],
+            {i: kv[:length].clone() for i, kv in self.kv.items()},
+            self.parent,
+        )
+        parent.last_access = self.last_access
+        self.parent.children[self.tokens[0]] = parent
+        self.tokens = self.tokens[length:]
+        self.kv = {i: kv[length:].clone() for i, kv in self.kv.items()}
+        self.parent = parent
+        parent.children[self.tokens[0]] = self
+        return parent
+
+
+@dataclass
+class PrefixCacheStats:
+    num_queries: int = 0
+    num_hits: int = 0
+    num_query_tokens: int = 0
+    # Number of prompt tokens whose prefill was skipped
+    num_hit_tokens: int = 0
+
+    @property
+    def hit_rate(self):
+        return self.num_hits / self.num_queries if self.num_queries > 0 else 0.0
+
+    @property
+    def token_hit_rate(self):
+        return self.num_hit_tokens / self.num_query_tokens if self.num_query_tokens > 0 else 0.0
+
+
+class PrefixCache:
+    """Radix tree from token sequences to snapshots of their KV cache, for every layer.
+    When more than max_tokens tokens are stored, the least recently used leaves are evicted.
+
+    Usage with decode (done by decode when passed prefix_cache=...):
+        num_cached = prefix_cache.load(input_ids, inference_params)
+        # prefill input_ids[:, num_cached:] with seqlen_offset = num_cached
+        prefix_cache.store(input_ids, inference_params)
+    """
+
+    def __init__(self, max_tokens):
+        self.max_tokens = max_tokens
+        self.root = _RadixNode()
+        self.num_tokens = 0
+        self.stats = PrefixCacheStats()
+        self._clock = 0
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def _walk(self, tokens):
+        """Return the list of (node, length) matched along the tree, and the total length."""
+        node, matched, path = self.root, 0, []
+        while matched < len(tokens):
+            child = node.children.get(tokens[matched])
+            if child is None:
+                break
+            length = 0
+            max_length = min(len(child.tokens), len(tokens) - matched)
+            while length < max_length and child.tokens[length] == tokens[matched + length]:
+                length += 1
+            path.append((child, length))
+            matched += length
+            if length < len(child.tokens):
+                break
+            node = child
+        return path, matched
+
+    def match(self, tokens: Sequence[int]):
+        """Return the length of the longest cached prefix of tokens, and its KV for each layer,
+        dict of layer_idx -> (length, 2, nheads, headdim). Does not update the statistics."""
+        path, matched = self._walk(tuple(tokens))
+        now = self._tick()
+        for node, _ in path:
+            node.last_access = now
+        if matched == 0:
+            return 0, {}
+        kv = {
+            layer_idx: torch.cat([node.kv[layer_idx][:length] for node, length in path], dim=0)
+            for layer_idx in path[0][0].kv
+        }
+        return matched, kv
+
+    def insert(self, tokens: Sequence[int], kv: Dict[int, Tensor]):
+        """Store the KV of tokens: kv is a dict of layer_idx -> (>= len(tokens), 2, nheads, headdim).
+        Only the part of tokens that is not already in the tree is copied."""
+        tokens = tuple(tokens)
+        path, matched = self._walk(tokens)
+        now = self._tick()
+        node = self.root
+        if path:
+            node, length = path[-1]
+            if length < len(node.tokens):
+                node = node.split(length)
+        for n, _ in path:
+            n.last_access = now
+        if matched < len(tokens):
+            leaf = _RadixNode(
+                tokens[matched:],
+                {i: v[matched : len(tokens)].clone() for i, v in kv.items()},
+                node,
+            )
+            leaf.last_access = now
+            node.children[tokens[matched]] = leaf
+            self.num_tokens += len(tokens) - matched
+        self.evict()
+
+    def evict(self, max_tokens=None):
+        """Evict the least recently used leaves until at most max_tokens tokens are stored."""
+        max_tokens = self.max_tokens if max_tokens is None else max_tokens
+        if self.num_tokens <= max_tokens:
+            return
+        leaves, stack = [], [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if not node.children and node is not self.root:
+                leaves.append((node.last_access, id(node), node))
+        heapq.heapify(leaves)
+        while self.num_tokens > max_tokens and leaves:
+            _, _, node = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.tokens[0]]
+            self.num_tokens -= len(node.tokens)
+            if not parent.children and parent is not self.root:
+                heapq.heappush(leaves, (parent.last_access, id(parent), parent))
+
+    @torch.inference_mode()
+    def load(self, input_ids, inference_params, max_cached=None):
+        """Seed the KV cache in inference_params with the longest cached prefix common to all the
+        sequences in input_ids, and return its length. The KV cache of every layer must already be
+        allocated in inference_params.key_value_memory_dict.
+        input_ids: (batch, seqlen). At least one token is left uncached so that the prefill still
+            produces the logits of the last token.
+        """
+        batch_size, seqlen = input_ids.shape
+        max_cached = seqlen - 1 if max_cached is None else min(max_cached, seqlen - 1)
+        matches = [self.match(row[:max_cached].tolist()) for row in input_ids]
+        num_cached = min(matched for matched, _ in matches)
+        self.stats.num_queries += batch_size
+        self.stats.num_query_tokens += batch_size * seqlen
+        if num_cached == 0:
+            return 0
+        self.stats.num_hits += batch_size
+        self.stats.num_hit_tokens += batch_size * num_cached
+        start = inference_params.batch_size_offset
+        for layer_idx, kv_cache in inference_params.key_value_memory_dict.items():
+            kv_cache[start : start + batch_size, :num_cached] = torch.stack(
+                [kv[layer_idx][:num_cached] for _, kv in matches], dim=0
+            )
+        return num_cached
+
+    def store(self, input_ids, inference_params):
+        """Snapshot the KV cache of the sequences in input_ids (batch, seqlen) after the prefill."""
+        start = inference_params.batch_size_offset
+        for i, row in enumerate(input_ids):
+            kv = {
+                layer_idx: kv_cache[start + i, : input_ids.shape[1]]
+                for layer_idx, kv_cache in inference_params.key_value_memory_dict.items()
+            }
+            self.insert(row.tolist(), kv)
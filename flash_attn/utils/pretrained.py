@@ -1,7 +1,16 @@
+import json
+import logging
 import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from functools import partial
+from typing import List
 
 import torch
+from safetensors import safe_open
 from safetensors.torch import load_file as safe_load_file
 from transformers.utils import (
     SAFE_WEIGHTS_INDEX_NAME,
@@ -11,10 +20,17 @@ from transformers.utils import (
 )
 from transformers.utils.hub import cached_file, get_checkpoint_shard_files
 
+try:
+    import resource
+except ImportError:
+    resource = None
 
-def state_dict_from_pretrained(model_name, device=None, dtype=None):
-    # If not fp32, then we don't want to load directly to the GPU
-    mapped_device = "cpu" if dtype not in [torch.float32, None] else device
+logger = logging.getLogger(__name__)
+
+
+def _resolve_checkpoint_files(model_name):
+    """Return the list of checkpoint files of model_name (downloaded if needed), and whether
+    they're in safetensors format."""
     is_sharded = False
     load_safe = False
     resolved_archive_file = None
@@ -56,24 +72,384 @@ def state_dict_from_pretrained(model_name, device=None, dtype=None):
     if resolved_archive_file is None:
         raise EnvironmentError(f"Model name {model_name} was not found.")
 
-    if load_safe:
-        loader = partial(safe_load_file, device=mapped_device)
-    else:
-        loader = partial(torch.load, map_location=mapped_device)
-
     if is_sharded:
         # resolved_archive_file becomes a list of files that point to the different
         # checkpoint shards in this case.
         resolved_archive_file, sharded_metadata = get_checkpoint_shard_files(
             model_name, resolved_archive_file
         )
-        state_dict = {}
-        for sharded_file in resolved_archive_file:
-            state_dict.update(loader(sharded_file))
+        return list(resolved_archive_file), load_safe
+    return [resolved_archive_file], load_safe
+
+
+def _ordered_map(fn, items, num_workers=1):
+    """Like map(fn, items), but fn runs in a pool of num_workers threads. The results are still
+    returned in the order of items, and at most num_workers items are processed ahead of the
+    consumer, so that memory stays bounded."""
+    if num_workers <= 1:
+        yield from map(fn, items)
+        return
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = deque()
+        for item in items:
+            if len(futures) >= num_workers:
+                yield futures.popleft().result()
+            futures.append(executor.submit(fn, item))
+        while futures:
+            yield futures.popleft().result()
+
+
+class _LoadProgress:
+    """Print the progress of loading, e.g. "[gpt2] shard 2/4 (model-00002-of-00004.safetensors):
+    0.93GB in 1.52s, 2.31GB/2.93GB total, 2.87s elapsed"."""
+
+    def __init__(self, desc, total, total_bytes=None, enabled=True):
+        self.desc, self.total, self.total_bytes, self.enabled = desc, total, total_bytes, enabled
+        self.count, self.nbytes = 0, 0
+        self.start = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def update(self, name, nbytes, seconds):
+        self.count += 1
+        self.nbytes += nbytes
+        if self.enabled:
+            gb = 2**30
+            total = f"/{self.total_bytes / gb:.2f}GB" if self.total_bytes is not None else ""
+            print(
+                f"[{self.desc}] {self.count}/{self.total} ({name}): {nbytes / gb:.2f}GB in "
+                f"{seconds:.2f}s, {self.nbytes / gb:.2f}GB{total} total, "
+                f"{self.elapsed:.2f}s elapsed"
+            )
+
+    def close(self):
+        gb = 2**30
+        message = (
+            f"[{self.desc}] Loaded {self.nbytes / gb:.2f}GB in {self.elapsed:.2f}s "
+            f"({self.nbytes / gb / max(self.elapsed, 1e-6):.2f}GB/s)"
+        )
+        if self.enabled:
+            print(message)
+        logger.info(message)
+
+
+def state_dict_from_pretrained(model_name, device=None, dtype=None, num_workers=1, progress=False):
+    """Load the state_dict of model_name.
+    num_workers: number of threads reading (and converting to dtype) the checkpoint shards in
+        parallel. The shards are merged in order, so the result doesn't depend on num_workers.
+    progress: whether to print the progress and timing of each shard.
+    """
+    # If not fp32, then we don't want to load directly to the GPU
+    mapped_device = "cpu" if dtype not in [torch.float32, None] else device
+    resolved_archive_files, load_safe = _resolve_checkpoint_files(model_name)
+
+    if load_safe:
+        loader = partial(safe_load_file, device=mapped_device)
     else:
-        state_dict = loader(resolved_archive_file)
-    # Convert dtype before moving to GPU to save memory
+        loader = partial(torch.load, map_location=mapped_device)
+
+    def load_shard(sharded_file):
+        start = time.perf_counter()
+        shard = loader(sharded_file)
+        # Convert dtype before moving to GPU to save memory
+        if dtype is not None:
+            shard = {k: v.to(dtype=dtype) for k, v in shard.items()}
+        shard = {k: v.to(device=device) for k, v in shard.items()}
+        return sharded_file, shard, time.perf_counter() - start
+
+    load_progress = _LoadProgress(model_name, len(resolved_archive_files), enabled=progress)
+    state_dict = {}
+    for sharded_file, shard, seconds in _ordered_map(
+        load_shard, resolved_archive_files, num_workers
+    ):
+        state_dict.update(shard)
+        load_progress.update(
+            os.path.basename(sharded_file), _storage_nbytes(shard.values()), seconds
+        )
+    load_progress.close()
+    return state_dict
+
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def _torch_load_mmap(path):
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # Older PyTorch, or checkpoints not saved in the zipfile format, can't be memory-mapped
+        return torch.load(path, map_location="cpu")
+
+
+class LazyCheckpoint:
+    """Memory-mapped view of the (possibly sharded) checkpoint of model_name.
+    Tensors are only read from disk when asked for with get_tensor, so that the whole checkpoint
+    never has to be in memory at once.
+    """
+
+    def __init__(self, model_name):
+        self.files, self.load_safe = _resolve_checkpoint_files(model_name)
+        # For each key, the index of the file it's stored in
+        self.key_to_file = {}
+        self._handles = []
+        for i, path in enumerate(self.files):
+            if self.load_safe:
+                handle = safe_open(path, framework="pt", device="cpu")
+            else:
+                handle = _torch_load_mmap(path)
+            self._handles.append(handle)
+            self.key_to_file.update({k: i for k in handle.keys()})
+
+    def keys(self):
+        return self.key_to_file.keys()
+
+    def get_meta(self, key, dtype=None):
+        """Return an empty tensor on the meta device with the shape and dtype of key."""
+        handle = self._handles[self.key_to_file[key]]
+        if self.load_safe:
+            tensor_slice = handle.get_slice(key)
+            shape = tensor_slice.get_shape()
+            key_dtype = _SAFETENSORS_DTYPES[tensor_slice.get_dtype()]
+        else:
+            shape, key_dtype = handle[key].shape, handle[key].dtype
+        if dtype is not None and key_dtype.is_floating_point:
+            key_dtype = dtype
+        return torch.empty(shape, dtype=key_dtype, device="meta")
+
+    def get_tensor(self, key, dtype=None):
+        handle = self._handles[self.key_to_file[key]]
+        tensor = handle.get_tensor(key) if self.load_safe else handle[key]
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype=dtype)
+        return tensor
+
+
+def _layer_group(key):
+    """Index of the layer that key belongs to (e.g. model.layers.3.mlp.up_proj.weight -> 3),
+    or -1 for the keys that are not part of a layer (embeddings, final norm, LM head)."""
+    match = re.search(r"(?:^|\.)(\d+)\.", key)
+    return int(match.group(1)) if match is not None else -1
+
+
+def _storage_nbytes(tensors):
+    """Total memory of tensors, counting the storage shared between views only once."""
+    storages = {}
+    for t in tensors:
+        if not t.is_meta:
+            storage = t.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+def _max_rss_bytes():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@dataclass
+class StreamingLoadStats:
+    num_tensors: int = 0
+    # Number of bytes read from the checkpoint (after dtype conversion)
+    num_bytes: int = 0
+    # Maximum number of bytes of checkpoint tensors held in memory at the same time
+    peak_bytes: int = 0
+    # Peak resident memory of the process, if available
+    max_rss_bytes: int = None
+    # Loading time in seconds
+    elapsed: float = 0.0
+    missing_keys: List[str] = field(default_factory=list)
+    unexpected_keys: List[str] = field(default_factory=list)
+
+    def __str__(self):
+        gb = 2**30
+        rss = f"{self.max_rss_bytes / gb:.2f}GB" if self.max_rss_bytes is not None else "n/a"
+        return (
+            f"Loaded {self.num_tensors} tensors ({self.num_bytes / gb:.2f}GB), "
+            f"in {self.elapsed:.2f}s, peak checkpoint memory {self.peak_bytes / gb:.2f}GB "
+            f"per layer, max RSS {rss}"
+        )
+
+
+@torch.no_grad()
+def load_state_dict_streaming(
+    model,
+    model_name,
+    remap_fn=None,
+    shard_fn=None,
+    dtype=None,
+    strict=True,
+    num_workers=1,
+    progress=False,
+):
+    """Load the checkpoint of model_name into model one layer at a time, instead of building the
+    whole state_dict in memory (several times, for the dtype conversion and the remapping).
+
+    The checkpoint files are memory-mapped, and the tensors of each layer are read, converted to
+    dtype, remapped with remap_fn, sharded with shard_fn, then copied into the parameters of model
+    before moving on to the next layer. Peak memory is about the size of one layer.
+
+    Arguments:
+        remap_fn: function state_dict -> state_dict from the checkpoint format to the model format,
+            e.g. partial(remap_state_dict_hf_llama, config=config). It's called on the whole state
+            dict each time, but only the tensors of the current layer are real: the other ones are
+            on the meta device, so that remap_fn can still look them up (at no cost).
+        shard_fn: function state_dict -> state_dict that only keeps the part of each tensor for the
+            current rank, e.g. partial(shard_state_dict_tp, config=config, world_size=2, rank=0).
+            It must accept a state_dict that only has some of the keys.
+        num_workers: number of threads reading, converting, remapping and sharding the layers in
+            parallel. The layers are still copied into the model in order, and at most
+            num_workers + 1 layers are in memory at the same time.
+        progress: whether to print the progress and timing of each layer.
+    Return:
+        StreamingLoadStats, also logged.
+    """
+    checkpoint = LazyCheckpoint(model_name)
+    target = model.state_dict()
+    stats = StreamingLoadStats()
+    groups = {}
+    for key in checkpoint.keys():
+        groups.setdefault(_layer_group(key), []).append(key)
+    meta_state_dict = {key: checkpoint.get_meta(key, dtype) for key in checkpoint.keys()}
+
+    def load_group(group):
+        start = time.perf_counter()
+        state_dict = dict(meta_state_dict)
+        for key in groups[group]:
+            state_dict[key] = checkpoint.get_tensor(key, dtype)
+        raw_tensors = [state_dict[key] for key in groups[group]]
+        if remap_fn is not None:
+            state_dict = remap_fn(state_dict)
+        state_dict = {k: v for k, v in state_dict.items() if not v.is_meta}
+        if shard_fn is not None:
+            state_dict = shard_fn(state_dict)
+        nbytes = _storage_nbytes(raw_tensors)
+        peak_bytes = _storage_nbytes(raw_tensors + list(state_dict.values()))
+        return group, state_dict, nbytes, peak_bytes, time.perf_counter() - start
+
+    total_bytes = sum(t.numel() * t.element_size() for t in meta_state_dict.values())
+    load_progress = _LoadProgress(model_name, len(groups), total_bytes, enabled=progress)
+    loaded = set()
+    for group, state_dict, nbytes, peak_bytes, seconds in _ordered_map(
+        load_group, sorted(groups), num_workers
+    ):
+        stats.num_tensors += len(groups[group])
+        stats.num_bytes += nbytes
+        stats.peak_bytes = max(stats.peak_bytes, peak_bytes)
+        _copy_state_dict(target, state_dict, loaded, stats.unexpected_keys)
+        del state_dict
+        load_progress.update(f"layer {group}" if group >= 0 else "embeddings", nbytes, seconds)
+    load_progress.close()
+    stats.missing_keys = [key for key in target if key not in loaded]
+    stats.max_rss_bytes = _max_rss_bytes()
+    stats.elapsed = load_progress.elapsed
+    _check_load_stats(model, stats, strict)
+    return stats
+
+
+# Pre-converted checkpoints, already remapped to the flash_attn format and sharded for tensor
+# parallel, with one safetensors file per rank and a manifest (written by
+# flash_attn/models/convert_checkpoint.py). Loading one skips the remapping and sharding.
+TP_MANIFEST_NAME = "flash_attn_manifest.json"
+TP_CHECKPOINT_FORMAT_VERSION = 1
+
+
+def tp_checkpoint_filename(rank, world_size):
+    return f"model-tp{rank:02d}-of-{world_size:02d}.safetensors"
+
+
+def is_tp_checkpoint(path):
+    return os.path.isfile(os.path.join(path, TP_MANIFEST_NAME))
+
+
+def load_tp_manifest(path):
+    with open(os.path.join(path, TP_MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != TP_CHECKPOINT_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported checkpoint format version {manifest.get('format_version')} in {path}, "
+            f"expected {TP_CHECKPOINT_FORMAT_VERSION}"
+        )
+    return manifest
+
+
+def _tp_checkpoint_file(path, world_size, rank):
+    manifest = load_tp_manifest(path)
+    if manifest["world_size"] != world_size:
+        raise ValueError(
+            f"Checkpoint {path} was sharded for world_size={manifest['world_size']}, "
+            f"but world_size={world_size}"
+        )
+    return os.path.join(path, manifest["files"][rank])
+
+
+def state_dict_from_tp_checkpoint(path, world_size, rank, device=None, dtype=None):
+    """Return the state_dict of the given rank of a pre-converted checkpoint."""
+    state_dict = safe_load_file(_tp_checkpoint_file(path, world_size, rank), device="cpu")
     if dtype is not None:
         state_dict = {k: v.to(dtype=dtype) for k, v in state_dict.items()}
-    state_dict = {k: v.to(device=device) for k, v in state_dict.items()}
-    return state_dict
+    return {k: v.to(device=device) for k, v in state_dict.items()}
+
+
+@torch.no_grad()
+def load_tp_checkpoint(model, path, world_size=1, rank=0, strict=True):
+    """Load the file of the given rank of a pre-converted checkpoint into model, one tensor at a
+    time. The tensors are already remapped and sharded, and converted to the dtype of the
+    parameters while copying.
+    Return:
+        StreamingLoadStats, also logged.
+    """
+    start = time.perf_counter()
+    target = model.state_dict()
+    stats = StreamingLoadStats()
+    loaded = set()
+    with safe_open(_tp_checkpoint_file(path, world_size, rank), framework="pt") as f:
+        for key in f.keys():
+            tensor = f.get_tensor(key)
+            stats.num_tensors += 1
+            stats.num_bytes += _storage_nbytes([tensor])
+            stats.peak_bytes = max(stats.peak_bytes, _storage_nbytes([tensor]))
+            _copy_state_dict(target, {key: tensor}, loaded, stats.unexpected_keys)
+    stats.missing_keys = [key for key in target if key not in loaded]
+    stats.max_rss_bytes = _max_rss_bytes()
+    stats.elapsed = time.perf_counter() - start
+    _check_load_stats(model, stats, strict)
+    return stats
+
+
+def _copy_state_dict(target, state_dict, loaded, unexpected_keys):
+    """Copy the tensors of state_dict into the tensors of target (the state_dict of a model)."""
+    for key, tensor in state_dict.items():
+        if key not in target:
+            unexpected_keys.append(key)
+            continue
+        if target[key].shape != tensor.shape:
+            raise RuntimeError(
+                f"size mismatch for {key}: copying a param with shape {tuple(tensor.shape)} "
+                f"from checkpoint, the shape in current model is {tuple(target[key].shape)}."
+            )
+        target[key].copy_(tensor)
+        loaded.add(key)
+
+
+def _check_load_stats(model, stats, strict):
+    if strict and (stats.missing_keys or stats.unexpected_keys):
+        raise RuntimeError(
+            f"Error(s) in loading state_dict for {model.__class__.__name__}: "
+            f"missing keys {stats.missing_keys}, unexpected keys {stats.unexpected_keys}"
+        )
+    logger.info(stats)
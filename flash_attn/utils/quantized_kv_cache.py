@@ -0,0 +1,94 @@
+# Quantized KV cache for inference.
+# The KV cache of each layer is stored in int8 (or fp8, if supported by the PyTorch version) with
+# one scale per head, or per group of group_size channels of each head, of each token. Keys and
+# values are quantized when they are written to the cache and dequantized when they are read, so
+# attention runs in the dtype of the model (with the PyTorch attention, FlashAttention can't read
+# the quantized cache). This divides the memory of the KV cache by ~2 compared to fp16 / bf16.
+import torch
+from einops import rearrange
+
+QUANT_DTYPES = [torch.int8] + (
+    [torch.float8_e4m3fn, torch.float8_e5m2] if hasattr(torch, "float8_e4m3fn") else []
+)
+
+
+def _quant_max(quant_dtype):
+    if quant_dtype == torch.int8:
+        return 127.0
+    return torch.finfo(quant_dtype).max
+
+
+def quantize_kv(kv, quant_dtype=torch.int8, group_size=None):
+    """Symmetric quantization of kv with one scale per group of group_size channels of the last
+    dimension (default: the whole last dimension, i.e. one scale per head).
+    kv: (..., headdim)
+    Return:
+        kv_quant: (..., headdim), dtype quant_dtype
+        scales: (..., headdim // group_size), same dtype as kv
+    """
+    assert quant_dtype in QUANT_DTYPES, f"Quantized KV cache dtype must be one of {QUANT_DTYPES}"
+    dtype, headdim = kv.dtype, kv.shape[-1]
+    group_size = headdim if group_size is None else group_size
+    assert headdim % group_size == 0, "headdim must be divisible by group_size"
+    kv = rearrange(kv.float(), "... (n g) -> ... n g", g=group_size)
+    scales = kv.abs().amax(dim=-1) / _quant_max(quant_dtype)
+    kv = kv / scales.clamp(min=torch.finfo(torch.float32).tiny).unsqueeze(-1)
+    if quant_dtype == torch.int8:
+        kv = kv.round().clamp(-127, 127)
+    return rearrange(kv.to(quant_dtype), "... n g -> ... (n g)"), scales.to(dtype)
+
+
+def dequantize_kv(kv_quant, scales, dtype=torch.float16):
+    """Inverse of quantize_kv. Return: (..., headdim), dtype dtype"""
+    group_size = kv_quant.shape[-1] // scales.shape[-1]
+    kv = rearrange(kv_quant.float(), "... (n g) -> ... n g", g=group_size)
+    return rearrange(kv * scales.float().unsqueeze(-1), "... n g -> ... (n g)").to(dtype)
+
+
+class QuantizedKVCache:
+    """KV cache of one layer, of shape (batch_size, seqlen, 2, nheads, headdim) (or
+    (num_blocks, block_size, 2, nheads, headdim) for a paged KV cache), that can be used in place
+    of the dense tensor: indexing returns the dequantized keys and values, and assigning to an index
+    quantizes them. Only indexing over the dimensions before headdim is supported, which is how
+    the KV cache is accessed (see flash_attn.modules.mha._update_kv_cache).
+    """
+
+    def __init__(
+        self, shape, dtype=torch.float16, device=None, quant_dtype=torch.int8, group_size=None
+    ):
+        group_size = shape[-1] if group_size is None else group_size
+        assert quant_dtype in QUANT_DTYPES, f"KV cache dtype must be one of {QUANT_DTYPES}"
+        assert shape[-1] % group_size == 0, "headdim must be divisible by group_size"
+        self.dtype = dtype
+        self.quant_dtype = quant_dtype
+        self.group_size = group_size
+        self.data = torch.zeros(shape, dtype=quant_dtype, device=device)
+        self.scales = torch.zeros(
+            *shape[:-1], shape[-1] // group_size, dtype=dtype, device=device
+        )
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def device(self):
+        return self.data.device
+
+    @property
+    def nbytes(self):
+        """Memory used by the quantized values and the scales."""
+        return self.data.nbytes + self.scales.nbytes
+
+    def __getitem__(self, idx):
+        return dequantize_kv(self.data[idx], self.scales[idx], dtype=self.dtype)
+
+    def __setitem__(self, idx, kv):
+        self.data[idx], self.scales[idx] = quantize_kv(
+            kv, quant_dtype=self.quant_dtype, group_size=self.group_size
+        )
+
+    def zero_(self):
+        self.data.zero_()
+        self.scales.zero_()
+        return self
@@ -0,0 +1,121 @@
+import os
+import tempfile
+
+import pytest
+import torch
+import torch.multiprocessing as mp
+from flash_attn.losses.cross_entropy import CrossEntropyLoss
+from flash_attn.ops.cross_entropy import cross_entropy_loss
+
+
+def _reference(x, y, smoothing, logit_scale, lse_square_scale):
+    x_scaled = x.float() * logit_scale
+    out = torch.nn.CrossEntropyLoss(label_smoothing=smoothing)(x_scaled, y)
+    lse = torch.logsumexp(x_scaled, dim=-1)
+    z_loss = lse_square_scale * (lse[y != -100] ** 2).mean()
+    return out + z_loss, z_loss
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+# @pytest.mark.parametrize("dtype", [torch.float32])
+@pytest.mark.parametrize("precompute_lse", [False, True])
+# @pytest.mark.parametrize("precompute_lse", [False])
+@pytest.mark.parametrize("inplace_backward", [False, True])
+# @pytest.mark.parametrize("inplace_backward", [False])
+@pytest.mark.parametrize("lse_square_scale", [0.0, 1e-2])
+# @pytest.mark.parametrize("lse_square_scale", [1e-2])
+@pytest.mark.parametrize("logit_scale", [1.0, 0.7])
+# @pytest.mark.parametrize("logit_scale", [1.0])
+@pytest.mark.parametrize("smoothing", [0.0, 0.9])
+# @pytest.mark.parametrize("smoothing", [0.0])
+@pytest.mark.parametrize("chunk_size", [None, 7])
+# @pytest.mark.parametrize("chunk_size", [7])
+def test_cross_entropy_loss_cpu(
+    chunk_size, smoothing, logit_scale, lse_square_scale, inplace_backward, precompute_lse, dtype
+):
+    if precompute_lse and (logit_scale != 1.0 or smoothing != 0.0):
+        pytest.skip("precompute_lse only works with logit_scale=1.0 and smoothing=0.0")
+    rtol, atol = (1e-5, 1e-6) if dtype == torch.float32 else (1e-2, 1e-3)
+    torch.random.manual_seed(0)
+    n_rows, vocab_size = 64, 1000
+    x_pt = torch.randn(n_rows, vocab_size, dtype=dtype, requires_grad=True)
+    x = x_pt.detach().clone().requires_grad_()
+    y = torch.randint(0, vocab_size, (n_rows,), dtype=torch.long)
+    y[torch.randperm(n_rows)[:10]] = -100
+    model = CrossEntropyLoss(
+        label_smoothing=smoothing,
+        logit_scale=logit_scale,
+        lse_square_scale=lse_square_scale,
+        return_z_loss=True,
+        inplace_backward=inplace_backward,
+    )
+    lse = torch.logsumexp(x.detach().float(), dim=-1) if precompute_lse else None
+    if chunk_size is not None:
+        out, out_z_loss = cross_entropy_loss(
+            x,
+            y,
+            precomputed_lse=lse,
+            label_smoothing=smoothing,
+            logit_scale=logit_scale,
+            lse_square_scale=lse_square_scale,
+            inplace_backward=inplace_backward,
+            chunk_size=chunk_size,
+        )
+        out, out_z_loss = out.sum() / (y != -100).sum(), out_z_loss.sum() / (y != -100).sum()
+    else:
+        out, out_z_loss = model(x, y, precomputed_lse=lse)
+    out_pt, z_loss_pt = _reference(x_pt, y, smoothing, logit_scale, lse_square_scale)
+    assert torch.allclose(out, out_pt, rtol=1e-5, atol=1e-6)
+    assert torch.allclose(out_z_loss, z_loss_pt, rtol=1e-5, atol=1e-6)
+
+    g = torch.randn_like(out)
+    out_pt.backward(g)
+    out.backward(g)
+    assert x.grad.dtype == dtype
+    assert torch.allclose(x.grad, x_pt.grad, rtol=rtol, atol=atol)
+
+
+def _run_parallel(rank, world_size, init_file, vocab_size, smoothing, lse_square_scale):
+    torch.distributed.init_process_group(
+        backend="gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size
+    )
+    torch.random.manual_seed(0)
+    n_rows = 32
+    partition_vocab_size = vocab_size // world_size
+    x_pt = torch.randn(n_rows, vocab_size, requires_grad=True)
+    y = torch.randint(0, vocab_size, (n_rows,), dtype=torch.long)
+    y[torch.randperm(n_rows)[:5]] = -100
+    vocab_slice = slice(rank * partition_vocab_size, (rank + 1) * partition_vocab_size)
+    x = x_pt[:, vocab_slice].detach().clone().requires_grad_()
+    model = CrossEntropyLoss(
+        label_smoothing=smoothing,
+        logit_scale=0.7,
+        lse_square_scale=lse_square_scale,
+        process_group=torch.distributed.group.WORLD,
+    )
+    out = model(x, y)
+    out_pt, _ = _reference(x_pt, y, smoothing, 0.7, lse_square_scale)
+    assert torch.allclose(out, out_pt, rtol=1e-5, atol=1e-6)
+    g = torch.randn_like(out)
+    out_pt.backward(g)
+    out.backward(g)
+    assert torch.allclose(x.grad, x_pt.grad[:, vocab_slice], rtol=1e-5, atol=1e-6)
+    torch.distributed.destroy_process_group()
+
+
+@pytest.mark.parametrize("lse_square_scale", [0.0, 1e-2])
+# @pytest.mark.parametrize("lse_square_scale", [1e-2])
+@pytest.mark.parametrize("smoothing", [0.0, 0.9])
+# @pytest.mark.parametrize("smoothing", [0.0])
+@pytest.mark.parametrize("world_size", [2, 3])
+# @pytest.mark.parametrize("world_size", [2])
+def test_cross_entropy_loss_parallel_cpu(world_size, smoothing, lse_square_scale):
+    """Tensor Parallel on CPU, with the vocab split across gloo processes."""
+    vocab_size = 1002  # Divisible by the world sizes
+    with tempfile.TemporaryDirectory() as tmpdir:
+        init_file = os.path.join(tmpdir, "init")
+        mp.spawn(
+            _run_parallel,
+            args=(world_size, init_file, vocab_size, smoothing, lse_square_scale),
+            nprocs=world_size,
+        )
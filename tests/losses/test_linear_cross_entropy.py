@@ -0,0 +1,103 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from flash_attn.losses.linear_cross_entropy import LinearCrossEntropyLoss
+
+
+@pytest.mark.parametrize("has_bias", [False, True])
+# @pytest.mark.parametrize("has_bias", [False])
+@pytest.mark.parametrize("lse_square_scale", [0.0, 1e-2])
+@pytest.mark.parametrize("return_z_loss", [False, True])
+# @pytest.mark.parametrize("lse_square_scale", [1e-2])
+@pytest.mark.parametrize("logit_scale", [1.0, 0.7])
+# @pytest.mark.parametrize("logit_scale", [1.0])
+@pytest.mark.parametrize("smoothing", [0.0, 0.9])
+# @pytest.mark.parametrize("smoothing", [0.0])
+@pytest.mark.parametrize("reduction", ["mean", "sum", "none"])
+# @pytest.mark.parametrize("reduction", ["mean"])
+@pytest.mark.parametrize("chunk_sizes", [(16, 24), (37, 100), (1024, 1024)])
+# @pytest.mark.parametrize("chunk_sizes", [(16, 24)])
+def test_linear_cross_entropy_loss(
+    chunk_sizes, reduction, smoothing, logit_scale, lse_square_scale, return_z_loss, has_bias
+):
+    """The chunked loss should match the LM head followed by the regular cross-entropy loss."""
+    device = "cpu"
+    dtype = torch.float32
+    token_chunk_size, vocab_chunk_size = chunk_sizes
+    torch.random.manual_seed(0)
+    batch_size, seqlen, hidden_dim, vocab_size = 2, 50, 32, 250
+    x_pt = torch.randn(batch_size, seqlen, hidden_dim, device=device, dtype=dtype)
+    x_pt.requires_grad_()
+    w_pt = torch.randn(vocab_size, hidden_dim, device=device, dtype=dtype) / hidden_dim**0.5
+    w_pt.requires_grad_()
+    b_pt = torch.randn(vocab_size, device=device, dtype=dtype, requires_grad=True)
+    x, w, b = [t.detach().clone().requires_grad_() for t in [x_pt, w_pt, b_pt]]
+    y = torch.randint(0, vocab_size, (batch_size, seqlen), dtype=torch.long, device=device)
+    y[0, :5] = -100
+    y[1, -3:] = -100
+    model = LinearCrossEntropyLoss(
+        reduction=reduction,
+        label_smoothing=smoothing,
+        logit_scale=logit_scale,
+        lse_square_scale=lse_square_scale,
+        return_z_loss=return_z_loss,
+        token_chunk_size=token_chunk_size,
+        vocab_chunk_size=vocab_chunk_size,
+    )
+    if return_z_loss:
+        out, out_z_loss = model(x, w, y, bias=b if has_bias else None)
+    else:
+        out = model(x, w, y, bias=b if has_bias else None)
+    logits_pt = F.linear(x_pt, w_pt, b_pt if has_bias else None) * logit_scale
+    out_pt = F.cross_entropy(
+        logits_pt.flatten(0, 1), y.flatten(), label_smoothing=smoothing, reduction="none"
+    ).view(batch_size, seqlen)
+    z_loss_pt = lse_square_scale * torch.logsumexp(logits_pt, dim=-1) ** 2
+    z_loss_pt = z_loss_pt.masked_fill(y == -100, 0.0)
+    out_pt = out_pt + z_loss_pt
+    if reduction == "mean":
+        out_pt = out_pt.sum() / (y != -100).sum()
+        z_loss_pt = z_loss_pt.sum() / (y != -100).sum()
+    elif reduction == "sum":
+        out_pt, z_loss_pt = out_pt.sum(), z_loss_pt.sum()
+    assert out.shape == out_pt.shape
+    assert torch.allclose(out, out_pt, rtol=1e-5, atol=1e-5)
+    if return_z_loss:
+        assert torch.allclose(out_z_loss, z_loss_pt, rtol=1e-5, atol=1e-6)
+
+    g = torch.randn_like(out)
+    out_pt.backward(g)
+    out.backward(g)
+    assert torch.allclose(x.grad, x_pt.grad, rtol=1e-4, atol=1e-5)
+    assert torch.allclose(w.grad, w_pt.grad, rtol=1e-4, atol=1e-5)
+    if has_bias:
+        assert torch.allclose(b.grad, b_pt.grad, rtol=1e-4, atol=1e-5)
+    else:
+        assert b.grad is None
+
+
+def test_gpt_linear_cross_entropy_loss():
+    """Passing labels to the model should give the loss of its logits, and the same gradients."""
+    from transformers import GPT2Config
+
+    from flash_attn.models.gpt import GPTLMHeadModel
+
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device="cpu", dtype=torch.float32)
+    model.eval()  # No dropout
+    input_ids = torch.randint(0, config.vocab_size, (2, 16))
+    labels = torch.roll(input_ids, -1, dims=1)
+    labels[:, -1] = -100
+    loss_fn = LinearCrossEntropyLoss(token_chunk_size=10, vocab_chunk_size=48)
+    loss = model(input_ids, labels=labels, loss_fn=loss_fn).loss
+    loss.backward()
+    grads = {name: p.grad.clone() for name, p in model.named_parameters()}
+    model.zero_grad()
+    logits = model(input_ids).logits
+    loss_ref = F.cross_entropy(logits.flatten(0, 1), labels.flatten())
+    loss_ref.backward()
+    assert torch.allclose(loss, loss_ref, rtol=1e-5, atol=1e-6)
+    for name, p in model.named_parameters():
+        assert torch.allclose(grads[name], p.grad, rtol=1e-4, atol=1e-6), name
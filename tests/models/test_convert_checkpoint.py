@@ -0,0 +1,74 @@
+import pytest
+import torch
+from safetensors.torch import load_file
+from transformers import GPT2Config, GPT2Model, LlamaConfig, LlamaForCausalLM
+
+from flash_attn.models.convert_checkpoint import (
+    convert_from_tp_checkpoint,
+    convert_to_tp_checkpoint,
+)
+from flash_attn.models.gpt import GPTLMHeadModel, remap_state_dict_hf_gpt2, shard_state_dict_tp
+from flash_attn.models.llama import llama_config_to_gpt2_config, remap_state_dict_hf_llama
+from flash_attn.utils.pretrained import (
+    is_tp_checkpoint,
+    state_dict_from_pretrained,
+    state_dict_from_tp_checkpoint,
+)
+
+
+@pytest.mark.parametrize("world_size", [1, 2, 4])
+# @pytest.mark.parametrize("world_size", [2])
+def test_llama_tp_checkpoint_roundtrip(world_size, tmp_path):
+    hf_config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+    )
+    torch.manual_seed(0)
+    LlamaForCausalLM(hf_config).save_pretrained(tmp_path / "hf")
+    config = llama_config_to_gpt2_config(hf_config)
+    manifest = convert_to_tp_checkpoint(
+        str(tmp_path / "hf"), str(tmp_path / "tp"), world_size=world_size
+    )
+    assert is_tp_checkpoint(str(tmp_path / "tp"))
+    assert manifest["world_size"] == world_size and manifest["dtype"] == "float32"
+    state_dict = remap_state_dict_hf_llama(state_dict_from_pretrained(str(tmp_path / "hf")), config)
+    for rank in range(world_size):
+        shard_ref = shard_state_dict_tp(dict(state_dict), config, world_size, rank)
+        shard = state_dict_from_tp_checkpoint(str(tmp_path / "tp"), world_size, rank)
+        assert shard.keys() == shard_ref.keys()
+        for key, value in shard.items():
+            assert torch.equal(value, shard_ref[key]), key
+    with pytest.raises(ValueError):
+        state_dict_from_tp_checkpoint(str(tmp_path / "tp"), world_size + 1, 0)
+
+    # Back to the Hugging Face format
+    convert_from_tp_checkpoint(str(tmp_path / "tp"), str(tmp_path / "hf_roundtrip"))
+    state_dict_hf = state_dict_from_pretrained(str(tmp_path / "hf"))
+    state_dict_roundtrip = load_file(tmp_path / "hf_roundtrip" / "model.safetensors")
+    assert state_dict_roundtrip.keys() == state_dict_hf.keys()
+    for key, value in state_dict_roundtrip.items():
+        assert torch.equal(value, state_dict_hf[key]), key
+    assert LlamaConfig.from_pretrained(tmp_path / "hf_roundtrip").hidden_size == 64
+
+
+def test_gpt_from_pretrained_tp_checkpoint(tmp_path):
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    GPT2Model(config).save_pretrained(tmp_path / "hf")
+    convert_to_tp_checkpoint(str(tmp_path / "hf"), str(tmp_path / "tp"), dtype=torch.float16)
+    model = GPTLMHeadModel.from_pretrained(
+        str(tmp_path / "tp"), config, device="cpu", dtype=torch.float16
+    )
+    model_ref = GPTLMHeadModel(config, device="cpu", dtype=torch.float16)
+    model_ref.load_state_dict(
+        remap_state_dict_hf_gpt2(
+            state_dict_from_pretrained(str(tmp_path / "hf"), dtype=torch.float16), config
+        )
+    )
+    state_dict_ref = model_ref.state_dict()
+    for key, value in model.state_dict().items():
+        assert torch.equal(value, state_dict_ref[key]), key
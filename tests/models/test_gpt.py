@@ -476,3 +476,37 @@ def test_gpt2_shard_unshard(n_heads_q_kv):
         ref = state_dict[k]
         new = state_dict[k]
         assert torch.allclose(ref, new, atol=0.0, rtol=0.0)
+
+
+# @pytest.mark.parametrize("n_heads_q_kv", [(8, 2)])
+@pytest.mark.parametrize("n_heads_q_kv", [(8, 8), (8, 2)])
+# @pytest.mark.parametrize("use_flash_attn", [False])
+@pytest.mark.parametrize("use_flash_attn", [False, True])
+# @pytest.mark.parametrize("rotary", [True])
+@pytest.mark.parametrize("rotary", [False, True])
+def test_gpt2_packed_documents(rotary, use_flash_attn, n_heads_q_kv):
+    """Check that documents packed into sequences with cu_seqlens get the same logits as when
+    each document is run through the model on its own.
+    """
+    dtype = torch.float16
+    device = "cuda"
+    rtol, atol = 3e-3, 3e-2
+    config = GPT2Config(n_embd=512, n_layer=2, vocab_size=1024, n_positions=128)
+    config.n_head, config.n_head_kv = n_heads_q_kv
+    if rotary:
+        config.n_positions = 0
+        config.rotary_emb_fraction = 0.5
+    config.use_flash_attn = use_flash_attn
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=dtype)
+    model.eval()
+
+    doc_lens = [[5, 27, 32], [64], [1, 40, 23]]
+    input_ids = torch.randint(0, config.vocab_size, (len(doc_lens), 64), device=device)
+    seqlens = torch.tensor([l for lens in doc_lens for l in lens], device=device)
+    cu_seqlens = torch.nn.functional.pad(seqlens.cumsum(0, dtype=torch.int32), (1, 0))
+    with torch.no_grad():
+        logits = model(input_ids, cu_seqlens=cu_seqlens, max_seqlen=64).logits
+        docs = rearrange(input_ids, "b s -> (b s)").split(seqlens.tolist())
+        logits_ref = torch.cat([model(doc[None]).logits[0] for doc in docs])
+    assert torch.allclose(rearrange(logits, "b s v -> (b s) v"), logits_ref, rtol=rtol, atol=atol)
@@ -0,0 +1,226 @@
+import pytest
+import torch
+from flash_attn.modules.mha import MHA, CrossAttention, SelfAttention, get_alibi_slopes
+from flash_attn.modules.mha import _tree_attention
+from flash_attn.utils.generation import InferenceParams, tree_attention_mask
+
+
+@pytest.mark.parametrize("alibi", [False, True])
+# @pytest.mark.parametrize("alibi", [False])
+@pytest.mark.parametrize("window_size", [(-1, -1), (16, 8), (5, 0)])
+# @pytest.mark.parametrize("window_size", [(-1, -1)])
+@pytest.mark.parametrize("causal", [False, True])
+# @pytest.mark.parametrize("causal", [True])
+@pytest.mark.parametrize("chunk_size", [7, 32])
+# @pytest.mark.parametrize("chunk_size", [7])
+@pytest.mark.parametrize("seqlen", [1, 50, 128])
+# @pytest.mark.parametrize("seqlen", [50])
+def test_self_attention_chunked(seqlen, chunk_size, causal, window_size, alibi):
+    """The chunked (online softmax) attention should match the dense attention."""
+    device = "cpu"
+    torch.random.manual_seed(0)
+    batch_size, nheads, headdim = 2, 4, 32
+    qkv = torch.randn(batch_size, seqlen, 3, nheads, headdim, device=device)
+    key_padding_mask = torch.arange(seqlen, device=device) < torch.tensor(
+        [[seqlen], [max(seqlen // 2, 1)]], device=device
+    )
+    alibi_slopes = torch.tensor(get_alibi_slopes(nheads), device=device) if alibi else None
+    kwargs = dict(causal=causal, window_size=window_size, alibi_slopes=alibi_slopes)
+    attn_ref = SelfAttention(**kwargs)
+    attn = SelfAttention(chunk_size=chunk_size, **kwargs)
+    for mask in [None, key_padding_mask]:
+        out_ref = attn_ref(qkv, key_padding_mask=mask)
+        out = attn(qkv, key_padding_mask=mask)
+        if mask is not None:  # Outputs of padding tokens are not defined
+            out, out_ref = out[mask], out_ref[mask]
+        assert torch.allclose(out, out_ref, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("alibi", [False, True])
+# @pytest.mark.parametrize("alibi", [False])
+@pytest.mark.parametrize("window_size", [(-1, -1), (16, 8)])
+# @pytest.mark.parametrize("window_size", [(-1, -1)])
+@pytest.mark.parametrize("causal", [False, True])
+# @pytest.mark.parametrize("causal", [True])
+@pytest.mark.parametrize("nheads_kv", [8, 2, 1])
+# @pytest.mark.parametrize("nheads_kv", [2])
+@pytest.mark.parametrize("seqlen_q,seqlen_k", [(1, 100), (37, 100), (64, 64)])
+# @pytest.mark.parametrize("seqlen_q,seqlen_k", [(37, 100)])
+def test_cross_attention_chunked(seqlen_q, seqlen_k, nheads_kv, causal, window_size, alibi):
+    device = "cpu"
+    torch.random.manual_seed(0)
+    batch_size, nheads, headdim = 2, 8, 32
+    q = torch.randn(batch_size, seqlen_q, nheads, headdim, device=device)
+    kv = torch.randn(batch_size, seqlen_k, 2, nheads_kv, headdim, device=device)
+    # Every query should attend to at least one key, otherwise the outputs aren't defined
+    key_padding_mask = torch.arange(seqlen_k, device=device) < torch.tensor(
+        [[seqlen_k], [max(seqlen_k - 20, seqlen_q)]], device=device
+    )
+    alibi_slopes = torch.tensor(get_alibi_slopes(nheads), device=device) if alibi else None
+    kwargs = dict(causal=causal, window_size=window_size, alibi_slopes=alibi_slopes)
+    attn_ref = CrossAttention(**kwargs)
+    attn = CrossAttention(chunk_size=16, **kwargs)
+    for mask in [None, key_padding_mask]:
+        out_ref = attn_ref(q, kv, key_padding_mask=mask)
+        out = attn(q, kv, key_padding_mask=mask)
+        assert torch.allclose(out, out_ref, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("alibi", [False, True])
+# @pytest.mark.parametrize("alibi", [False])
+@pytest.mark.parametrize("window_size", [(-1, -1), (4, 0)])
+# @pytest.mark.parametrize("window_size", [(4, 0)])
+@pytest.mark.parametrize("causal", [False, True])
+# @pytest.mark.parametrize("causal", [True])
+def test_attention_chunked_fully_masked_rows(causal, window_size, alibi):
+    """Rows where all the keys are masked out (fully padded sequence, left padding, queries
+    outside of the window of every key) should get the same output with the chunked attention as
+    with the dense attention."""
+    device = "cpu"
+    torch.random.manual_seed(0)
+    batch_size, seqlen, seqlen_q, nheads, headdim = 3, 40, 10, 4, 32
+    qkv = torch.randn(batch_size, seqlen, 3, nheads, headdim, device=device)
+    q = torch.randn(batch_size, seqlen_q, nheads, headdim, device=device)
+    # Fully padded, left padded and not padded sequences
+    key_padding_mask = torch.stack(
+        [
+            torch.zeros(seqlen, dtype=torch.bool, device=device),
+            torch.arange(seqlen, device=device) >= 25,
+            torch.ones(seqlen, dtype=torch.bool, device=device),
+        ]
+    )
+    alibi_slopes = torch.tensor(get_alibi_slopes(nheads), device=device) if alibi else None
+    kwargs = dict(causal=causal, window_size=window_size, alibi_slopes=alibi_slopes)
+    for attn_cls in [SelfAttention, CrossAttention]:
+        attn_ref = attn_cls(**kwargs)
+        attn = attn_cls(chunk_size=8, **kwargs)
+        if attn_cls is SelfAttention:
+            out_ref = attn_ref(qkv, key_padding_mask=key_padding_mask)
+            out = attn(qkv, key_padding_mask=key_padding_mask)
+        else:
+            out_ref = attn_ref(q, qkv[:, :, 1:], key_padding_mask=key_padding_mask)
+            out = attn(q, qkv[:, :, 1:], key_padding_mask=key_padding_mask)
+        assert torch.allclose(out, out_ref, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 16])
+# @pytest.mark.parametrize("chunk_size", [None])
+@pytest.mark.parametrize("causal", [False, True])
+# @pytest.mark.parametrize("causal", [True])
+def test_attention_varlen(causal, chunk_size):
+    """Attention on packed sequences with cu_seqlens should match attention on each sequence."""
+    device = "cpu"
+    torch.random.manual_seed(0)
+    nheads, nheads_kv, headdim = 4, 2, 32
+    seqlens, seqlens_k = [5, 1, 33, 17], [9, 30, 33, 2]
+    cu_seqlens = torch.tensor([0] + seqlens, device=device).cumsum(0).to(torch.int32)
+    cu_seqlens_k = torch.tensor([0] + seqlens_k, device=device).cumsum(0).to(torch.int32)
+    qkv = torch.randn(sum(seqlens), 3, nheads, headdim, device=device)
+    q = torch.randn(sum(seqlens), nheads, headdim, device=device)
+    kv = torch.randn(sum(seqlens_k), 2, nheads_kv, headdim, device=device)
+    self_attn = SelfAttention(causal=causal, chunk_size=chunk_size)
+    cross_attn = CrossAttention(causal=causal, chunk_size=chunk_size)
+    out = self_attn(qkv, cu_seqlens=cu_seqlens, max_seqlen=max(seqlens))
+    out_cross = cross_attn(
+        q,
+        kv,
+        cu_seqlens=cu_seqlens,
+        max_seqlen=max(seqlens),
+        cu_seqlens_k=cu_seqlens_k,
+        max_seqlen_k=max(seqlens_k),
+    )
+    assert out.shape == (sum(seqlens), nheads, headdim)
+    assert out_cross.shape == (sum(seqlens), nheads, headdim)
+    for i in range(len(seqlens)):
+        start, end = cu_seqlens[i].item(), cu_seqlens[i + 1].item()
+        start_k, end_k = cu_seqlens_k[i].item(), cu_seqlens_k[i + 1].item()
+        out_ref = self_attn(qkv[None, start:end])[0]
+        assert torch.allclose(out[start:end], out_ref, rtol=1e-4, atol=1e-5)
+        if causal and end - start > end_k - start_k:
+            continue  # Some queries don't attend to any key, the outputs aren't defined
+        out_cross_ref = cross_attn(q[None, start:end], kv[None, start_k:end_k])[0]
+        assert torch.allclose(out_cross[start:end], out_cross_ref, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 4])
+# @pytest.mark.parametrize("chunk_size", [None])
+def test_cross_attention_tree_mask(chunk_size):
+    """Attention of the nodes of a tree with a tree mask should match attention of each node to
+    the cached tokens and its ancestors only."""
+    device = "cpu"
+    torch.random.manual_seed(0)
+    batch_size, nheads, headdim, cache_seqlen = 2, 4, 32, 10
+    # Root, 2 children of the root, 2 children of node 1, 1 child of node 2
+    parents = [-1, 0, 0, 1, 1, 2]
+    tree_mask = tree_attention_mask(parents, device=device)
+    num_nodes = len(parents)
+    q = torch.randn(batch_size, num_nodes, nheads, headdim, device=device)
+    kv = torch.randn(batch_size, cache_seqlen + num_nodes, 2, nheads, headdim, device=device)
+    attn_mask = torch.cat(
+        [torch.ones(num_nodes, cache_seqlen, dtype=torch.bool, device=device), tree_mask], dim=1
+    ).expand(batch_size, -1, -1)
+    attn = CrossAttention(chunk_size=chunk_size)
+    out = attn(q, kv, attn_mask=attn_mask)
+    for i in range(num_nodes):
+        ancestors = [j for j in range(num_nodes) if tree_mask[i, j]]
+        kv_path = torch.cat([kv[:, :cache_seqlen], kv[:, [cache_seqlen + j for j in ancestors]]], 1)
+        out_ref = attn(q[:, i : i + 1], kv_path)
+        assert torch.allclose(out[:, i : i + 1], out_ref, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("window_size", [(-1, -1), (4, 0), (0, 0)])
+# @pytest.mark.parametrize("window_size", [(4, 0)])
+def test_tree_attention_sliding_window(window_size):
+    """With a sliding window, each node of a tree should attend to the cached tokens and its
+    ancestors in the window, with the node at the position of its depth in the tree."""
+    device = "cpu"
+    torch.random.manual_seed(0)
+    batch_size, nheads, headdim, cache_seqlen = 2, 4, 32, 10
+    parents = [-1, 0, 0, 1, 1, 2]
+    tree_mask = tree_attention_mask(parents, device=device)
+    num_nodes = len(parents)
+    q = torch.randn(batch_size, num_nodes, nheads, headdim, device=device)
+    kv = torch.randn(batch_size, cache_seqlen + num_nodes, 2, nheads, headdim, device=device)
+    key_padding_mask = torch.ones(batch_size, cache_seqlen + num_nodes, dtype=torch.bool)
+    attn = CrossAttention(window_size=window_size)
+    out = _tree_attention(attn, q, kv, key_padding_mask, tree_mask)
+    for i in range(num_nodes):
+        ancestors = [j for j in range(num_nodes) if tree_mask[i, j]]
+        kv_path = torch.cat([kv[:, :cache_seqlen], kv[:, [cache_seqlen + j for j in ancestors]]], 1)
+        out_ref = attn(q[:, i : i + 1], kv_path)
+        assert torch.allclose(out[:, i : i + 1], out_ref, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("num_heads_kv", [4, 2])
+# @pytest.mark.parametrize("num_heads_kv", [4])
+@pytest.mark.parametrize("window", [1, 6, 16])
+# @pytest.mark.parametrize("window", [6])
+def test_mha_sliding_window_kv_cache(window, num_heads_kv):
+    """Prefill and decoding with a ring buffer KV cache of the size of the window should match
+    the local attention over the whole sequence."""
+    device = "cpu"
+    torch.random.manual_seed(0)
+    embed_dim, num_heads, batch_size, seqlen = 64, 4, 2, 30
+    mha = MHA(
+        embed_dim,
+        num_heads,
+        num_heads_kv=num_heads_kv,
+        causal=True,
+        layer_idx=0,
+        window_size=(window, 0),
+        device=device,
+    )
+    x = torch.randn(batch_size, seqlen, embed_dim, device=device)
+    out_ref = mha(x)
+    inference_params = InferenceParams(
+        max_seqlen=seqlen, max_batch_size=batch_size, sliding_window_kv_cache=True
+    )
+    out = []
+    for chunk in [10, 1, 3, 1, 7, 1, 1, 6]:
+        start = inference_params.seqlen_offset
+        out.append(mha(x[:, start : start + chunk], inference_params=inference_params))
+        inference_params.seqlen_offset += chunk
+    assert torch.allclose(torch.cat(out, dim=1), out_ref, rtol=1e-4, atol=1e-5)
+    assert inference_params.key_value_memory_dict[0].shape[:2] == (batch_size, window)
+    kv_cache = mha.allocate_inference_cache(batch_size, 1000, sliding_window_kv_cache=True)
+    assert kv_cache.shape[1] == window
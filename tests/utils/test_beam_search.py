@@ -0,0 +1,106 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.generation import decode, decode_beam
+
+
+def beam_search_reference(
+    model, input_ids, max_length, num_beams, length_penalty, early_stopping, eos_token_id
+):
+    """Beam search without KV cache, for a single sequence: every step runs the model on the
+    whole sequence of every beam, and scores every possible continuation.
+    Return the tokens of the best beam and its score."""
+    beams = [(0.0, [])]  # (sum of log-probabilities, generated tokens)
+    finished = []  # (score, generated tokens)
+    length = 0
+    while True:
+        length += 1
+        candidates = []
+        for sum_logprobs, tokens in beams:
+            seq = torch.cat([input_ids, torch.tensor(tokens, dtype=torch.long)])
+            logprobs = F.log_softmax(model(seq[None]).logits[0, -1].float(), dim=-1)
+            for token, logprob in enumerate(logprobs.tolist()):
+                candidates.append((sum_logprobs + logprob, tokens + [token]))
+        candidates.sort(key=lambda c: c[0], reverse=True)
+        beams = []
+        for rank, (sum_logprobs, tokens) in enumerate(candidates):
+            if tokens[-1] == eos_token_id:
+                if rank < num_beams:
+                    finished.append((sum_logprobs / length**length_penalty, tokens))
+            else:
+                beams.append((sum_logprobs, tokens))
+            if len(beams) == num_beams:
+                break
+        finished = sorted(finished, key=lambda f: f[0], reverse=True)[:num_beams]
+        done = len(finished) == num_beams and (
+            early_stopping or candidates[0][0] / length**length_penalty <= finished[-1][0]
+        )
+        if done:
+            break
+        if input_ids.shape[0] + length >= max_length:
+            finished += [(s / length**length_penalty, tokens) for s, tokens in beams]
+            finished = sorted(finished, key=lambda f: f[0], reverse=True)
+            break
+    return finished[0][1], finished[0][0]
+
+
+def _get_model():
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=32, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device="cpu", dtype=torch.float32)
+    model.eval()
+    return model, config
+
+
+@pytest.mark.parametrize("early_stopping", [False, True])
+# @pytest.mark.parametrize("early_stopping", [False])
+@pytest.mark.parametrize("length_penalty", [1.0, 0.0, 2.0])
+# @pytest.mark.parametrize("length_penalty", [1.0])
+@pytest.mark.parametrize("num_beams", [2, 4])
+# @pytest.mark.parametrize("num_beams", [4])
+def test_decode_beam(num_beams, length_penalty, early_stopping):
+    """Beam search with the KV cache reordered between steps should find the same best beams as
+    beam search without KV cache."""
+    model, config = _get_model()
+    batch_size, seqlen, max_length = 3, 5, 20
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen))
+    # A token that the model generates often, so that some beams finish before max_length
+    greedy = decode(input_ids, model, max_length).sequences[:, seqlen:]
+    eos_token_id = torch.bincount(greedy.flatten(), minlength=config.vocab_size).argmax().item()
+    out = decode_beam(
+        input_ids,
+        model,
+        max_length,
+        num_beams=num_beams,
+        length_penalty=length_penalty,
+        early_stopping=early_stopping,
+        eos_token_id=eos_token_id,
+        pad_token_id=-1,
+    )
+    assert torch.equal(out.sequences[:, :seqlen], input_ids)
+    for b in range(batch_size):
+        with torch.inference_mode():
+            tokens_ref, score_ref = beam_search_reference(
+                model,
+                input_ids[b],
+                max_length,
+                num_beams,
+                length_penalty,
+                early_stopping,
+                eos_token_id,
+            )
+        tokens = out.sequences[b, seqlen:]
+        assert tokens[tokens != -1].tolist() == tokens_ref
+        assert abs(out.sequences_scores[b].item() - score_ref) < 1e-4
+
+
+def test_decode_beam_single_beam():
+    """Beam search with one beam is greedy decoding."""
+    model, config = _get_model()
+    input_ids = torch.randint(0, config.vocab_size, (2, 5))
+    out_ref = decode(input_ids, model, 20)
+    out = decode_beam(input_ids, model, 20, num_beams=1)
+    assert torch.equal(out.sequences, out_ref.sequences)
@@ -0,0 +1,64 @@
+import pytest
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.continuous_batching import ContinuousBatchingEngine
+from flash_attn.utils.generation import decode
+
+
+def _get_model():
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device="cpu", dtype=torch.float32)
+    model.eval()
+    return model, config
+
+
+@pytest.mark.parametrize("prefill_chunk_size", [1, 4, 7, 32])
+# @pytest.mark.parametrize("prefill_chunk_size", [4])
+def test_decode_chunked_prefill(prefill_chunk_size):
+    """Prefilling the prompt by chunks should give the same outputs as prefilling it at once."""
+    model, config = _get_model()
+    input_ids = torch.randint(0, config.vocab_size, (2, 19))
+    kwargs = dict(max_length=30, top_k=1, return_dict_in_generate=True, output_scores=True)
+    out_ref = decode(input_ids, model, **kwargs)
+    out = decode(input_ids, model, prefill_chunk_size=prefill_chunk_size, **kwargs)
+    assert torch.equal(out.sequences, out_ref.sequences)
+    # The order of the reductions can differ, so the logits are only close
+    for scores, scores_ref in zip(out.scores, out_ref.scores):
+        assert torch.allclose(scores, scores_ref, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("prefill_chunk_size", [3, 8])
+# @pytest.mark.parametrize("prefill_chunk_size", [3])
+def test_continuous_batching_chunked_prefill(prefill_chunk_size):
+    """With chunked prefill, the requests that are already running keep being decoded while a
+    long prompt is prefilled, and the outputs are the same as with a one-shot prefill."""
+    model, config = _get_model()
+    seqlens = [3, 25, 6, 17]
+    max_new_tokens = [10, 5, 8, 6]
+    prompts = [torch.randint(0, config.vocab_size, (l,)) for l in seqlens]
+
+    def run(prefill_chunk_size):
+        engine = ContinuousBatchingEngine(
+            model, max_batch_size=3, max_seqlen=40, prefill_chunk_size=prefill_chunk_size
+        )
+        requests = [engine.add_request(p, n) for p, n in zip(prompts, max_new_tokens)]
+        num_tokens = []
+        outputs = {}
+        while engine.scheduler.has_unfinished():
+            for request in engine.step():
+                outputs[request.request_id] = request.output_ids
+            num_tokens.append([len(r.output_ids) for r in requests])
+        return outputs, num_tokens
+
+    outputs_ref, _ = run(None)
+    outputs, num_tokens = run(prefill_chunk_size)
+    assert outputs == outputs_ref
+    # Request 0 is prefilled in one chunk, then decoded at every step while the prompt of
+    # request 1 is being prefilled
+    num_chunks = (seqlens[1] + prefill_chunk_size - 1) // prefill_chunk_size
+    assert [n[0] for n in num_tokens[:num_chunks]] == list(range(2, num_chunks + 2))
+    assert all(n[1] == 0 for n in num_tokens[: num_chunks - 1])
+    assert num_tokens[num_chunks - 1][1] == 2
@@ -0,0 +1,76 @@
+import pytest
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.continuous_batching import (
+    ContinuousBatchingEngine,
+    GenerationRequest,
+    SlotScheduler,
+)
+
+
+def greedy_reference(model, input_ids, max_new_tokens):
+    """Decode without KV cache, one full forward per token."""
+    cur_ids = input_ids[None]
+    output_ids = []
+    with torch.inference_mode():
+        for _ in range(max_new_tokens):
+            token = model(cur_ids).logits[:, -1].argmax(dim=-1)
+            output_ids.append(token.item())
+            cur_ids = torch.cat([cur_ids, token[:, None]], dim=1)
+    return output_ids
+
+
+def test_slot_scheduler():
+    scheduler = SlotScheduler(max_batch_size=2, max_seqlen=32)
+    requests = [GenerationRequest(i, torch.zeros(4, dtype=torch.long), 4) for i in range(3)]
+    for request in requests:
+        scheduler.add_request(request)
+    assert [r.request_id for r in scheduler.schedule()] == [0, 1]
+    assert scheduler.schedule() == []
+    assert scheduler.active_slots() == [0, 1]
+    requests[0].finished = True
+    assert scheduler.active_slots() == [1]
+    scheduler.release(requests[0])
+    # The freed slot is reused by the next waiting request
+    assert [(r.request_id, r.slot) for r in scheduler.schedule()] == [(2, 0)]
+    with pytest.raises(ValueError):
+        scheduler.add_request(GenerationRequest(3, torch.zeros(30, dtype=torch.long), 4))
+
+
+@pytest.mark.parametrize("max_batch_size", [1, 2, 3])
+def test_continuous_batching_greedy(max_batch_size):
+    """Requests of different prompt and output lengths, with more requests than slots, should
+    give the same outputs as decoding each of them on its own."""
+    device = "cpu"
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=torch.float32)
+    model.eval()
+    seqlens = [5, 9, 3, 12, 7]
+    max_new_tokens = [6, 2, 10, 4, 1]
+    prompts = [torch.randint(0, config.vocab_size, (l,), device=device) for l in seqlens]
+
+    engine = ContinuousBatchingEngine(model, max_batch_size=max_batch_size, max_seqlen=32)
+    for prompt, n in zip(prompts, max_new_tokens):
+        engine.add_request(prompt, n)
+    outputs = engine.generate()
+    assert sorted(outputs.keys()) == list(range(len(prompts)))
+    for i, (prompt, n) in enumerate(zip(prompts, max_new_tokens)):
+        assert outputs[i] == greedy_reference(model, prompt, n)
+    assert sorted(engine.scheduler.free_slots) == list(range(max_batch_size))
+
+
+def test_continuous_batching_eos():
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device="cpu", dtype=torch.float32)
+    model.eval()
+    prompt = torch.randint(0, config.vocab_size, (6,))
+    reference = greedy_reference(model, prompt, 8)
+    eos_token_id = reference[3]
+    engine = ContinuousBatchingEngine(model, max_batch_size=2, max_seqlen=32)
+    request = engine.add_request(prompt, 8, eos_token_id=eos_token_id)
+    engine.generate()
+    assert request.output_ids == reference[: reference.index(eos_token_id) + 1]
@@ -0,0 +1,69 @@
+import pytest
+import torch
+
+from flash_attn.utils.generation import CUDAGraphBucketCache
+
+
+class MockCapture:
+    """Stands in for CUDA graph capture: each "graph" returns one-hot logits of its input tokens,
+    and records the shapes it's run with."""
+
+    def __init__(self, vocab_size=16, nbytes_per_row=100):
+        self.vocab_size = vocab_size
+        self.nbytes_per_row = nbytes_per_row
+        self.captured = []
+        self.calls = []
+
+    def __call__(self, batch_size, decoding_seqlen):
+        self.captured.append((batch_size, decoding_seqlen))
+
+        def run(input_ids, position_ids, seqlen):
+            assert input_ids.shape == position_ids.shape == (batch_size, decoding_seqlen)
+            self.calls.append((batch_size, decoding_seqlen, seqlen))
+            return torch.nn.functional.one_hot(input_ids, self.vocab_size).float()
+
+        return run, batch_size * decoding_seqlen * self.nbytes_per_row
+
+
+def test_cuda_graph_bucket_cache_dispatch():
+    capture = MockCapture()
+    cache = CUDAGraphBucketCache(capture, max_batch_size=12)
+    assert [cache.bucket(b) for b in [1, 2, 3, 4, 5, 8, 9, 12]] == [1, 2, 4, 4, 8, 8, 12, 12]
+    with pytest.raises(AssertionError):
+        cache.bucket(13)
+    for batch_size in [3, 4, 2, 3, 9]:
+        input_ids = torch.randint(0, 16, (batch_size, 1))
+        position_ids = torch.full((batch_size, 1), 7)
+        logits = cache(input_ids, position_ids, 7)
+        # The padding rows are dropped
+        assert torch.equal(logits, torch.nn.functional.one_hot(input_ids, 16).float())
+    # Batch sizes 3 and 4 share a graph, padded to 4 rows
+    assert capture.captured == [(4, 1), (2, 1), (12, 1)]
+    assert [call[0] for call in capture.calls] == [4, 4, 2, 4, 12]
+    assert cache.num_captures == 3
+    cache(torch.zeros(3, 2, dtype=torch.long), torch.zeros(3, 2, dtype=torch.long), 7)
+    assert capture.captured[-1] == (4, 2)
+
+
+def test_cuda_graph_bucket_cache_eviction():
+    capture = MockCapture(nbytes_per_row=100)
+    cache = CUDAGraphBucketCache(capture, max_batch_size=16, memory_budget=1000)
+    for batch_size in [1, 2, 4]:
+        cache.get(batch_size)
+    assert cache.memory_used == 700 and cache.num_evictions == 0
+    cache.get(1)  # Now the most recently used
+    cache.get(8)  # 1500 bytes: evict the least recently used graphs, the ones of 2 and 4
+    assert list(cache.graphs) == [(1, 1), (8, 1)]
+    assert cache.memory_used == 900 and cache.num_evictions == 2
+    # A graph larger than the budget is still kept, alone
+    cache.get(16)
+    assert list(cache.graphs) == [(16, 1)]
+    assert cache.memory_used == 1600
+    # Evicted graphs are captured again when needed
+    cache.get(2)
+    assert capture.captured.count((2, 1)) == 2
+    assert list(cache.graphs) == [(2, 1)]
+    cache.memory_budget = None
+    cache.get(4)
+    cache.get(1)
+    assert list(cache.graphs) == [(2, 1), (4, 1), (1, 1)]
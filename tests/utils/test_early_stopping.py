@@ -0,0 +1,104 @@
+import pytest
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.generation import decode
+
+
+def _expected_sequences(sequences, seqlen, stop_sequences, pad_token_id):
+    """Truncate each row of sequences after the first stop sequence, and pad."""
+    expected = sequences.clone()
+    for row in expected:
+        generated = row[seqlen:].tolist()
+        for i in range(len(generated)):
+            if any(generated[: i + 1][-len(seq) :] == seq for seq in stop_sequences):
+                row[seqlen + i + 1 :] = pad_token_id
+                break
+    lengths = (expected != pad_token_id).sum(dim=1)
+    return expected[:, : lengths.max()]
+
+
+@pytest.mark.parametrize("compact_interval", [None, 1, 3])
+# @pytest.mark.parametrize("compact_interval", [1])
+def test_decode_early_stopping(compact_interval):
+    """With stop sequences, each row should stop on its own, and removing the finished rows from
+    the batch shouldn't change the outputs."""
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device="cpu", dtype=torch.float32)
+    model.eval()
+    batch_size, seqlen, max_length = 4, 6, 40
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen))
+    out_ref = decode(input_ids, model, max_length).sequences
+    # Stop sequences taken from the outputs of rows 0 and 2, so that rows finish at different steps
+    stop_sequences = [
+        out_ref[0, seqlen + 3 : seqlen + 5].tolist(),
+        out_ref[2, seqlen + 10 : seqlen + 13].tolist(),
+    ]
+    pad_token_id = -1
+    expected = _expected_sequences(out_ref, seqlen, stop_sequences, pad_token_id)
+    assert (expected[0] == pad_token_id).any()
+
+    batch_sizes = []
+    hook = model.lm_head.register_forward_pre_hook(
+        lambda module, args: batch_sizes.append(args[0].shape[0])
+    )
+    out = decode(
+        input_ids,
+        model,
+        max_length,
+        stop_sequences=stop_sequences,
+        compact_interval=compact_interval,
+        pad_token_id=pad_token_id,
+        stop_check_interval=1,
+    ).sequences
+    hook.remove()
+    assert torch.equal(out, expected)
+    # The finished rows don't go through the model anymore
+    num_rows_ref = batch_size * (expected.shape[1] - seqlen)
+    if compact_interval is None:
+        assert sum(batch_sizes) == num_rows_ref
+    else:
+        assert sum(batch_sizes) < num_rows_ref
+        assert batch_sizes[-1] < batch_size
+
+
+@pytest.mark.parametrize("stop_check_interval", [1, 3, 8])
+# @pytest.mark.parametrize("stop_check_interval", [3])
+def test_decode_stop_check_interval(stop_check_interval):
+    """Checking for EOS only every stop_check_interval steps should give the same outputs, at the
+    cost of at most stop_check_interval - 1 extra steps."""
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device="cpu", dtype=torch.float32)
+    model.eval()
+    seqlen, max_length = 6, 40
+    input_ids = torch.randint(0, config.vocab_size, (1, seqlen))
+    out_ref = decode(input_ids, model, max_length)
+    eos_token_id = out_ref.sequences[0, seqlen + 4].item()
+    num_tokens = (out_ref.sequences[0, seqlen:] == eos_token_id).nonzero()[0, 0].item() + 1
+
+    num_steps = 0
+
+    def count_steps(module, args):
+        nonlocal num_steps
+        num_steps += 1
+
+    hook = model.lm_head.register_forward_pre_hook(count_steps)
+    out = decode(
+        input_ids,
+        model,
+        max_length,
+        eos_token_id=eos_token_id,
+        stop_check_interval=stop_check_interval,
+    )
+    hook.remove()
+    assert torch.equal(out.sequences, out_ref.sequences[:, : seqlen + num_tokens])
+    assert len(out.scores) == num_tokens
+    for scores, scores_ref in zip(out.scores, out_ref.scores):
+        assert torch.allclose(scores, scores_ref)
+    assert num_tokens <= num_steps <= num_tokens + stop_check_interval - 1
+    out = decode(input_ids, model, max_length, eos_token_id=eos_token_id, output_scores=False)
+    assert torch.equal(out.sequences, out_ref.sequences[:, : seqlen + num_tokens])
+    assert out.scores is None
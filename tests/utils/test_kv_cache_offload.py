@@ -0,0 +1,92 @@
+import pytest
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.continuous_batching import ContinuousBatchingEngine
+from flash_attn.utils.kv_cache_offload import KVCacheOffloader, PreemptionPolicy
+
+
+@pytest.mark.parametrize("block_size", [4, 16])
+# @pytest.mark.parametrize("block_size", [4])
+def test_kv_cache_offloader(block_size):
+    """Swapping out and back in, into another slot, should restore the KV cache exactly, and the
+    host blocks should be reused once they're free."""
+    torch.random.manual_seed(0)
+    kv_caches = {i: torch.randn(3, 32, 2, 4, 8) for i in range(2)}
+    offloader = KVCacheOffloader(kv_caches, num_host_blocks=10, block_size=block_size)
+    seqlens = {0: 13, 1: 7}
+    expected = {
+        seq_id: {i: c[seq_id, :seqlen].clone() for i, c in kv_caches.items()}
+        for seq_id, seqlen in seqlens.items()
+    }
+    for seq_id, seqlen in seqlens.items():
+        offloader.swap_out(seq_id, slot=seq_id, seqlen=seqlen)
+        assert offloader.is_swapped(seq_id)
+    num_free_blocks = offloader.allocator.num_free_blocks
+    assert num_free_blocks == 10 - sum((l + block_size - 1) // block_size for l in seqlens.values())
+    for c in kv_caches.values():  # The slots are reused by other sequences
+        c[:2].normal_()
+    assert offloader.swap_in(1, slot=2) == 7
+    assert offloader.swap_in(0, slot=1) == 13
+    offloader.wait([1, 2])
+    for i, c in kv_caches.items():
+        assert torch.equal(c[2, :7], expected[1][i])
+        assert torch.equal(c[1, :13], expected[0][i])
+    assert offloader.allocator.num_free_blocks == 10
+    assert offloader.stats.num_swap_out == offloader.stats.num_swap_in == 2
+    assert offloader.stats.bytes_swapped_out == 2 * (13 + 7) * 2 * 4 * 8 * 4
+    with pytest.raises(RuntimeError):
+        offloader.swap_out(2, slot=0, seqlen=10 * block_size + 1)
+    offloader.swap_out(2, slot=0, seqlen=5)
+    offloader.free(2)
+    offloader.synchronize()
+    assert offloader.allocator.num_free_blocks == 10
+
+
+@pytest.mark.parametrize("swap", [False, True])
+# @pytest.mark.parametrize("swap", [True])
+def test_continuous_batching_preemption(swap):
+    """Preempting requests, then resuming them from the swapped out KV cache or by recomputing
+    it, should give the same outputs as without preemption."""
+    device = "cpu"
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=torch.float32)
+    model.eval()
+    seqlens = [5, 9, 3, 12]
+    max_new_tokens = [8, 6, 10, 5]
+    prompts = [torch.randint(0, config.vocab_size, (l,), device=device) for l in seqlens]
+
+    def run(preempt_slots):
+        """preempt_slots: dict of step -> number of slots to free before the step."""
+        engine = ContinuousBatchingEngine(
+            model,
+            max_batch_size=2,
+            max_seqlen=32,
+            num_host_blocks=16 if swap else 0,
+            host_block_size=4,
+            preemption_policy=PreemptionPolicy(min_swap_tokens=0 if swap else 10**9),
+        )
+        requests = [engine.add_request(p, n) for p, n in zip(prompts, max_new_tokens)]
+        outputs, step, num_preempted = {}, 0, 0
+        while engine.scheduler.has_unfinished():
+            if step in preempt_slots:
+                # The preempted requests are resumed right away, possibly in another slot
+                preempted = engine.preempt(num_slots=preempt_slots[step])
+                assert all(r.swapped == swap for r in preempted)
+                num_preempted += len(preempted)
+            for request in engine.step():
+                outputs[request.request_id] = request.output_ids
+            step += 1
+        return outputs, requests, engine, num_preempted
+
+    outputs_ref, _, _, _ = run(preempt_slots={})
+    outputs, requests, engine, num_preempted = run(preempt_slots={1: 1, 2: 2, 4: 1, 7: 2})
+    assert outputs == outputs_ref
+    assert num_preempted >= 4
+    assert sum(r.num_preemptions for r in requests) == num_preempted
+    if swap:
+        stats = engine.offloader.stats
+        assert stats.num_swap_out == stats.num_swap_in == num_preempted
+        assert engine.offloader.allocator.num_free_blocks == 16
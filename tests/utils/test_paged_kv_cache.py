@@ -0,0 +1,96 @@
+import pytest
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.generation import InferenceParams
+from flash_attn.utils.paged_kv_cache import BlockAllocator, BlockManager, copy_blocks
+
+
+def test_block_allocator():
+    allocator = BlockAllocator(3)
+    blocks = [allocator.allocate() for _ in range(3)]
+    assert sorted(blocks) == [0, 1, 2]
+    with pytest.raises(RuntimeError):
+        allocator.allocate()
+    allocator.fork(blocks[1])
+    allocator.free(blocks[1])
+    assert allocator.num_free_blocks == 0
+    allocator.free(blocks[1])
+    assert allocator.allocate() == blocks[1]
+
+
+def test_block_manager_copy_on_write():
+    manager = BlockManager(num_blocks=8, block_size=4)
+    assert manager.append_slots(0, 6) == []
+    manager.advance(0, 6)
+    assert len(manager.block_tables[0]) == 2
+    manager.fork(0, 1)
+    assert manager.block_tables[1] == manager.block_tables[0]
+    # Seq 1 writes into the 2nd block, which is shared: it gets its own copy
+    shared = manager.block_tables[0][1]
+    copies = manager.append_slots(1, 1)
+    assert len(copies) == 1 and copies[0][0] == shared
+    assert manager.block_tables[1][1] == copies[0][1]
+    assert manager.block_tables[1][0] == manager.block_tables[0][0]
+    # Seq 0 is now the only owner of the block, no copy needed
+    assert manager.append_slots(0, 1) == []
+    manager.free(0)
+    manager.free(1)
+    assert manager.num_free_blocks == 8
+
+    kv_caches = {0: torch.randn(8, 4, 2, 1, 2)}
+    kv_ref = kv_caches[0].clone()
+    copy_blocks(kv_caches, [(1, 5)])
+    assert torch.equal(kv_caches[0][5], kv_ref[1])
+
+
+@pytest.mark.parametrize("block_size", [1, 4, 16])
+def test_gpt_paged_kv_cache(block_size):
+    """Prefill two sequences that share a prompt with a paged KV cache, then decode them with
+    different tokens. The logits should match the forward pass without KV cache."""
+    device = "cpu"
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=torch.float32)
+    model.eval()
+    num_blocks, seqlen, num_decode_steps = 32, 10, 5
+    manager = BlockManager(num_blocks, block_size)
+    inference_params = InferenceParams(
+        max_seqlen=seqlen + num_decode_steps,
+        max_batch_size=2,
+        key_value_memory_dict=model.allocate_inference_cache(
+            2, None, num_blocks=num_blocks, block_size=block_size
+        ),
+    )
+    prompt = torch.randint(0, config.vocab_size, (1, seqlen), device=device)
+    continuations = torch.randint(0, config.vocab_size, (2, num_decode_steps), device=device)
+
+    with torch.inference_mode():
+        copy_blocks(inference_params.key_value_memory_dict, manager.append_slots(0, seqlen))
+        inference_params.block_table = manager.get_block_table([0], device)
+        inference_params.lengths_per_sample = manager.get_seqlens([0], device)
+        model(prompt, inference_params=inference_params)
+        manager.advance(0, seqlen)
+        manager.fork(0, 1)
+        for i in range(num_decode_steps):
+            for seq_id in [0, 1]:
+                copies = manager.append_slots(seq_id, 1)
+                copy_blocks(inference_params.key_value_memory_dict, copies)
+            inference_params.block_table = manager.get_block_table([0, 1], device)
+            inference_params.lengths_per_sample = manager.get_seqlens([0, 1], device)
+            inference_params.seqlen_offset = seqlen + i
+            position_ids = torch.full((2, 1), seqlen + i, dtype=torch.long, device=device)
+            logits = model(
+                continuations[:, i : i + 1],
+                position_ids=position_ids,
+                inference_params=inference_params,
+            ).logits[:, -1]
+            for seq_id in [0, 1]:
+                manager.advance(seq_id, 1)
+            input_ids = torch.cat([prompt.expand(2, -1), continuations[:, : i + 1]], dim=1)
+            logits_ref = model(input_ids).logits[:, -1]
+            assert torch.allclose(logits, logits_ref, rtol=1e-4, atol=1e-4)
+    # The two sequences only share the blocks that were full before the fork
+    num_shared = seqlen // block_size
+    assert manager.block_tables[0][:num_shared] == manager.block_tables[1][:num_shared]
@@ -0,0 +1,72 @@
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.prefix_cache import PrefixCache
+
+
+def make_kv(tokens, nlayers=2):
+    # The "KV" of each token is just the token itself, so we can check what's returned
+    kv = torch.tensor(tokens, dtype=torch.float32)[:, None, None, None].expand(-1, 2, 1, 1)
+    return {i: kv + i for i in range(nlayers)}
+
+
+def test_radix_tree_match_insert():
+    cache = PrefixCache(max_tokens=100)
+    cache.insert([1, 2, 3, 4], make_kv([1, 2, 3, 4]))
+    cache.insert([1, 2, 5], make_kv([1, 2, 5]))  # Splits the edge [1, 2, 3, 4]
+    assert cache.num_tokens == 5
+    matched, kv = cache.match([1, 2, 3, 7])
+    assert matched == 3
+    assert torch.equal(kv[1][:, 0, 0, 0], torch.tensor([2.0, 3.0, 4.0]))
+    matched, kv = cache.match([1, 2, 5, 6])
+    assert matched == 3
+    assert torch.equal(kv[0][:, 0, 0, 0], torch.tensor([1.0, 2.0, 5.0]))
+    assert cache.match([9, 1])[0] == 0
+
+
+def test_radix_tree_lru_eviction():
+    cache = PrefixCache(max_tokens=6)
+    cache.insert([1, 2, 3], make_kv([1, 2, 3]))
+    cache.insert([4, 5, 6], make_kv([4, 5, 6]))
+    cache.match([1, 2, 3])  # [4, 5, 6] is now the least recently used
+    cache.insert([7, 8], make_kv([7, 8]))
+    assert cache.num_tokens == 5
+    assert cache.match([4, 5, 6])[0] == 0
+    assert cache.match([1, 2, 3])[0] == 3
+    assert cache.match([7, 8])[0] == 2
+
+
+def test_gpt_generation_prefix_cache():
+    """Generation with a prefix cache should give the same result as without, while skipping
+    the prefill of the shared system prompt."""
+    device = "cpu"
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=torch.float32)
+    model.eval()
+    system_prompt = torch.randint(0, config.vocab_size, (1, 16), device=device)
+    prefix_cache = PrefixCache(max_tokens=1024)
+    for i in range(3):
+        # Distinct first token so that only the system prompt is shared between requests
+        user_prompt = torch.full((1, 4 + i), 100 + i, dtype=torch.long, device=device)
+        input_ids = torch.cat([system_prompt, user_prompt], dim=1)
+        max_length = input_ids.shape[1] + 8
+        out_ref = model.generate(
+            input_ids, max_length, return_dict_in_generate=True, output_scores=True
+        )
+        out = model.generate(
+            input_ids,
+            max_length,
+            prefix_cache=prefix_cache,
+            return_dict_in_generate=True,
+            output_scores=True,
+        )
+        assert torch.equal(out.sequences, out_ref.sequences)
+        assert torch.allclose(
+            torch.stack(out.scores, dim=1), torch.stack(out_ref.scores, dim=1), atol=1e-4
+        )
+    assert prefix_cache.stats.num_queries == 3
+    assert prefix_cache.stats.num_hits == 2
+    assert prefix_cache.stats.num_hit_tokens == 2 * system_prompt.shape[1]
+    assert prefix_cache.stats.hit_rate == 2 / 3
@@ -0,0 +1,71 @@
+from functools import partial
+
+import pytest
+import torch
+from transformers import GPT2Config, GPT2Model
+
+from flash_attn.models.gpt import GPTLMHeadModel, remap_state_dict_hf_gpt2
+from flash_attn.utils.pretrained import load_state_dict_streaming, state_dict_from_pretrained
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16])
+# @pytest.mark.parametrize("dtype", [torch.float16])
+@pytest.mark.parametrize("safe_serialization", [True, False])
+# @pytest.mark.parametrize("safe_serialization", [True])
+def test_load_state_dict_streaming(safe_serialization, dtype, tmp_path):
+    """Loading the checkpoint one layer at a time should give the same model as loading the
+    whole state_dict, while only holding one layer in memory."""
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=4, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    GPT2Model(config).save_pretrained(
+        tmp_path, safe_serialization=safe_serialization, max_shard_size="100KB"
+    )
+    model_ref = GPTLMHeadModel(config, device="cpu", dtype=dtype)
+    model_ref.load_state_dict(
+        remap_state_dict_hf_gpt2(state_dict_from_pretrained(str(tmp_path), dtype=dtype), config)
+    )
+    model = GPTLMHeadModel(config, device="cpu", dtype=dtype)
+    stats = load_state_dict_streaming(
+        model, str(tmp_path), remap_fn=partial(remap_state_dict_hf_gpt2, config=config), dtype=dtype
+    )
+    state_dict_ref = model_ref.state_dict()
+    for key, value in model.state_dict().items():
+        assert torch.equal(value, state_dict_ref[key]), key
+    assert not stats.missing_keys and not stats.unexpected_keys
+    # The largest group is one layer, less than a third of the model
+    assert 0 < stats.peak_bytes < stats.num_bytes / 3
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+# @pytest.mark.parametrize("streaming", [True])
+@pytest.mark.parametrize("num_workers", [2, 4])
+# @pytest.mark.parametrize("num_workers", [4])
+def test_load_parallel(num_workers, streaming, tmp_path, capsys):
+    """Loading with a thread pool should give exactly the same result as loading sequentially."""
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=4, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    GPT2Model(config).save_pretrained(tmp_path, max_shard_size="100KB")
+    dtype = torch.float16
+    if not streaming:
+        state_dict_ref = state_dict_from_pretrained(str(tmp_path), dtype=dtype)
+        state_dict = state_dict_from_pretrained(
+            str(tmp_path), dtype=dtype, num_workers=num_workers, progress=True
+        )
+        assert list(state_dict.keys()) == list(state_dict_ref.keys())
+    else:
+        remap_fn = partial(remap_state_dict_hf_gpt2, config=config)
+        model_ref = GPTLMHeadModel(config, device="cpu", dtype=dtype)
+        load_state_dict_streaming(model_ref, str(tmp_path), remap_fn=remap_fn, dtype=dtype)
+        model = GPTLMHeadModel(config, device="cpu", dtype=dtype)
+        load_state_dict_streaming(
+            model,
+            str(tmp_path),
+            remap_fn=remap_fn,
+            dtype=dtype,
+            num_workers=num_workers,
+            progress=True,
+        )
+        state_dict_ref, state_dict = model_ref.state_dict(), model.state_dict()
+    for key, value in state_dict.items():
+        assert torch.equal(value, state_dict_ref[key]), key
+    assert "Loaded" in capsys.readouterr().out
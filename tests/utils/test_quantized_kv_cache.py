@@ -0,0 +1,84 @@
+import pytest
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.quantized_kv_cache import (
+    QUANT_DTYPES,
+    QuantizedKVCache,
+    dequantize_kv,
+    quantize_kv,
+)
+
+# Max quantization error, relative to the max absolute value of each group
+QUANT_TOLERANCE = {torch.int8: 1 / 254 + 1e-6}
+if hasattr(torch, "float8_e4m3fn"):
+    QUANT_TOLERANCE.update({torch.float8_e4m3fn: 2**-4, torch.float8_e5m2: 2**-3})
+
+
+@pytest.mark.parametrize("quant_dtype", QUANT_DTYPES)
+# @pytest.mark.parametrize("quant_dtype", [torch.int8])
+@pytest.mark.parametrize("group_size", [None, 8])
+# @pytest.mark.parametrize("group_size", [None])
+def test_quantize_kv(group_size, quant_dtype):
+    torch.random.manual_seed(0)
+    kv = torch.randn(2, 17, 2, 4, 32) * torch.rand(2, 17, 2, 4, 1) * 10
+    kv[0, 0] = 0.0  # Groups of zeros shouldn't give NaN
+    kv_quant, scales = quantize_kv(kv, quant_dtype=quant_dtype, group_size=group_size)
+    assert kv_quant.dtype == quant_dtype
+    assert scales.shape == (2, 17, 2, 4, 32 // (group_size or 32))
+    kv_deq = dequantize_kv(kv_quant, scales, dtype=kv.dtype)
+    group_size = group_size or 32
+    amax = kv.reshape(2, 17, 2, 4, -1, group_size).abs().amax(dim=-1, keepdim=True)
+    err = (kv_deq - kv).reshape(2, 17, 2, 4, -1, group_size).abs()
+    assert (err <= amax * QUANT_TOLERANCE[quant_dtype]).all()
+    # Indexing the cache writes and reads the quantized values
+    kv_cache = QuantizedKVCache((3, 20, 2, 4, 32), dtype=kv.dtype, quant_dtype=quant_dtype)
+    kv_cache[1:, 2:19] = kv
+    assert torch.equal(kv_cache[1:, 2:19], dequantize_kv(*quantize_kv(kv, quant_dtype), kv.dtype))
+    batch_idx, seq_idx = torch.tensor([2, 0]), torch.tensor([[3, 4], [7, 8]])
+    kv_cache[batch_idx[:, None], seq_idx] = kv[:, :2]
+    assert torch.allclose(kv_cache[2, 3:5], kv[0, :2], atol=amax.max() * 0.2)
+    assert kv_cache.nbytes < kv.element_size() * kv_cache.shape.numel() / 2
+
+
+@pytest.mark.parametrize("quant_dtype", QUANT_DTYPES)
+# @pytest.mark.parametrize("quant_dtype", [torch.int8])
+@pytest.mark.parametrize("group_size", [None, 8])
+# @pytest.mark.parametrize("group_size", [None])
+def test_gpt_quantized_kv_cache(group_size, quant_dtype):
+    """Decoding with a quantized KV cache should give almost the same logits as with the full
+    precision KV cache, with much less memory."""
+    device = "cpu"
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=torch.float32)
+    model.eval()
+    batch_size, seqlen, max_length = 2, 10, 30
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), device=device)
+    out_ref = model.generate(
+        input_ids, max_length, return_dict_in_generate=True, output_scores=True
+    )
+    # Feed the same tokens, so that the logits can be compared at every step
+    out = model.generate(
+        input_ids,
+        max_length,
+        return_dict_in_generate=True,
+        output_scores=True,
+        teacher_outputs=out_ref.sequences,
+        kv_cache_quant_dtype=quant_dtype,
+        kv_cache_quant_group_size=group_size,
+    )
+    scores, scores_ref = torch.stack(out.scores, dim=1), torch.stack(out_ref.scores, dim=1)
+    assert (scores - scores_ref).abs().max() < 0.1 * scores_ref.abs().max()
+    kv_cache = model.allocate_inference_cache(
+        batch_size,
+        max_length,
+        dtype=torch.float16,
+        kv_cache_quant_dtype=quant_dtype,
+        kv_cache_quant_group_size=group_size,
+    )
+    kv_cache_ref = model.allocate_inference_cache(batch_size, max_length, dtype=torch.float16)
+    nbytes = sum(c.nbytes for c in kv_cache.values())
+    nbytes_ref = sum(c.nbytes for c in kv_cache_ref.values())
+    assert nbytes < 0.7 * nbytes_ref
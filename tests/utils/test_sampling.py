@@ -0,0 +1,119 @@
+import pytest
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.continuous_batching import ContinuousBatchingEngine
+from flash_attn.utils.generation import (
+    SamplingParams,
+    _sampling_probs,
+    random_uniform_per_row,
+    sample_batched,
+)
+
+
+def test_random_uniform_per_row():
+    seed = torch.tensor([0, 1, 2**40 + 1, -5]).repeat_interleave(5000)
+    offset = torch.arange(5000).repeat(4)
+    uniform = random_uniform_per_row(seed, offset)
+    assert uniform.dtype == torch.float32
+    assert (uniform >= 0).all() and (uniform < 1).all()
+    # The stream of each seed is uniform, and the streams of different seeds are different
+    for u in uniform.split(5000):
+        assert abs(u.mean().item() - 0.5) < 0.02
+        assert abs(u.std().item() - 12**-0.5) < 0.02
+    assert not torch.equal(uniform[:5000], uniform[5000:10000])
+    assert not torch.equal(uniform[5000:10000], uniform[10000:15000])
+    # Only depends on the seed and offset of the row
+    flipped = random_uniform_per_row(seed.flip(0), offset.flip(0))
+    assert torch.equal(flipped, uniform.flip(0))
+
+
+@pytest.mark.parametrize("top_k", [0, 1, 5])
+# @pytest.mark.parametrize("top_k", [5])
+@pytest.mark.parametrize("top_p", [0.0, 0.8])
+# @pytest.mark.parametrize("top_p", [0.8])
+@pytest.mark.parametrize("temperature", [0.7, 1.0])
+# @pytest.mark.parametrize("temperature", [0.7])
+def test_sample_batched_distribution(top_k, top_p, temperature):
+    """Sampling each row with its own seed should follow the same distribution as sample."""
+    torch.random.manual_seed(0)
+    vocab_size, num_samples = 16, 20000
+    logits = torch.randn(1, vocab_size) * 2
+    tokens = sample_batched(
+        logits.expand(num_samples, -1),
+        top_k=torch.full((num_samples,), top_k),
+        top_p=torch.full((num_samples,), top_p),
+        temperature=torch.full((num_samples,), temperature),
+        seed=torch.full((num_samples,), 1234),
+        offset=torch.arange(num_samples),
+    )
+    probs_ref = _sampling_probs(logits, top_k=top_k, top_p=top_p, temperature=temperature)[0]
+    if top_k == 1:
+        probs_ref = torch.nn.functional.one_hot(logits.argmax(), vocab_size).float()
+    freqs = torch.bincount(tokens, minlength=vocab_size).float() / num_samples
+    assert (freqs[probs_ref == 0] == 0).all()
+    assert (freqs - probs_ref).abs().max().item() < 0.02
+
+
+def test_sample_batched_per_row():
+    """Each row uses its own parameters and random stream, whatever the rest of the batch."""
+    torch.random.manual_seed(0)
+    batch_size, vocab_size = 6, 50
+    logits = torch.randn(batch_size, vocab_size) * 3
+    kwargs = dict(
+        top_k=torch.tensor([1, 0, 10, 3, 0, 0]),
+        top_p=torch.tensor([0.0, 0.9, 0.0, 0.5, 0.0, 0.0]),
+        min_p=torch.tensor([0.0, 0.0, 0.0, 0.0, 0.2, 0.0]),
+        temperature=torch.tensor([1.0, 0.5, 1.5, 1.0, 1.0, 0.0]),
+        repetition_penalty=torch.tensor([1.0, 1.0, 1.0, 1.0, 1.0, 10.0]),
+        seed=torch.arange(batch_size) * 1000,
+        offset=torch.full((batch_size,), 7),
+    )
+    prev_tokens = torch.full((batch_size, 3), -1)
+    prev_tokens[5] = logits[5].topk(3).indices
+    tokens = sample_batched(logits, prev_tokens=prev_tokens, **kwargs)
+    # Greedy rows take the argmax, after the repetition penalty
+    assert tokens[0] == logits[0].argmax()
+    assert tokens[5] == logits[5].topk(4).indices[-1]
+    assert tokens[2] in logits[2].topk(10).indices
+    assert tokens[3] in logits[3].topk(3).indices
+    probs = logits[4].softmax(dim=-1)
+    assert probs[tokens[4]] >= 0.2 * probs.max()
+    # Bitwise reproducible, and the same when the rows are sampled one by one
+    assert torch.equal(sample_batched(logits, prev_tokens=prev_tokens, **kwargs), tokens)
+    for i in range(batch_size):
+        row_kwargs = {k: v[i : i + 1] for k, v in kwargs.items()}
+        token = sample_batched(logits[i : i + 1], prev_tokens=prev_tokens[i : i + 1], **row_kwargs)
+        assert token.item() == tokens[i].item()
+    # Scalar greedy parameters short-circuit to the argmax
+    assert torch.equal(sample_batched(logits, top_k=1), logits.argmax(dim=-1))
+
+
+def test_continuous_batching_sampling_params():
+    """The tokens of a request only depend on its prompt and sampling parameters, not on the
+    other requests it's batched with."""
+    device = "cpu"
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=torch.float32)
+    model.eval()
+    prompts = [torch.randint(0, config.vocab_size, (l,), device=device) for l in [5, 9, 3, 12]]
+    sampling_params = [
+        SamplingParams(top_k=1),
+        SamplingParams(top_k=0, top_p=0.9, temperature=0.8, seed=1),
+        SamplingParams(top_k=20, min_p=0.05, repetition_penalty=1.3, seed=2),
+        SamplingParams(top_k=0, temperature=1.2, seed=3),
+    ]
+
+    def run(max_batch_size, order):
+        engine = ContinuousBatchingEngine(model, max_batch_size=max_batch_size, max_seqlen=32)
+        requests = {
+            i: engine.add_request(prompts[i], 10, sampling_params=sampling_params[i]) for i in order
+        }
+        engine.generate()
+        return {i: r.output_ids for i, r in requests.items()}
+
+    outputs_ref = run(max_batch_size=1, order=[0, 1, 2, 3])
+    assert run(max_batch_size=4, order=[0, 1, 2, 3]) == outputs_ref
+    assert run(max_batch_size=2, order=[3, 1, 0, 2]) == outputs_ref
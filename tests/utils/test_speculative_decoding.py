@@ -0,0 +1,194 @@
+import math
+
+import pytest
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.generation import (
+    decode_speculative,
+    decode_speculative_batched,
+    decode_speculative_tree,
+    sample_speculative,
+    sample_speculative_tree,
+)
+
+
+def test_sample_speculative_batched():
+    """Each sequence gets its own number of accepted tokens and its own resampled token."""
+    torch.manual_seed(0)
+    batch_size, seqlen, vocab_size = 3, 4, 16
+    tokens_draft = torch.randint(0, vocab_size, (batch_size, seqlen))
+    # The draft tokens are the greedy choice of the draft model
+    logits_draft = torch.randn(batch_size, seqlen, vocab_size)
+    logits_draft.scatter_(-1, tokens_draft[..., None], 100.0)
+    logits = torch.randn(batch_size, seqlen + 1, vocab_size)
+    # Greedy: the draft tokens are accepted until the first one that isn't the argmax
+    logits[0, :, :].scatter_(-1, torch.cat([tokens_draft[0], tokens_draft[0, :1]])[:, None], 100.0)
+    logits[1, 2].scatter_(-1, ((tokens_draft[1, 2] + 1) % vocab_size)[None], 200.0)
+    logits[1, :2].scatter_(-1, tokens_draft[1, :2, None], 100.0)
+    tokens, num_generated_tokens = sample_speculative(logits, logits_draft, tokens_draft, top_k=1)
+    assert num_generated_tokens[0] == seqlen + 1
+    assert num_generated_tokens[1] == 3
+    assert tokens[1, 2] == (tokens_draft[1, 2] + 1) % vocab_size
+    assert torch.equal(tokens[1, :2], tokens_draft[1, :2])
+    assert torch.equal(tokens[0, :seqlen], tokens_draft[0])
+    # The other rows aren't modified by the resampling of row 1
+    num_accepted = num_generated_tokens[2] - 1
+    assert torch.equal(tokens[2, :num_accepted], tokens_draft[2, :num_accepted])
+
+
+@pytest.mark.parametrize("same_draft", [False, True])
+# @pytest.mark.parametrize("same_draft", [False])
+@pytest.mark.parametrize("speculative_lookahead", [1, 4])
+# @pytest.mark.parametrize("speculative_lookahead", [4])
+def test_gpt_speculative_decoding_batched(speculative_lookahead, same_draft):
+    """With greedy decoding, speculative decoding should give the same result as decoding each
+    sequence with the main model, whatever the draft model proposes."""
+    device = "cpu"
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=torch.float32)
+    model.eval()
+    if not same_draft:
+        config_draft = GPT2Config(n_embd=32, n_head=2, n_layer=1, vocab_size=128, n_positions=64)
+        model_draft = GPTLMHeadModel(config_draft, device=device, dtype=torch.float32)
+        model_draft.eval()
+    else:
+        model_draft = model
+    batch_size, seqlen, max_length = 4, 7, 30
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), device=device)
+    out, stats = decode_speculative_batched(
+        input_ids,
+        model,
+        model_draft,
+        max_length,
+        speculative_lookahead=speculative_lookahead,
+        return_stats=True,
+    )
+    assert out.sequences.shape == (batch_size, max_length)
+    assert out.scores.shape == (batch_size, max_length - seqlen, config.vocab_size)
+    for i in range(batch_size):
+        out_ref = model.generate(
+            input_ids[i : i + 1], max_length, return_dict_in_generate=True, output_scores=True
+        )
+        assert torch.equal(out.sequences[i], out_ref.sequences[0])
+        assert torch.allclose(out.scores[i], torch.cat(out_ref.scores, dim=0), atol=1e-4)
+    assert stats.num_draft_tokens.shape == (batch_size,)
+    assert (stats.num_accepted_tokens <= stats.num_draft_tokens).all()
+    if same_draft:
+        assert (stats.acceptance_rate == 1.0).all()
+        num_new_tokens = max_length - seqlen
+        max_calls = math.ceil(num_new_tokens / (speculative_lookahead + 1)) + 1
+        assert stats.num_main_model_calls <= max_calls
+
+
+class _RejectingDraftModel(torch.nn.Module):
+    """Proposes the greedy tokens of model, except for the rows in reject_rows, where it never
+    proposes the greedy token (the logits are shifted by one along the vocab)."""
+
+    def __init__(self, model, reject_rows):
+        super().__init__()
+        self.model = model
+        self.reject_rows = reject_rows
+
+    def forward(self, input_ids, **kwargs):
+        out = self.model(input_ids, **kwargs)
+        logits = out.logits.clone()
+        logits[self.reject_rows] = logits[self.reject_rows].roll(1, dims=-1)
+        return out._replace(logits=logits)
+
+
+@pytest.mark.parametrize("speculative_lookahead", [1, 4])
+# @pytest.mark.parametrize("speculative_lookahead", [4])
+def test_gpt_speculative_decoding_batched_uneven(speculative_lookahead):
+    """Rows that accept all the draft tokens finish long before rows that reject them all, and
+    keep going through the models with the other rows without overflowing the KV cache."""
+    device = "cpu"
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=torch.float32)
+    model.eval()
+    model_draft = _RejectingDraftModel(model, reject_rows=[1, 2])
+    batch_size, seqlen, max_length = 4, 7, 30
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seqlen), device=device)
+    out, stats = decode_speculative_batched(
+        input_ids,
+        model,
+        model_draft,
+        max_length,
+        speculative_lookahead=speculative_lookahead,
+        return_stats=True,
+    )
+    assert (stats.acceptance_rate[[0, 3]] == 1.0).all()
+    assert (stats.num_accepted_tokens[[1, 2]] == 0).all()
+    for i in range(batch_size):
+        out_ref = model.generate(
+            input_ids[i : i + 1], max_length, return_dict_in_generate=True, output_scores=True
+        )
+        assert torch.equal(out.sequences[i], out_ref.sequences[0])
+        assert torch.allclose(out.scores[i], torch.cat(out_ref.scores, dim=0), atol=1e-4)
+
+
+def test_sample_speculative_tree():
+    """The first token sampled with speculative sampling on a tree should be distributed as the
+    main model, whatever the draft model."""
+    torch.manual_seed(0)
+    vocab_size, num_children, num_trials = 4, 2, 4000
+    probs = torch.tensor([0.1, 0.2, 0.3, 0.4])
+    probs_draft = torch.tensor([0.5, 0.3, 0.1, 0.1])
+    logits = probs.log().expand(num_children + 1, vocab_size)
+    logits_draft = probs_draft.log().expand(num_children + 1, vocab_size)
+    parents = [-1] + [0] * num_children
+    counts = torch.zeros(vocab_size)
+    for _ in range(num_trials):
+        tokens = [0] + torch.multinomial(probs_draft, num_children, replacement=True).tolist()
+        path, next_token = sample_speculative_tree(
+            logits, logits_draft, tokens, parents, top_k=0
+        )
+        assert len(path) <= 1
+        counts[tokens[path[0]] if path else next_token.item()] += 1
+    assert torch.allclose(counts / num_trials, probs, atol=0.03)
+    # Greedy: the child that is the argmax of the main model is accepted
+    path, next_token = sample_speculative_tree(logits, logits_draft, [0, 1, 3], parents, top_k=1)
+    assert path == [2] and next_token.item() == 3
+
+
+@pytest.mark.parametrize("same_draft", [False, True])
+# @pytest.mark.parametrize("same_draft", [False])
+@pytest.mark.parametrize("tree_branching", [(1,), (2, 2, 1), (3, 1)])
+# @pytest.mark.parametrize("tree_branching", [(2, 2, 1)])
+def test_gpt_speculative_decoding_tree(tree_branching, same_draft):
+    """With greedy decoding, tree speculative decoding should give the same result as decoding
+    with the main model, whatever the draft model proposes."""
+    device = "cpu"
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device=device, dtype=torch.float32)
+    model.eval()
+    if not same_draft:
+        config_draft = GPT2Config(n_embd=32, n_head=2, n_layer=1, vocab_size=128, n_positions=64)
+        model_draft = GPTLMHeadModel(config_draft, device=device, dtype=torch.float32)
+        model_draft.eval()
+    else:
+        model_draft = model
+    seqlen, max_length = 7, 30
+    input_ids = torch.randint(0, config.vocab_size, (1, seqlen), device=device)
+    out, stats = decode_speculative_tree(
+        input_ids, model, model_draft, max_length, tree_branching=tree_branching, return_stats=True
+    )
+    out_ref = model.generate(
+        input_ids, max_length, return_dict_in_generate=True, output_scores=True
+    )
+    assert torch.equal(out.sequences, out_ref.sequences)
+    assert torch.allclose(out.scores[0], torch.cat(out_ref.scores, dim=0), atol=1e-4)
+    out_dispatch = decode_speculative(
+        input_ids, model, model_draft, max_length, tree_branching=tree_branching
+    )
+    assert torch.equal(out_dispatch.sequences, out.sequences)
+    assert (stats.num_accepted_tokens <= stats.num_draft_tokens).all()
+    if same_draft:
+        assert (stats.acceptance_rate == 1.0).all()
+        num_new_tokens = max_length - seqlen
+        max_calls = math.ceil(num_new_tokens / (len(tree_branching) + 1)) + 1
+        assert stats.num_main_model_calls <= max_calls
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+import torch
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+from flash_attn.utils.generation import decode_stream, decode_stream_async
+
+
+def _get_model():
+    config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+    torch.manual_seed(0)
+    model = GPTLMHeadModel(config, device="cpu", dtype=torch.float32)
+    model.eval()
+    return model, config
+
+
+@pytest.mark.parametrize("stream_interval", [1, 3])
+# @pytest.mark.parametrize("stream_interval", [1])
+def test_decode_stream(stream_interval):
+    """The streamed tokens should be the same as the ones returned by generate."""
+    model, config = _get_model()
+    input_ids = torch.randint(0, config.vocab_size, (2, 7))
+    max_length = 20
+    out_ref = model.generate(
+        input_ids, max_length, return_dict_in_generate=True, output_scores=True
+    )
+    outputs = list(model.generate_stream(input_ids, max_length, stream_interval=stream_interval))
+    num_new_tokens = max_length - input_ids.shape[1]
+    assert len(outputs) == (num_new_tokens + stream_interval - 1) // stream_interval
+    assert all(output.tokens.shape[1] == len(output.scores) for output in outputs)
+    sequences = torch.cat([input_ids] + [output.tokens for output in outputs], dim=1)
+    assert torch.equal(sequences, out_ref.sequences)
+    scores = [score for output in outputs for score in output.scores]
+    for score, score_ref in zip(scores, out_ref.scores):
+        assert torch.allclose(score, score_ref)
+    assert not outputs[-1].finished.any()
+
+
+def test_decode_stream_stopping_criteria():
+    """Each row stops on its own condition, and decoding stops once all rows are finished."""
+    model, config = _get_model()
+    input_ids = torch.randint(0, config.vocab_size, (3, 5))
+    max_new_tokens = torch.tensor([2, 6, 4])
+    num_tokens = 0
+
+    def stopping_criteria(tokens):
+        nonlocal num_tokens
+        num_tokens += 1
+        return num_tokens >= max_new_tokens
+
+    outputs = list(decode_stream(input_ids, model, 30, stopping_criteria=stopping_criteria))
+    assert len(outputs) == max_new_tokens.max()
+    finished = torch.stack([output.finished for output in outputs], dim=1)
+    assert torch.equal(finished.sum(dim=1), max_new_tokens.max() - max_new_tokens + 1)
+    # With eos_token_id, the rows that sample it are finished
+    eos_token_id = outputs[0].tokens[0, 0].item()
+    outputs = list(decode_stream(input_ids, model, 30, eos_token_id=eos_token_id))
+    assert outputs[0].finished[0]
+    assert all(output.finished[0] for output in outputs)
+
+
+def test_decode_stream_cancel():
+    model, config = _get_model()
+    input_ids = torch.randint(0, config.vocab_size, (1, 5))
+    stream = decode_stream(input_ids, model, 30)
+    first = next(stream)
+    assert first.tokens.shape == (1, 1)
+    stream.close()
+    with pytest.raises(StopIteration):
+        next(stream)
+
+
+def test_decode_stream_async():
+    model, config = _get_model()
+    input_ids = torch.randint(0, config.vocab_size, (2, 5))
+    tokens_ref = torch.cat([output.tokens for output in decode_stream(input_ids, model, 16)], 1)
+
+    async def collect():
+        return [output.tokens async for output in decode_stream_async(input_ids, model, 16)]
+
+    assert torch.equal(torch.cat(asyncio.run(collect()), dim=1), tokens_ref)
+
+    async def cancel():
+        received = []
+
+        async def consume():
+            async for output in model.generate_stream_async(input_ids, 16):
+                received.append(output)
+                if len(received) == 2:
+                    await asyncio.sleep(10)
+
+        task = asyncio.create_task(consume())
+        while len(received) < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return received
+
+    received = asyncio.run(cancel())
+    assert torch.equal(torch.cat([output.tokens for output in received], 1), tokens_ref[:, :2])
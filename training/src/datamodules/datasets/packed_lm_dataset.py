@@ -0,0 +1,140 @@
+# Packs whole documents into fixed-size sequences, so that attention doesn't cross document
+# boundaries (with the varlen attention path) and there's no padding waste from one document per
+# sequence.
+from bisect import bisect_left, insort
+
+import numpy as np
+
+import torch
+
+
+def best_fit_decreasing(sizes, capacity):
+    """Pack items into bins of the given capacity, with the best-fit-decreasing heuristic:
+    items are placed from the largest to the smallest, each in the bin with the least remaining
+    space that can still hold it.
+    Arguments:
+        sizes: (n_items,) int array, all <= capacity
+        capacity: int
+    Return:
+        bin_offsets: (n_bins + 1,) int64 array
+        items: (n_items,) int64 array, the indices of the items in bin i are
+            items[bin_offsets[i]:bin_offsets[i + 1]].
+    """
+    sizes = np.asarray(sizes)
+    assert np.all(sizes <= capacity)
+    # Stable sort, so that the packing is deterministic
+    order = np.argsort(-sizes, kind='stable')
+    bin_of_item = np.empty(len(sizes), dtype=np.int64)
+    # Remaining space -> bins with that much space left, and the sorted list of the remaining
+    # spaces that have at least one bin. There are at most capacity + 1 distinct values, so the
+    # sorted list stays small.
+    bins_by_space = {}
+    spaces = []
+    n_bins = 0
+    sizes_list = sizes.tolist()
+    for item in order.tolist():
+        size = sizes_list[item]
+        idx = bisect_left(spaces, size)
+        if idx < len(spaces):
+            space = spaces[idx]
+            bin_idx = bins_by_space[space].pop()
+            if not bins_by_space[space]:
+                del bins_by_space[space]
+                spaces.pop(idx)
+        else:
+            space = capacity
+            bin_idx = n_bins
+            n_bins += 1
+        bin_of_item[item] = bin_idx
+        space -= size
+        if space > 0:
+            if space not in bins_by_space:
+                bins_by_space[space] = []
+                insort(spaces, space)
+            bins_by_space[space].append(bin_idx)
+    items = np.argsort(bin_of_item, kind='stable')
+    bin_offsets = np.zeros(n_bins + 1, dtype=np.int64)
+    np.cumsum(np.bincount(bin_of_item, minlength=n_bins), out=bin_offsets[1:])
+    return bin_offsets, items
+
+
+class PackedLMDataset(torch.utils.data.Dataset):
+
+    def __init__(self, tokens, doc_offsets, seq_len, pad_token_id=0, ignore_index=-100):
+        """tokens should be a numpy array, and doc_offsets the (n_docs + 1,) offsets of the
+        documents in tokens.
+        Each sample is a bin of seq_len tokens that contains whole documents (documents longer
+        than seq_len + 1 tokens are split into pieces), packed with best-fit-decreasing.
+        A document of n tokens takes n - 1 positions, since its last token is only a target.
+        """
+        self.seq_len = seq_len
+        self.pad_token_id = pad_token_id
+        self.ignore_index = ignore_index
+        # We're careful not to slice tokens, since it could be a memmap'ed array or H5 dataset,
+        # and slicing would load it to memory.
+        self.tokens = tokens
+        doc_offsets = np.asarray(doc_offsets, dtype=np.int64)
+        doc_lens = np.diff(doc_offsets)
+        # Split long documents into pieces of seq_len + 1 tokens, overlapping by 1 token so that
+        # every token (except the first of each document) is a target exactly once.
+        n_pieces = np.maximum((doc_lens - 2) // seq_len + 1, 0)
+        n_pieces[doc_lens < 2] = 0  # Documents of 1 token have no target
+        doc_idx = np.repeat(np.arange(len(doc_lens)), n_pieces)
+        piece_idx = np.arange(len(doc_idx)) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+        self.piece_starts = doc_offsets[doc_idx] + piece_idx * seq_len
+        piece_ends = np.minimum(self.piece_starts + seq_len + 1, doc_offsets[doc_idx + 1])
+        # Number of positions (i.e. of targets) of each piece
+        self.piece_lens = piece_ends - self.piece_starts - 1
+        self.bin_offsets, self.pieces = best_fit_decreasing(self.piece_lens, seq_len)
+        n_positions = int(self.piece_lens.sum())
+        self.packing_stats = {
+            'num_documents': int((doc_lens >= 2).sum()),
+            'num_split_documents': int((n_pieces > 1).sum()),
+            'num_sequences': len(self),
+            'num_tokens': n_positions,
+            'padding_tokens': len(self) * seq_len - n_positions,
+            # Fraction of the positions that are not padding
+            'efficiency': n_positions / max(len(self) * seq_len, 1),
+        }
+
+    def __len__(self):
+        return len(self.bin_offsets) - 1
+
+    def __getitem__(self, idx):
+        """Return input_ids and labels of shape (seq_len,), padded at the end (labels with
+        ignore_index), the (n_docs + 1,) int32 cu_seqlens of the documents in the sequence, and
+        their max_seqlen.
+        """
+        pieces = self.pieces[self.bin_offsets[idx]:self.bin_offsets[idx + 1]]
+        starts, lens = self.piece_starts[pieces], self.piece_lens[pieces]
+        input_ids = np.full(self.seq_len, self.pad_token_id, dtype=np.int64)
+        labels = np.full(self.seq_len, self.ignore_index, dtype=np.int64)
+        cu_seqlens = np.zeros(len(pieces) + 1, dtype=np.int32)
+        np.cumsum(lens, out=cu_seqlens[1:])
+        for start, length, offset in zip(starts.tolist(), lens.tolist(), cu_seqlens.tolist()):
+            data = self.tokens[start:start + length + 1].astype(np.int64)
+            input_ids[offset:offset + length] = data[:-1]
+            labels[offset:offset + length] = data[1:]
+        return (torch.from_numpy(input_ids), torch.from_numpy(labels),
+                torch.from_numpy(cu_seqlens), int(lens.max()))
+
+    @staticmethod
+    def collate(batch):
+        """Collate samples into (input_ids, labels, seqlens). seqlens contains the int32
+        cu_seqlens over the flattened (batch_size * seq_len) tokens, where the padding at the end
+        of each sequence is a segment of its own, and max_seqlen, as expected by the varlen
+        attention path (e.g. MHA with cu_seqlens).
+        """
+        input_ids = torch.stack([sample[0] for sample in batch])
+        labels = torch.stack([sample[1] for sample in batch])
+        seq_len = input_ids.shape[1]
+        cu_seqlens, max_seqlen = [torch.zeros(1, dtype=torch.int32)], 0
+        for i, (_, _, sample_cu_seqlens, sample_max_seqlen) in enumerate(batch):
+            ends = sample_cu_seqlens[1:]
+            if ends[-1] < seq_len:  # Padding
+                ends = torch.cat([ends, torch.tensor([seq_len], dtype=torch.int32)])
+                sample_max_seqlen = max(sample_max_seqlen, seq_len - sample_cu_seqlens[-1].item())
+            cu_seqlens.append(ends + i * seq_len)
+            max_seqlen = max(max_seqlen, sample_max_seqlen)
+        seqlens = {'cu_seqlens': torch.cat(cu_seqlens), 'max_seqlen': max_seqlen}
+        return input_ids, labels, seqlens
@@ -0,0 +1,137 @@
+# Tokenize a dataset with several processes straight into one memory-mapped token file.
+# Each process tokenizes a contiguous shard of the examples. A first pass counts the tokens of each
+# shard, so that the exact offset of each shard in the file is known before anything is written,
+# then each process tokenizes its shard again and writes it straight to its offset.
+# New shards can be appended to an existing file, which makes the cache incremental and resumable.
+import hashlib
+from itertools import chain
+from multiprocessing import Pool
+
+import numpy as np
+
+from datasets import DatasetDict
+
+
+def _tokenize_texts(texts, tokenizer, add_eos):
+    # Add EOS token to the end of the text if the text is not empty
+    if add_eos:
+        texts = [(text + tokenizer.eos_token) if text else text for text in texts]
+    return tokenizer(texts)['input_ids']
+
+
+def _count_shard_tokens(dataset, text_column_name, start, end, tokenizer, add_eos, batch_size):
+    """Return the lengths of the non-empty documents of examples start:end."""
+    doc_lens = []
+    for i in range(start, end, batch_size):
+        texts = dataset[i:min(i + batch_size, end)][text_column_name]
+        input_ids = _tokenize_texts(texts, tokenizer, add_eos)
+        doc_lens.extend(len(ids) for ids in input_ids if ids)
+    return np.array(doc_lens, dtype=np.int64)
+
+
+def _tokenize_shard(dataset, text_column_name, start, end, tokenizer, add_eos, filename, dtype,
+                    offset, num_tokens, batch_size):
+    """Tokenize examples start:end into tokens [offset, offset + num_tokens) of filename, where
+    num_tokens was counted by _count_shard_tokens.
+    """
+    if num_tokens == 0:
+        return
+    tokens = np.memmap(filename, dtype=dtype, mode='r+', offset=offset * np.dtype(dtype).itemsize,
+                       shape=(num_tokens,))
+    idx = 0
+    for i in range(start, end, batch_size):
+        texts = dataset[i:min(i + batch_size, end)][text_column_name]
+        batch = np.fromiter(chain(*_tokenize_texts(texts, tokenizer, add_eos)), dtype=dtype)
+        assert idx + len(batch) <= num_tokens, \
+            f'Examples {start}:{end} have more tokens than the {num_tokens} counted'
+        tokens[idx:idx + len(batch)] = batch
+        idx += len(batch)
+    assert idx == num_tokens, \
+        f'Examples {start}:{end} have fewer tokens than the {num_tokens} counted'
+    tokens.flush()
+    del tokens
+
+
+def _shard_hash(dataset, text_column_name, start, end, batch_size):
+    hash_fn = hashlib.blake2b(digest_size=16)
+    for i in range(start, end, batch_size):
+        for text in dataset[i:min(i + batch_size, end)][text_column_name]:
+            data = text.encode()
+            # Prefix with the length, so that the boundaries between examples count
+            hash_fn.update(len(data).to_bytes(8, 'little'))
+            hash_fn.update(data)
+    return hash_fn.hexdigest()
+
+
+def shard_hashes(dataset, text_column_name, example_ranges, num_workers=1, batch_size=1000):
+    """Content hash of the text of examples start:end, for each (start, end) in example_ranges."""
+    with Pool(max(min(num_workers, len(example_ranges)), 1)) as pool:
+        return pool.starmap(_shard_hash, [(dataset, text_column_name, start, end, batch_size)
+                                          for start, end in example_ranges])
+
+
+def tokenize_to_memmap(dataset, text_column_name, tokenizer, add_eos, filename, dtype,
+                       num_workers=1, batch_size=1000, example_ranges=None, offset=0):
+    """Tokenize the text column of dataset into filename, a flat array of tokens of dtype.
+    By default the examples are split into num_workers contiguous shards. Otherwise example_ranges
+    is the list of (start, end) of the shards, each tokenized by its own process.
+    The tokens are written from token offset on, and the file is truncated after them: this
+    appends to the tokens [0, offset) already in the file.
+    Return:
+        num_tokens: int, the number of tokens written
+        doc_lens: (n_docs,) int64 array, the lengths of the non-empty documents
+        shards: list of dicts with the examples (start, end) and the tokens (offset, num_tokens)
+            of each shard
+    """
+    if example_ranges is None:
+        num_shards = max(min(num_workers, len(dataset)), 1)
+        example_bounds = np.linspace(0, len(dataset), num_shards + 1).astype(np.int64).tolist()
+        example_ranges = list(zip(example_bounds[:-1], example_bounds[1:]))
+    num_shards = max(len(example_ranges), 1)
+    with Pool(num_shards) as pool:
+        shard_doc_lens = pool.starmap(
+            _count_shard_tokens,
+            [(dataset, text_column_name, start, end, tokenizer, add_eos, batch_size)
+             for start, end in example_ranges]
+        )
+        lengths = [int(lens.sum()) for lens in shard_doc_lens]
+        offsets = (offset + np.cumsum([0] + lengths, dtype=np.int64)).tolist()
+        # Drop whatever follows the tokens [0, offset) and size the file for the new tokens
+        with open(filename, 'ab') as f:
+            f.truncate(offsets[-1] * np.dtype(dtype).itemsize)
+        pool.starmap(
+            _tokenize_shard,
+            [(dataset, text_column_name, start, end, tokenizer, add_eos, filename, dtype,
+              shard_offset, length, batch_size)
+             for (start, end), shard_offset, length in zip(example_ranges, offsets, lengths)]
+        )
+    doc_lens = np.concatenate([np.zeros(0, dtype=np.int64)] + shard_doc_lens)
+    shards = [{'start': start, 'end': end, 'offset': shard_offset, 'num_tokens': length,
+               'num_documents': len(lens)}
+              for (start, end), shard_offset, length, lens
+              in zip(example_ranges, offsets, lengths, shard_doc_lens)]
+    return offsets[-1] - offset, doc_lens, shards
+
+
+def load_memmap(filename, dtype, num_tokens):
+    # np.memmap can't map an empty file
+    if num_tokens == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=(num_tokens,))
+
+
+def stable_train_test_split(dataset, test_size, seed):
+    """Like Dataset.train_test_split, but whether an example is in the test split only depends on
+    its index and the seed: appending examples to the dataset doesn't move the existing ones from
+    one split to the other, and examples appended to the dataset are appended to their split.
+    """
+    # splitmix64 of the index, as a uniform number in [0, 1)
+    x = np.arange(len(dataset), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+    is_test = (x >> np.uint64(11)).astype(np.float64) / 2.0 ** 53 < test_size
+    return DatasetDict({'train': dataset.select(np.flatnonzero(~is_test)),
+                        'test': dataset.select(np.flatnonzero(is_test))})
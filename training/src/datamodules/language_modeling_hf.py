@@ -1,10 +1,10 @@
 # Adapted from https://github.com/huggingface/transformers/blob/master/examples/pytorch/language-modeling/run_clm.py
 from itertools import chain
+import json
+import os
 from pathlib import Path
 import pickle
 from typing import Any, List, Union
-import subprocess
-import mmap
 
 from multiprocessing.shared_memory import SharedMemory
 
@@ -18,6 +18,9 @@ from datasets import load_dataset
 from pytorch_lightning import LightningDataModule
 
 from src.datamodules.datasets.lm_dataset import LMDataset
+from src.datamodules.datasets.packed_lm_dataset import PackedLMDataset
+from src.datamodules.datasets.tokenized_memmap import tokenize_to_memmap, load_memmap
+from src.datamodules.datasets.tokenized_memmap import shard_hashes, stable_train_test_split
 from src.datamodules.fault_tolerant_sampler import RandomFaultTolerantSampler
 from src.datamodules.fault_tolerant_sampler import FaultTolerantDistributedSampler
 from src.datamodules.datasets.detokenizer import DATASET_TOKENIZATION_REGISTRY
@@ -44,7 +47,8 @@ class LMDataModule(LightningDataModule):
                  detokenize=False, val_only=False, batch_size=32, batch_size_eval=None, num_workers=1,
                  shuffle=False, pin_memory=False, drop_last=False, fault_tolerant=False, ddp=False,
                  fast_forward_epochs=None, fast_forward_batches=None,
-                 use_shmem=True):
+                 use_shmem=True, pack_documents=False, cache_chunk_size=100000,
+                 update_cache=False, stable_val_split=False):
         super().__init__()
         self.dataset_name = dataset_name
         self.dataset_config_name = dataset_config_name
@@ -76,38 +80,79 @@ class LMDataModule(LightningDataModule):
         self.use_shmem = use_shmem
         if self.use_shmem:
             assert cache_dir is not None
+        # Pack whole documents into sequences with best-fit-decreasing, instead of slicing the
+        # concatenated tokens into windows that cross document boundaries
+        self.pack_documents = pack_documents
+        # The memmap cache (use_shmem=False) is tokenized and checkpointed in chunks of this many
+        # examples. With update_cache, prepare_data tokenizes the examples added to the dataset
+        # since the cache was saved.
+        self.cache_chunk_size = cache_chunk_size
+        # If the dataset has no validation split, stable_val_split picks the validation examples
+        # by hashing their index with val_split_seed instead of shuffling the whole dataset, so
+        # that appending examples does not move the existing ones from one split to the other.
+        # This is a different split than the default one for the same val_split_seed.
+        self.stable_val_split = stable_val_split
+        if update_cache:
+            assert not self.use_shmem, 'Only the memmap cache (use_shmem=False) can be updated'
+            assert self.stable_val_split, 'update_cache requires stable_val_split'
+        self.update_cache = update_cache
 
     def prepare_data(self):
         if self.cache_dir is None:  # Just download the dataset
             load_dataset(self.dataset_name, self.dataset_config_name)
         else:  # Process the dataset and save it
-            self.process_dataset()
+            self.process_dataset(update_cache=self.update_cache)
 
     def setup(self, stage=None):
         if stage == 'test' and hasattr(self, 'dataset_test'):
             return
-        concat_ids, self.tokenizer = self.process_dataset()
+        concat_ids, doc_offsets, self.tokenizer = self.process_dataset()
         self.vocab_size = len(self.tokenizer)
         # Create all splits
-        self.dataset_train, self.dataset_val, self.dataset_test = [
-            LMDataset(concat_ids[split], seq_len=self.max_length)
-            for split in ['train', 'validation', 'test']
-        ]
+        if not self.pack_documents:
+            self.dataset_train, self.dataset_val, self.dataset_test = [
+                LMDataset(concat_ids[split], seq_len=self.max_length)
+                for split in ['train', 'validation', 'test']
+            ]
+        else:
+            assert all(offsets is not None for offsets in doc_offsets.values()), \
+                'The cache has no document offsets, it needs to be processed again'
+            # The padding is never attended to nor used as a target, any token works
+            pad_token_id = self.tokenizer.eos_token_id or 0
+            self.dataset_train, self.dataset_val, self.dataset_test = [
+                PackedLMDataset(concat_ids[split], doc_offsets[split], seq_len=self.max_length,
+                                pad_token_id=pad_token_id)
+                for split in ['train', 'validation', 'test']
+            ]
+            for split, dataset in zip(['train', 'validation', 'test'],
+                                      [self.dataset_train, self.dataset_val, self.dataset_test]):
+                stats = dataset.packing_stats
+                logger.info(f'Packed {split}: {stats["num_documents"]} documents '
+                            f'({stats["num_split_documents"]} split) into '
+                            f'{stats["num_sequences"]} sequences, {stats["padding_tokens"]} '
+                            f'padding tokens, packing efficiency {stats["efficiency"]:.2%}')
 
-    def process_dataset(self):
+    def process_dataset(self, update_cache=False):
+        """If update_cache, tokenize the examples that were added to the dataset since the cache
+        was saved, instead of loading the cache as is."""
         cache_dir = None if self.cache_dir is None else self.cache_dir / self._cache_dir_name
         if cache_dir is not None:
-            if cache_dir.is_dir():
+            if self._cache_is_complete(cache_dir) and not update_cache:
                 return self._load_from_cache(cache_dir)
 
         raw_datasets = load_dataset(self.dataset_name, self.dataset_config_name)
         # https://github.com/stanford-crfm/mistral/blob/main/src/corpora/auto.py
         if 'validation' not in raw_datasets:
             assert "train" in raw_datasets, "You must have train in raw_datasets to make a validation raw_datasets"
-            raw_datasets = raw_datasets["train"].train_test_split(
-                test_size=self.val_ratio, seed=self.val_split_seed,
-                shuffle=True  # Otherwise test will be at the end of the dataset
-            )
+            if not self.stable_val_split:
+                raw_datasets = raw_datasets["train"].train_test_split(
+                    test_size=self.val_ratio, seed=self.val_split_seed,
+                    shuffle=True  # Otherwise test will be at the end of the dataset
+                )
+            else:
+                raw_datasets = stable_train_test_split(
+                    raw_datasets["train"], test_size=self.val_ratio, seed=self.val_split_seed
+                )
             raw_datasets['validation'] = raw_datasets['test']
 
         if self.val_only:  # Should only be used for evaluation, not for training
@@ -154,18 +199,26 @@ class LMDataModule(LightningDataModule):
         dtype = np.uint16 if tokenizer.vocab_size < 64 * 1024 else np.int32
         def tokenize_concat(examples):
             # We just need 'input_ids', not 'attention_mask' (since it's all 1)
-            input_ids = np.fromiter(chain(*tokenize(examples)['input_ids']), dtype=dtype)
+            tokenized_ids = tokenize(examples)['input_ids']
+            input_ids = np.fromiter(chain(*tokenized_ids), dtype=dtype)
+            # Lengths of the non-empty documents, to be able to pack documents without crossing
+            # their boundaries
+            doc_lens = np.array([len(ids) for ids in tokenized_ids if ids], dtype=np.int64)
             # Need to return a list since we're doing batched processing
-            return {'input_ids': [input_ids], 'len': [len(input_ids)]}
-        tokenized_datasets = raw_datasets.map(
-            tokenize_concat,
-            batched=True,
-            num_proc=max(self.num_workers, 1),
-            remove_columns=column_names,
-            desc="Running tokenizer on dataset",
-        )
+            return {'input_ids': [input_ids], 'len': [len(input_ids)], 'doc_lens': [doc_lens]}
 
         if self.use_shmem:
+            tokenized_datasets = raw_datasets.map(
+                tokenize_concat,
+                batched=True,
+                num_proc=max(self.num_workers, 1),
+                remove_columns=column_names,
+                desc="Running tokenizer on dataset",
+            )
+            doc_offsets = {}
+            for name, ds in tokenized_datasets.items():
+                doc_lens = np.fromiter(chain(*ds['doc_lens']), dtype=np.int64)
+                doc_offsets[name] = np.concatenate([[0], np.cumsum(doc_lens)])
             # Concatenate all input_ids into an array in shared memory
             def write_ids_to_shm(example, shm_name, array_len):
                 shm = SharedMemory(name=shm_name)
@@ -192,63 +245,141 @@ class LMDataModule(LightningDataModule):
                 # https://github.com/numpy/numpy/issues/18294
                 concat_ids[name] = SHMArray(shm_arr, shm=shm)
         else:
-            # Use disk
-            concat_ids = {}
+            # Use disk: each worker tokenizes a contiguous chunk of the examples straight into its
+            # own region of one memmap per split, which is the cache itself
             assert cache_dir is not None
-            cache_dir.mkdir(parents=True, exist_ok=True)
-            def write_ids_to_disk(example, filename):
-                with open(filename, 'r+b') as f:
-                    mm = mmap.mmap(f.fileno(), 0)
-                    start_idx = example['len_offset'] - len(example['input_ids'])
-                    array_len = len(example['input_ids'])
-                    arr = np.ndarray((array_len,), dtype=dtype, buffer=mm,
-                                     offset=np.dtype(dtype).itemsize * start_idx)
-                    arr[:] = example['input_ids']
-                    mm.flush()
-            for name, ds in tokenized_datasets.items():
-                tokenized_datasets[name] = ds.add_column('len_offset', np.cumsum(ds['len']))
-                array_len = tokenized_datasets[name][-1]['len_offset']
-                filename = cache_dir / f'{name}.bin'
-                # Need to create the file with this specific size first
-                # https://ostechnix.com/create-files-certain-size-linux/
-                subprocess.run(['truncate', '-s', str(array_len * np.dtype(dtype).itemsize),
-                                str(filename)], check=True)
-                tokenized_datasets[name].map(
-                    write_ids_to_disk,
-                    fn_kwargs={'filename': filename},
-                    batched=False,
-                    num_proc=max(self.num_workers, 1),
-                    desc="Concatenating examples",
-                )
-                concat_ids[name] = np.memmap(filename, dtype=dtype, mode='r', shape=(array_len,))
+            return self._tokenize_to_cache(raw_datasets, text_column_name, tokenizer, dtype,
+                                           cache_dir)
 
         if cache_dir is not None:
-            self._save_to_cache(concat_ids, tokenizer, cache_dir)
-            if not self.use_shmem:
-                for name in concat_ids:
-                    Path(cache_dir / f'{name}.bin').unlink()
-        return concat_ids, tokenizer
+            self._save_to_cache(concat_ids, doc_offsets, tokenizer, cache_dir)
+        return concat_ids, doc_offsets, tokenizer
 
-    def _save_to_cache(self, concat_ids, tokenizer, cache_dir):
+    def _tokenize_to_cache(self, raw_datasets, text_column_name, tokenizer, dtype, cache_dir):
+        """Tokenize into the memmap cache, cache_chunk_size examples at a time. The index records
+        the content hash of each tokenized chunk, and is saved after every group of chunks: chunks
+        that are unchanged are kept, so an interrupted run resumes where it stopped, and only
+        the examples appended to the dataset since the last run are tokenized.
+        """
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        chunk_size = self.cache_chunk_size
+        num_workers = max(self.num_workers, 1)
+        index = self._read_index(cache_dir)
+        if (index is None or index['dtype'] != np.dtype(dtype).name
+                or index.get('chunk_size') != chunk_size):
+            index = {'dtype': np.dtype(dtype).name, 'chunk_size': chunk_size, 'splits': {}}
+        index['complete'] = False
+        for name, ds in raw_datasets.items():
+            split = index['splits'].setdefault(
+                name, {'num_tokens': 0, 'num_documents': 0, 'chunks': []}
+            )
+            chunk_ranges = [(start, min(start + chunk_size, len(ds)))
+                            for start in range(0, len(ds), chunk_size)]
+            hashes = shard_hashes(ds, text_column_name, chunk_ranges, num_workers=num_workers)
+            # Keep the tokenized chunks up to the first one that changed
+            num_kept = 0
+            for chunk, (start, end), chunk_hash in zip(split['chunks'], chunk_ranges, hashes):
+                if (chunk['start'], chunk['end'], chunk['hash']) != (start, end, chunk_hash):
+                    break
+                num_kept += 1
+            del split['chunks'][num_kept:]
+            split['num_tokens'] = sum(chunk['num_tokens'] for chunk in split['chunks'])
+            split['num_documents'] = sum(chunk['num_documents'] for chunk in split['chunks'])
+            # The index is saved before the files are truncated, so that it never refers to tokens
+            # that aren't there
+            self._write_index(index, cache_dir)
+            tokens_filename = cache_dir / f'{name}.bin'
+            doc_offsets_filename = cache_dir / f'{name}_doc_offsets.bin'
+            for filename in [tokens_filename, doc_offsets_filename]:
+                open(filename, 'ab').close()
+            os.truncate(tokens_filename, split['num_tokens'] * np.dtype(dtype).itemsize)
+            if split['num_documents'] == 0:
+                np.zeros(1, dtype=np.int64).tofile(doc_offsets_filename)
+            else:
+                os.truncate(doc_offsets_filename, (split['num_documents'] + 1) * 8)
+            pending = list(zip(chunk_ranges, hashes))[num_kept:]
+            logger.info(f'Tokenizing {name}: {num_kept} chunks of {chunk_size} examples in the '
+                        f'cache, {len(pending)} to tokenize')
+            for i in range(0, len(pending), num_workers):
+                group = pending[i:i + num_workers]
+                num_tokens, doc_lens, shards = tokenize_to_memmap(
+                    ds, text_column_name, tokenizer, self.add_eos, tokens_filename, dtype,
+                    example_ranges=[chunk_range for chunk_range, _ in group],
+                    offset=split['num_tokens']
+                )
+                with open(doc_offsets_filename, 'ab') as f:
+                    f.write((split['num_tokens'] + np.cumsum(doc_lens, dtype=np.int64)).tobytes())
+                for shard, (_, chunk_hash) in zip(shards, group):
+                    split['chunks'].append({**shard, 'hash': chunk_hash})
+                split['num_tokens'] += num_tokens
+                split['num_documents'] += len(doc_lens)
+                self._write_index(index, cache_dir)  # Checkpoint
+        with open(cache_dir / 'tokenizer.pkl', 'wb') as f:
+            pickle.dump(tokenizer, f)
+        index['complete'] = True
+        self._write_index(index, cache_dir)
+        logger.info(f'Saved to cache at {str(cache_dir)}')
+        return self._load_from_cache(cache_dir)
+
+    @staticmethod
+    def _read_index(cache_dir):
+        if not (cache_dir / 'index.json').exists():
+            return None
+        with open(cache_dir / 'index.json') as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write_index(index, cache_dir):
+        # Replace atomically, so that a crash leaves either the old or the new index
+        with open(cache_dir / 'index.json.tmp', 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(cache_dir / 'index.json.tmp', cache_dir / 'index.json')
+
+    def _cache_is_complete(self, cache_dir):
+        index = self._read_index(cache_dir)
+        # Caches saved with np.save are written at the end of process_dataset
+        return index.get('complete', False) if index is not None else cache_dir.is_dir()
+
+    def _save_to_cache(self, concat_ids, doc_offsets, tokenizer, cache_dir):
         cache_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f'Saving to cache at {str(cache_dir)}')
         for k, v in concat_ids.items():
             np.save(cache_dir / f'{k}.npy', v)
+        for k, v in doc_offsets.items():
+            np.save(cache_dir / f'{k}_doc_offsets.npy', v)
         with open(cache_dir / 'tokenizer.pkl', 'wb') as f:
             pickle.dump(tokenizer, f)
 
     def _load_from_cache(self, cache_dir):
         assert cache_dir.is_dir()
         logger.info(f'Load from cache at {str(cache_dir)}')
-        concat_ids = {split: np.load(cache_dir / f'{split}.npy', mmap_mode='r')
-                      for split in ['train', 'validation', 'test']}
+        # Everything is memory-mapped, nothing is read until it's used
+        index = self._read_index(cache_dir)
+        if index is not None:  # Tokens written straight to a memmap
+            assert index.get('complete', False), \
+                'The cache is incomplete, it needs to be processed again'
+            splits = index['splits']
+            concat_ids = {split: load_memmap(cache_dir / f'{split}.bin', index['dtype'],
+                                             splits[split]['num_tokens'])
+                          for split in ['train', 'validation', 'test']}
+            doc_offsets = {split: load_memmap(cache_dir / f'{split}_doc_offsets.bin', np.int64,
+                                              splits[split]['num_documents'] + 1)
+                           for split in ['train', 'validation', 'test']}
+        else:
+            concat_ids = {split: np.load(cache_dir / f'{split}.npy', mmap_mode='r')
+                          for split in ['train', 'validation', 'test']}
+            # Caches written before document offsets were saved don't have them
+            doc_offsets = {split: (np.load(cache_dir / f'{split}_doc_offsets.npy', mmap_mode='r')
+                                   if (cache_dir / f'{split}_doc_offsets.npy').exists() else None)
+                           for split in ['train', 'validation', 'test']}
         with open(cache_dir / 'tokenizer.pkl', 'rb') as f:
             tokenizer = pickle.load(f)
-        return concat_ids, tokenizer
+        return concat_ids, doc_offsets, tokenizer
 
     @property
     def _cache_dir_name(self):
-        return f'tokenizer_name-{self.tokenizer_name}-val_ratio-{self.val_ratio}-val_split_seed-{self.val_split_seed}-add_eos-{self.add_eos}-detokenize-{self.detokenize}'
+        name = f'tokenizer_name-{self.tokenizer_name}-val_ratio-{self.val_ratio}-val_split_seed-{self.val_split_seed}-add_eos-{self.add_eos}-detokenize-{self.detokenize}'
+        return name if not self.stable_val_split else name + '-stable_val_split'
 
     def train_dataloader(self, *args: Any, **kwargs: Any) -> DataLoader:
         """ The train dataloader """
@@ -285,6 +416,7 @@ class LMDataModule(LightningDataModule):
             num_workers=1,  # Data is already in memory, we don't need many workers
             shuffle=shuffle,
             sampler=sampler,
+            collate_fn=PackedLMDataset.collate if self.pack_documents else None,
             drop_last=self.drop_last,
             pin_memory=self.pin_memory,
             # persistent_workers=True
@@ -58,7 +58,7 @@ class Perplexity(Metric):
         """
         count = target.numel()
         if loss is None:
-            loss = self.loss_fn(preds, target)
+            loss = self.loss_fn(preds.reshape(-1, preds.shape[-1]), target.reshape(-1))
         self.total_log_probs += loss.double() * count
         self.count += count
 
@@ -96,7 +96,10 @@ class SequenceModel(LightningModule):
         except ValueError:
             x, y = batch
             lengths = None
-        output = self.forward(x) if lengths is None else self.forward(x, lengths=lengths)
+        if isinstance(lengths, dict):  # cu_seqlens and max_seqlen of packed documents
+            output = self.forward(x, **lengths)
+        else:
+            output = self.forward(x) if lengths is None else self.forward(x, lengths=lengths)
         loss = self.loss_fn(output, y) if is_train else self.loss_fn_val(output, y)
         return loss, output, y
 
@@ -169,8 +172,12 @@ class SequenceModel(LightningModule):
 class SequenceLMModel(SequenceModel):
 
     def step(self, batch: Any, is_train=True):
-        x, y = batch
-        output = self.forward(x).logits
+        try:
+            x, y, seqlens = batch  # cu_seqlens and max_seqlen of packed documents
+        except ValueError:
+            x, y = batch
+            seqlens = {}
+        output = self.forward(x, **seqlens).logits
         output = rearrange(output, '... C -> (...) C')
         y = rearrange(y, '... -> (...)')
         loss = self.loss_fn(output, y) if is_train else self.loss_fn_val(output, y)
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+import torch
+
+from transformers import GPT2Config
+
+from flash_attn.models.gpt import GPTLMHeadModel
+
+from src.datamodules.datasets.packed_lm_dataset import PackedLMDataset, best_fit_decreasing
+
+
+class TestPackedLMDataset:
+
+    def test_best_fit_decreasing(self):
+        sizes = np.array([5, 3, 7, 2, 4, 8, 1, 6])
+        bin_offsets, items = best_fit_decreasing(sizes, capacity=10)
+        bins = [sorted(items[bin_offsets[i]:bin_offsets[i + 1]].tolist())
+                for i in range(len(bin_offsets) - 1)]
+        # 8 -> bin 0, 7 -> bin 1, 6 -> bin 2, 5 -> bin 3, 4 -> bin 2 (best fit), 3 -> bin 1,
+        # 2 -> bin 0, 1 -> bin 3
+        assert bins == [[3, 5], [1, 2], [4, 7], [0, 6]]
+        assert sorted(items.tolist()) == list(range(len(sizes)))
+        assert all(sizes[b].sum() <= 10 for b in bins)
+
+    @pytest.mark.parametrize('seq_len', [8, 16, 50])
+    def test_packed_lm_dataset(self, seq_len):
+        rng = np.random.default_rng(0)
+        doc_lens = rng.integers(1, 40, size=100)
+        doc_offsets = np.concatenate([[0], np.cumsum(doc_lens)])
+        tokens = rng.integers(0, 1000, size=doc_offsets[-1]).astype(np.uint16)
+        dataset = PackedLMDataset(tokens, doc_offsets, seq_len=seq_len, pad_token_id=0)
+        targets = []
+        for idx in range(len(dataset)):
+            x, y, cu_seqlens, max_seqlen = dataset[idx]
+            assert x.shape == y.shape == (seq_len,)
+            assert cu_seqlens.dtype == torch.int32 and cu_seqlens[-1] <= seq_len
+            seqlens = cu_seqlens.diff()
+            assert max_seqlen == seqlens.max().item()
+            assert (y[cu_seqlens[-1]:] == -100).all()
+            for start, end in zip(cu_seqlens[:-1].tolist(), cu_seqlens[1:].tolist()):
+                # Within a document, the targets are the inputs shifted by one
+                assert torch.equal(x[start + 1:end], y[start:end - 1])
+                targets.append(y[start:end])
+        # Every token except the first one of each document is a target exactly once
+        targets = torch.cat(targets).sort().values
+        expected = np.concatenate([tokens[start + 1:end]
+                                   for start, end in zip(doc_offsets[:-1], doc_offsets[1:])])
+        assert torch.equal(targets, torch.from_numpy(np.sort(expected).astype(np.int64)))
+        stats = dataset.packing_stats
+        assert stats['num_tokens'] == len(expected)
+        assert stats['num_documents'] == (doc_lens >= 2).sum()
+        assert stats['efficiency'] == len(expected) / (len(dataset) * seq_len)
+
+    def test_collate(self):
+        doc_offsets = np.array([0, 6, 9, 12])
+        tokens = np.arange(12)
+        dataset = PackedLMDataset(tokens, doc_offsets, seq_len=6)
+        batch = [dataset[idx] for idx in range(len(dataset))]
+        x, y, seqlens = PackedLMDataset.collate(batch)
+        # Bins: [doc 0 (5 positions)], [doc 1, doc 2 (2 positions each), padding]
+        assert x.shape == y.shape == (2, 6)
+        assert seqlens['cu_seqlens'].tolist() == [0, 5, 6, 8, 10, 12]
+        assert seqlens['cu_seqlens'].dtype == torch.int32
+        assert seqlens['max_seqlen'] == 5
+
+    def test_packed_batch_through_model(self):
+        """Each packed document gets the same logits as when it's run through the model alone."""
+        rng = np.random.default_rng(0)
+        doc_lens = rng.integers(2, 20, size=20)
+        doc_offsets = np.concatenate([[0], np.cumsum(doc_lens)])
+        tokens = rng.integers(0, 128, size=doc_offsets[-1])
+        dataset = PackedLMDataset(tokens, doc_offsets, seq_len=32)
+        x, y, seqlens = PackedLMDataset.collate([dataset[idx] for idx in range(len(dataset))])
+        config = GPT2Config(n_embd=64, n_head=4, n_layer=2, vocab_size=128, n_positions=64)
+        torch.manual_seed(0)
+        model = GPTLMHeadModel(config)
+        model.eval()
+        with torch.no_grad():
+            logits = model(x, **seqlens).logits.flatten(0, 1)
+            x, y = x.flatten(), y.flatten()
+            cu_seqlens = seqlens['cu_seqlens'].tolist()
+            for start, end in zip(cu_seqlens[:-1], cu_seqlens[1:]):
+                if y[start] == -100:  # Padding
+                    continue
+                logits_ref = model(x[None, start:end]).logits[0]
+                assert torch.allclose(logits[start:end], logits_ref, atol=1e-5)
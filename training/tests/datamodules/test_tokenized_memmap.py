@@ -0,0 +1,151 @@
+from itertools import chain
+import json
+
+import numpy as np
+import pytest
+
+from datasets import Dataset, DatasetDict
+
+from src.datamodules.datasets.tokenized_memmap import tokenize_to_memmap, load_memmap
+from src.datamodules.datasets.tokenized_memmap import stable_train_test_split
+from src.datamodules.language_modeling_hf import LMDataModule
+
+
+class ByteTokenizer:
+    """Byte-level tokenizer, with the EOS token mapped to 0."""
+
+    eos_token = '</s>'
+
+    def __call__(self, texts):
+        encode = lambda text: list(text.replace(self.eos_token, '\x00').encode())
+        if isinstance(texts, str):
+            return {'input_ids': encode(texts)}
+        return {'input_ids': [encode(text) for text in texts]}
+
+
+class ExpandingTokenizer(ByteTokenizer):
+    """Byte-level tokenizer that adds a BOS token and splits each byte into 3 tokens, so that
+    documents have more tokens than UTF-8 bytes (e.g. NFKC normalization or special tokens)."""
+
+    def __call__(self, texts):
+        encode = lambda ids: [1] + [token for i in ids for token in (i, i + 256, i + 512)]
+        input_ids = super().__call__(texts)['input_ids']
+        if isinstance(texts, str):
+            return {'input_ids': encode(input_ids)}
+        return {'input_ids': [encode(ids) for ids in input_ids]}
+
+
+class TestTokenizeToMemmap:
+
+    @pytest.mark.parametrize('tokenizer_cls', [ByteTokenizer, ExpandingTokenizer])
+    # @pytest.mark.parametrize('tokenizer_cls', [ExpandingTokenizer])
+    @pytest.mark.parametrize('add_eos', [False, True])
+    @pytest.mark.parametrize('num_workers', [1, 3])
+    def test_tokenize_to_memmap(self, num_workers, add_eos, tokenizer_cls, tmp_path):
+        rng = np.random.default_rng(0)
+        texts = [''.join(rng.choice(list('abcdé €'), size=n)) for n in rng.integers(0, 50, 100)]
+        texts[3] = ''
+        dataset = Dataset.from_dict({'text': texts})
+        tokenizer = tokenizer_cls()
+        filename = tmp_path / 'train.bin'
+        num_tokens, doc_lens, shards = tokenize_to_memmap(
+            dataset, 'text', tokenizer, add_eos, filename, np.uint16, num_workers=num_workers,
+            batch_size=7
+        )
+        add_eos_fn = lambda text: (text + tokenizer.eos_token) if add_eos and text else text
+        expected = [tokenizer(add_eos_fn(text))['input_ids'] for text in texts]
+        assert num_tokens == sum(len(ids) for ids in expected)
+        # The file holds exactly the tokens
+        assert filename.stat().st_size == num_tokens * 2
+        tokens = load_memmap(filename, np.uint16, num_tokens)
+        assert np.array_equal(tokens, np.fromiter(chain(*expected), dtype=np.uint16))
+        assert doc_lens.tolist() == [len(ids) for ids in expected if ids]
+        assert len(shards) == num_workers
+        assert shards[0]['start'] == 0 and shards[-1]['end'] == len(texts)
+        for shard, next_shard in zip(shards[:-1], shards[1:]):
+            assert shard['end'] == next_shard['start']
+            assert shard['offset'] + shard['num_tokens'] == next_shard['offset']
+
+
+def test_stable_train_test_split():
+    dataset = Dataset.from_dict({'text': [str(i) for i in range(2000)]})
+    splits = stable_train_test_split(dataset, test_size=0.1, seed=2357)
+    assert 100 < len(splits['test']) < 300
+    assert len(splits['train']) + len(splits['test']) == len(dataset)
+    # Appending examples doesn't move the existing ones to the other split
+    splits_prefix = stable_train_test_split(dataset.select(range(1500)), test_size=0.1, seed=2357)
+    for name in ['train', 'test']:
+        prefix = splits_prefix[name]['text']
+        assert splits[name]['text'][:len(prefix)] == prefix
+
+
+class TestIncrementalCache:
+
+    def _tokenize_to_cache(self, texts, cache_dir, num_workers=2):
+        datamodule = LMDataModule('dataset', tokenizer_name='tokenizer', cache_dir=cache_dir,
+                                  use_shmem=False, num_workers=num_workers, cache_chunk_size=16)
+        dataset = Dataset.from_dict({'text': texts})
+        raw_datasets = DatasetDict({'train': dataset, 'validation': dataset.select(range(10)),
+                                    'test': dataset.select(range(10))})
+        return datamodule._tokenize_to_cache(raw_datasets, 'text', ByteTokenizer(), np.uint16,
+                                             cache_dir)
+
+    def test_incremental_cache(self, tmp_path):
+        rng = np.random.default_rng(0)
+        texts = [''.join(rng.choice(list('abcdé €'), size=n)) for n in rng.integers(0, 50, 150)]
+        concat_ids_ref, doc_offsets_ref, _ = self._tokenize_to_cache(texts, tmp_path / 'ref')
+        cache_dir = tmp_path / 'cache'
+        self._tokenize_to_cache(texts[:100], cache_dir)
+        with open(cache_dir / 'index.json') as f:
+            chunks = json.load(f)['splits']['train']['chunks']
+        # Examples are appended: the 6 full chunks are kept, the partial one is tokenized again
+        concat_ids, doc_offsets, _ = self._tokenize_to_cache(texts, cache_dir)
+        with open(cache_dir / 'index.json') as f:
+            index = json.load(f)
+        assert index['complete']
+        assert index['splits']['train']['chunks'][:6] == chunks[:6]
+        assert len(index['splits']['train']['chunks']) == 10
+        assert np.array_equal(concat_ids['train'], concat_ids_ref['train'])
+        assert np.array_equal(doc_offsets['train'], doc_offsets_ref['train'])
+        # Changed examples are tokenized again, from the first chunk that changed
+        texts[40] = 'changed'
+        concat_ids_ref, doc_offsets_ref, _ = self._tokenize_to_cache(texts, tmp_path / 'ref2')
+        concat_ids, doc_offsets, _ = self._tokenize_to_cache(texts, cache_dir)
+        assert np.array_equal(concat_ids['train'], concat_ids_ref['train'])
+        assert np.array_equal(doc_offsets['train'], doc_offsets_ref['train'])
+
+    def test_resume(self, tmp_path):
+        rng = np.random.default_rng(0)
+        texts = [''.join(rng.choice(list('abcdé €'), size=n)) for n in rng.integers(0, 50, 150)]
+        concat_ids_ref, doc_offsets_ref, _ = self._tokenize_to_cache(texts, tmp_path / 'ref')
+        cache_dir = tmp_path / 'cache'
+        self._tokenize_to_cache(texts, cache_dir)
+        # Interrupted after the checkpoint of the first 4 chunks: the index has the first 4
+        # chunks, the files have more tokens
+        with open(cache_dir / 'index.json') as f:
+            index = json.load(f)
+        split = index['splits']['train']
+        del split['chunks'][4:]
+        split['num_tokens'] = sum(chunk['num_tokens'] for chunk in split['chunks'])
+        split['num_documents'] = sum(chunk['num_documents'] for chunk in split['chunks'])
+        index['complete'] = False
+        with open(cache_dir / 'index.json', 'w') as f:
+            json.dump(index, f)
+        datamodule = LMDataModule('dataset', tokenizer_name='tokenizer', cache_dir=tmp_path,
+                                  use_shmem=False)
+        assert not datamodule._cache_is_complete(cache_dir)
+        concat_ids, doc_offsets, _ = self._tokenize_to_cache(texts, cache_dir)
+        assert datamodule._cache_is_complete(cache_dir)
+        assert np.array_equal(concat_ids['train'], concat_ids_ref['train'])
+        assert np.array_equal(doc_offsets['train'], doc_offsets_ref['train'])
+
+    def test_update_cache_requires_stable_val_split(self, tmp_path):
+        with pytest.raises(AssertionError):
+            LMDataModule('dataset', tokenizer_name='tokenizer', cache_dir=tmp_path,
+                         use_shmem=False, update_cache=True)
+        datamodule = LMDataModule('dataset', tokenizer_name='tokenizer', cache_dir=tmp_path,
+                                  use_shmem=False, update_cache=True, stable_val_split=True)
+        # The default split and the stable split don't share a cache
+        assert datamodule._cache_dir_name != LMDataModule(
+            'dataset', tokenizer_name='tokenizer', cache_dir=tmp_path, use_shmem=False
+        )._cache_dir_name